@@ -0,0 +1,1237 @@
+#!/bin/python
+# anukoron - Instruction set simulator for Sutra-1
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''
+Runs Sutra-1 memory images without Logisim.
+
+Every possible 10 bit word is decoded once into a handler, so executing a word is one table lookup
+and one call. Handlers take the address after the word and return the address to continue at.
+Addresses above the 20 bit range stop the inner loop: HALT, a wrap around the end of memory, or a
+word that may have made an interrupt deliverable (LOADISR, ILOCKSET, writing IMR).
+
+BlockMachine compiles straight line code into Python functions instead, see its documentation.
+'''
+
+import argparse, bisect, collections, itertools, json, time, functools
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import rochoyita
+from rochoyita import Constants, AssemblerError, decoded_words, print_error, ALU_AZ, ALU_AC, ALU_BZ, ALU_BC, ALU_CIN, ALU_N, ALU_OC
+
+VERSION = 1.0
+
+MEMORY_SIZE = 0x100000
+ADDRESS_MASK = MEMORY_SIZE - 1
+
+EVENT = MEMORY_SIZE << 1    # interrupts have to be checked before the next word
+HALTED = MEMORY_SIZE << 2
+
+# slots of Machine.registers. Destination register indices are the same as slots, source register
+# index 6 is ISR and 7 is not connected
+A, B, C, D, SP, IMR, MARL, MARH, ISR, ZERO, RESULT, STATUS, FLAGS, LOCK = range(14)
+
+REGISTERS = ('A', 'B', 'C', 'D', 'SP', 'IMR', 'MARL', 'MARH', 'ISR')
+SOURCE_SLOTS = (A, B, C, D, SP, IMR, ISR, ZERO)
+
+INTERRUPT_LINES = 0xF
+
+# result flags latched by ALUEVAL, in the order stored by ALUSTOREF
+STATUS_ZERO, STATUS_NEGATIVE, STATUS_CARRY = 1, 2, 4
+
+class SimulatorError(Exception):
+    def __init__(self, *text):
+        super().__init__('\n'.join(text))
+        self.text = text
+
+def error_raw(*text):
+    raise SimulatorError(*text)
+
+# ALU
+
+def alu_operation(flags):
+    # (a, b) -> (result, status) for one set of ALU flags, same as rochoyita.alu
+    a_mask = 0 if flags & ALU_AZ else 0x3FF
+    a_complement = 0x3FF if flags & ALU_AC else 0
+    b_mask = 0 if flags & ALU_BZ else 0x3FF
+    b_complement = 0x3FF if flags & ALU_BC else 0
+    output_complement = 0x3FF if flags & ALU_OC else 0
+
+    if flags & ALU_N:
+        nand_complement = 0x3FF ^ output_complement
+        def nand(a, b):
+            result = (((a & a_mask) ^ a_complement) & ((b & b_mask) ^ b_complement)) ^ nand_complement
+            return result, ((result >> 9) << 1) | (result == 0)
+
+        return nand
+
+    carry_in = 1 if flags & ALU_CIN else 0
+
+    def add(a, b):
+        total = ((a & a_mask) ^ a_complement) + ((b & b_mask) ^ b_complement) + carry_in
+        result = (total & 0x3FF) ^ output_complement
+        return result, ((total >> 10) << 2) | ((result >> 9) << 1) | (result == 0)
+
+    return add
+
+alu_operations = [alu_operation(flags) for flags in range(128)]
+
+# memory images
+
+def read_hex(file, memory=None):
+    # Logisim Evolution v3.0 image, addressed or plain, with N*value runs
+    memory = memory if memory is not None else [0] * MEMORY_SIZE
+
+    try:
+        hex_file = open(file, 'r')
+    except OSError:
+        error_raw(f'input file "{file}" not found!')
+
+    with hex_file:
+        header = hex_file.readline().split()
+        if header[:3] != ['v3.0', 'hex', 'words']:
+            error_raw(f'"{file}" is not a Logisim Evolution v3.0 hex file')
+
+        addressed = header[3:] == ['addressed']
+        address = 0
+
+        for line_number, line in enumerate(hex_file, 2):
+            line = line.partition('#')[0].strip()
+            if not line:
+                continue
+
+            try:
+                if addressed:
+                    row_address, _, line = line.partition(':')
+                    address = int(row_address, 16)
+
+                for token in line.split():
+                    count, _, value = token.rpartition('*')
+                    count = int(count) if count else 1
+                    word = int(value, 16)
+
+                    if word > 0x3FF or address + count > MEMORY_SIZE:
+                        raise ValueError
+
+                    memory[address:address + count] = [word] * count
+                    address += count
+            except ValueError:
+                error_raw(f'ERROR in line #{line_number} of "{file}": "{line}"', 'invalid word or address')
+
+    return memory
+
+def program_memory(program, memory=None):
+    # memory image of an assembled rochoyita.Program
+    memory = memory if memory is not None else [0] * MEMORY_SIZE
+    memory[:len(program.program)] = program.program
+    memory[Constants.ISR_ADDRESS:Constants.ISR_ADDRESS + len(program.isr)] = program.isr
+    return memory
+
+def load(file, defines=None, include_paths=()):
+    # memory image of a hex file, or of an assembly source file assembled first
+    if Path(file).suffix.lower() == '.s':
+        return program_memory(rochoyita.assemble_file(file, defines, include_paths))
+
+    return read_hex(file)
+
+def load_debug(file, defines=None, include_paths=()):
+    # memory image and debug map of an assembly source file, or of a hex file without a map
+    if Path(file).suffix.lower() == '.s':
+        program = rochoyita.assemble_file(file, defines, include_paths, listing=True)
+        return program_memory(program), rochoyita.debug_map(program)
+
+    return read_hex(file), None
+
+# simulation
+
+class Machine:
+    '''
+    One Sutra-1 CPU and its memory.
+
+    `output` is called with every word put on the output bus, by default they are collected in
+    `outputs`. An interrupt is taken at the start of a cycle when a line of ISR not masked by IMR is
+    set and interrupts are not locked: execution continues at the ISR address, without saving
+    anything or locking, so every ISR starts with ILOCKSET 1. Without an ISR, execution halts.
+    '''
+
+    def __init__(self, memory, output=None):
+        self.memory = memory
+        self.registers = [0] * 14
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        self.outputs = []
+        self.output = output if output is not None else self.outputs.append
+        self.dispatch = [self.handler(word) for word in range(1024)]
+
+    def handler(self, word):
+        # function executing one word, given the address after it and returning the next address
+        r = self.registers
+        memory = self.memory
+        decoded = decoded_words[word]
+
+        if decoded is None:
+            return lambda pc: pc
+
+        name, operands = decoded
+
+        match name:
+            case 'COPY':
+                source, destination = SOURCE_SLOTS[operands[0]], operands[1]
+                event = EVENT if destination == IMR else 0
+                def h(pc):
+                    r[destination] = r[source]
+                    return pc | event
+            case 'LOADIU':
+                destination, upper = operands[0], operands[1] << 5
+                def h(pc):
+                    r[destination] = upper | (r[destination] & 0x1F)
+                    return pc
+            case 'LOADIL':
+                destination, lower = operands
+                def h(pc):
+                    r[destination] = (r[destination] & 0x3E0) | lower
+                    return pc
+            case 'ALUFSET':
+                flags = operands[0]
+                def h(pc):
+                    r[FLAGS] = flags
+                    return pc
+            case 'ALUFSETR':
+                source = SOURCE_SLOTS[operands[0]]
+                def h(pc):
+                    r[FLAGS] = r[source] & 0x7F
+                    return pc
+            case 'ALUEVAL':
+                source = SOURCE_SLOTS[operands[0]]
+                def h(pc):
+                    r[RESULT], r[STATUS] = alu_operations[r[FLAGS]](r[A], r[source])
+                    return pc
+            case 'ALUSTOREF':
+                destination = operands[0]
+                event = EVENT if destination == IMR else 0
+                def h(pc):
+                    r[destination] = r[STATUS]
+                    return pc | event
+            case 'ALUSTORER':
+                destination = operands[0]
+                event = EVENT if destination == IMR else 0
+                def h(pc):
+                    r[destination] = r[RESULT]
+                    return pc | event
+            case 'AOP':
+                match operands[0]:
+                    case 1:
+                        def h(pc):
+                            r[A] >>= 1
+                            return pc
+                    case 2:
+                        def h(pc):
+                            r[A] = (r[A] << 1) & 0x3FF
+                            return pc
+                    case _:
+                        h = lambda pc: pc
+            case 'STORE':
+                source = SOURCE_SLOTS[operands[0]]
+                def h(pc):
+                    memory[(r[MARH] << 10) | r[MARL]] = r[source]
+                    return pc
+            case 'LOAD':
+                destination = operands[0]
+                event = EVENT if destination == IMR else 0
+                def h(pc):
+                    r[destination] = memory[(r[MARH] << 10) | r[MARL]]
+                    return pc | event
+            case 'JUMP':
+                match operands[0]:
+                    case 0:
+                        h = lambda pc: (r[MARH] << 10) | r[MARL]
+                    case mode:
+                        condition = (STATUS_ZERO, STATUS_NEGATIVE, STATUS_CARRY)[mode - 1]
+                        h = lambda pc: (r[MARH] << 10) | r[MARL] if r[STATUS] & condition else pc
+            case 'OUT':
+                source = SOURCE_SLOTS[operands[0]]
+                output = self.output
+                def h(pc):
+                    output(r[source])
+                    return pc
+            case 'LOADISR':
+                lines = operands[0]
+                def h(pc):
+                    r[ISR] = lines
+                    return pc | EVENT
+            case 'ILOCKSET':
+                lock = operands[0]
+                def h(pc):
+                    r[LOCK] = lock
+                    return pc | EVENT
+            case 'NOOP':
+                h = lambda pc: pc
+            case 'HALT':
+                h = lambda pc: (pc - 1) | HALTED
+
+        return h
+
+    def interrupt(self, lines):
+        # set interrupt lines of ISR, as an external device would
+        self.registers[ISR] |= lines & INTERRUPT_LINES
+
+    def interrupt_pending(self):
+        r = self.registers
+        return bool(r[ISR] & ~r[IMR] & INTERRUPT_LINES) and not r[LOCK]
+
+    def has_isr(self):
+        return any(self.memory[Constants.ISR_ADDRESS:MEMORY_SIZE - Constants.STACK_LENGTH])
+
+    def step(self):
+        # execute one word, taking a pending interrupt first. False once halted
+        if self.halted:
+            return False
+
+        if self.interrupt_pending():
+            if not self.has_isr():
+                self.halted = True
+                return False
+            self.pc = Constants.ISR_ADDRESS
+
+        pc = self.dispatch[self.memory[self.pc]](self.pc + 1)
+        self.cycles += 1
+
+        if pc & HALTED:
+            self.halted = True
+        self.pc = pc & ADDRESS_MASK
+
+        return not self.halted
+
+    def run(self, max_cycles=None, interrupts=None):
+        '''
+        Execute until HALT or `max_cycles` more cycles, returns whether it halted.
+
+        `interrupts` maps cycles (counted from the first run) to interrupt lines set at their start.
+        '''
+
+        interrupts = dict(interrupts or {})
+        end = self.cycles + max_cycles if max_cycles is not None else None
+
+        while not self.halted and (end is None or self.cycles < end):
+            for cycle in [c for c in interrupts if c <= self.cycles]:
+                self.interrupt(interrupts.pop(cycle))
+
+            if self.interrupt_pending():
+                self.step()
+                continue
+
+            stops = [c for c in (end, *interrupts) if c is not None]
+            self.execute(min(stops) - self.cycles if stops else 1 << 62)
+
+        return self.halted
+
+    def execute(self, budget):
+        # run up to `budget` cycles, stopping early at HALT and words that may need interrupts checked
+        memory = self.memory
+        dispatch = self.dispatch
+
+        pc = self.pc
+        executed = budget
+        for i in range(budget):
+            pc = dispatch[memory[pc]](pc + 1)
+            if pc > ADDRESS_MASK:
+                executed = i + 1
+                break
+
+        self.cycles += executed
+        if pc & HALTED:
+            self.halted = True
+        self.pc = pc & ADDRESS_MASK
+
+    def state(self):
+        r = self.registers
+        state = {name: r[slot] for slot, name in enumerate(REGISTERS)}
+        state |= {
+            'PC': self.pc,
+            'flags': r[FLAGS],
+            'result': r[RESULT],
+            'status': r[STATUS],
+            'lock': r[LOCK],
+            'cycles': self.cycles,
+            'halted': self.halted,
+            'outputs': self.outputs,
+        }
+        return state
+
+BLOCK_MAX_LENGTH = 256
+
+class BlockMachine(Machine):
+    '''
+    Machine running basic blocks compiled into Python functions.
+
+    A block starts wherever execution reaches and ends after a JUMP, HALT, STORE, a word that may
+    make an interrupt deliverable, or BLOCK_MAX_LENGTH words. Every word of a block runs whenever it
+    runs, so it is compiled once with register contents followed through it: immediate loads,
+    copies and ALU operations on known values are folded into constants, and registers are only
+    written back at its end. A STORE into a compiled block drops it, to be compiled again when
+    reached. Interrupts are checked between blocks, and word by word when one is scheduled inside.
+
+    Running a block still costs a lookup and a call, and loops are short blocks, so this is around 5
+    to 6 times faster than Machine rather than the 10 to 50 times aimed for, see docs/anukoron.md.
+    '''
+
+    def __init__(self, memory, output=None):
+        self.blocks = {}                        # start address -> (function, length)
+        self.code = bytearray(MEMORY_SIZE)      # 1 where a compiled block may cover the address
+        super().__init__(memory, output)
+
+    def handler(self, word):
+        # stores executed word by word have to drop compiled blocks as well
+        h = super().handler(word)
+        if decoded_words[word] is None or decoded_words[word][0] != 'STORE':
+            return h
+
+        r = self.registers
+        code = self.code
+        invalidate = self.invalidate
+        def store(pc):
+            h(pc)
+            address = (r[MARH] << 10) | r[MARL]
+            if code[address]:
+                invalidate(address)
+            return pc
+
+        return store
+
+    def invalidate(self, address):
+        for start in range(max(0, address - BLOCK_MAX_LENGTH + 1), address + 1):
+            block = self.blocks.get(start)
+            if block is not None and start + block[1] > address:
+                del self.blocks[start]
+
+    def execute(self, budget):
+        blocks = self.blocks
+        compile_block = self.compile_block
+
+        pc = self.pc
+        left = budget
+        while True:
+            function, length = blocks.get(pc) or compile_block(pc)
+            if length > left:
+                break
+
+            left -= length
+            pc = function()
+            if pc > ADDRESS_MASK:
+                break
+
+        self.cycles += budget - left
+        if pc & HALTED:
+            self.halted = True
+        self.pc = pc & ADDRESS_MASK
+
+        # the rest of the budget ends inside a block
+        if length > left and left and not self.halted:
+            super().execute(left)
+
+    def compile_block(self, start):
+        lines = []
+        values = {ZERO: 0}  # slot -> int, local variable, or (total, result) of an addition
+        written = set()
+        names = itertools.count()
+
+        def local(expression):
+            name = f'v{next(names)}'
+            lines.append(f'{name} = {expression}')
+            return name
+
+        def read(slot):
+            if slot not in values:
+                values[slot] = local(f'r[{slot}]')
+            values[slot] = value(values[slot])
+            return values[slot]
+
+        def value(v):
+            # zero, negative and carry flags of an addition are only computed when needed
+            if isinstance(v, tuple):
+                total, result = v
+                carry = f'(({total} >> 10) << 2) | ' if total is not None else ''
+                return local(f'{carry}(({result} >> 9) << 1) | ({result} == 0)')
+            return v
+
+        def write(slot, v):
+            values[slot] = v
+            written.add(slot)
+
+        def address():
+            high, low = read(MARH), read(MARL)
+            if isinstance(high, int) and isinstance(low, int):
+                return (high << 10) | low
+            return f'({high} << 10) | {low}'
+
+        def operand(v, zero, complement):
+            if zero:
+                return 0x3FF if complement else 0
+            if isinstance(v, int):
+                return v ^ 0x3FF if complement else v
+            return f'({v} ^ 1023)' if complement else v
+
+        def evaluate(flags, a, b):
+            # (result, status) of ALUEVAL with known flags
+            a = operand(a, flags & ALU_AZ, flags & ALU_AC)
+            b = operand(b, flags & ALU_BZ, flags & ALU_BC)
+            output_complement = 0x3FF if flags & ALU_OC else 0
+
+            if isinstance(a, int) and isinstance(b, int):
+                # operands already zeroed and complemented
+                return alu_operations[flags & (ALU_CIN | ALU_N | ALU_OC)](a, b)
+
+            if flags & ALU_N:
+                result = local(f'({a} & {b}) ^ {0x3FF ^ output_complement}')
+                return result, (None, result)
+
+            total = local(f'{a} + {b} + {1 if flags & ALU_CIN else 0}')
+            result = local(f'({total} & 1023) ^ {output_complement}')
+            return result, (total, result)
+
+        def condition(mode):
+            status = values.get(STATUS)
+            if isinstance(status, tuple):
+                total, result = status
+                match mode:
+                    case 1: return f'{result} == 0'
+                    case 2: return f'{result} >> 9'
+                    case 3: return f'{total} >> 10' if total is not None else 0
+            if isinstance(status, int):
+                return status & (STATUS_ZERO, STATUS_NEGATIVE, STATUS_CARRY)[mode - 1]
+            return f'{read(STATUS)} & {(STATUS_ZERO, STATUS_NEGATIVE, STATUS_CARRY)[mode - 1]}'
+
+        memory = self.memory
+        pc = start
+        end = None
+
+        while end is None:
+            word = memory[pc]
+            pc += 1
+            decoded = decoded_words[word]
+            name, operands = decoded if decoded is not None else ('NOOP', ())
+
+            match name:
+                case 'COPY':
+                    write(operands[1], read(SOURCE_SLOTS[operands[0]]))
+                    if operands[1] == IMR:
+                        end = pc | EVENT
+                case 'LOADIU' | 'LOADIL':
+                    destination, data = operands
+                    following = decoded_words[memory[pc]] if pc < MEMORY_SIZE else None
+                    if name == 'LOADIU' and following is not None and following[0] == 'LOADIL' and following[1][0] == destination and pc - start < BLOCK_MAX_LENGTH - 1:
+                        # both halves, as loaded by LOADI
+                        write(destination, (data << 5) | following[1][1])
+                        pc += 1
+                    else:
+                        v = read(destination)
+                        keep, data = (0x1F, data << 5) if name == 'LOADIU' else (0x3E0, data)
+                        write(destination, (v & keep) | data if isinstance(v, int) else local(f'({v} & {keep}) | {data}'))
+                case 'ALUFSET':
+                    write(FLAGS, operands[0])
+                case 'ALUFSETR':
+                    v = read(SOURCE_SLOTS[operands[0]])
+                    write(FLAGS, v & 0x7F if isinstance(v, int) else local(f'{v} & 127'))
+                case 'ALUEVAL':
+                    flags = read(FLAGS)
+                    a, b = read(A), read(SOURCE_SLOTS[operands[0]])
+                    if isinstance(flags, int):
+                        result, status = evaluate(flags, a, b)
+                    else:
+                        evaluated = local(f'alu[{flags}]({a}, {b})')
+                        result, status = local(f'{evaluated}[0]'), local(f'{evaluated}[1]')
+
+                    write(RESULT, result)
+                    write(STATUS, status)
+                case 'ALUSTOREF':
+                    write(operands[0], read(STATUS))
+                    if operands[0] == IMR:
+                        end = pc | EVENT
+                case 'ALUSTORER':
+                    write(operands[0], read(RESULT))
+                    if operands[0] == IMR:
+                        end = pc | EVENT
+                case 'AOP':
+                    if operands[0] in (1, 2):
+                        v = read(A)
+                        if operands[0] == 1:
+                            write(A, v >> 1 if isinstance(v, int) else local(f'{v} >> 1'))
+                        else:
+                            write(A, (v << 1) & 0x3FF if isinstance(v, int) else local(f'({v} << 1) & 1023'))
+                case 'STORE':
+                    target = local(address())
+                    lines.append(f'memory[{target}] = {read(SOURCE_SLOTS[operands[0]])}')
+                    lines.append(f'if code[{target}]: invalidate({target})')
+                    end = pc
+                case 'LOAD':
+                    write(operands[0], local(f'memory[{address()}]'))
+                    if operands[0] == IMR:
+                        end = pc | EVENT
+                case 'JUMP':
+                    target = address()
+                    taken = 1 if operands[0] == 0 else condition(operands[0])
+                    if isinstance(taken, int):
+                        end = target if taken else pc
+                    else:
+                        end = local(f'{target} if {taken} else {pc}')
+                case 'OUT':
+                    lines.append(f'output({read(SOURCE_SLOTS[operands[0]])})')
+                case 'LOADISR':
+                    write(ISR, operands[0])
+                    end = pc | EVENT
+                case 'ILOCKSET':
+                    write(LOCK, operands[0])
+                    end = pc | EVENT
+                case 'HALT':
+                    end = (pc - 1) | HALTED
+
+            if end is None and (pc - start >= BLOCK_MAX_LENGTH or pc == MEMORY_SIZE):
+                end = pc
+
+        for slot in sorted(written):
+            lines.append(f'r[{slot}] = {value(values[slot])}')
+        lines.append(f'return {end}')
+
+        source = '\n    '.join(['def block(r=r, memory=memory, output=output, alu=alu, code=code, invalidate=invalidate):', *lines])
+        namespace = {'r': self.registers, 'memory': memory, 'output': self.output, 'alu': alu_operations,
+                     'code': self.code, 'invalidate': self.invalidate}
+        exec(source, namespace)
+
+        self.code[start:pc] = b'\x01' * (pc - start)
+        block = self.blocks[start] = (namespace['block'], pc - start)
+        return block
+
+# display
+
+DISPLAY_WIDTH = 64
+DISPLAY_HEIGHT = 32
+
+class Display:
+    '''
+    The 64x32 display on the output bus, see docs/display.md. Pass it as the output of a Machine.
+
+    Columns are 32 bits, row bank b being bits 8b to 8b + 7 with the top row of a bank in its highest
+    bit, so bank 3 is the top of the display and row 0 is bit 31. Row data is written into the
+    selected bank of the selected column right away, and load buffer shows all columns as a new
+    frame. Commands are told apart by their upper 2 bits, words starting with 00 are ignored.
+    '''
+
+    def __init__(self):
+        self.column = 0
+        self.bank = 0
+        self.columns = [0] * DISPLAY_WIDTH
+        self.frames = []    # columns shown by every load buffer
+
+    def __call__(self, word):
+        match word >> 8:
+            case 0b01:
+                # select row and column   01<row bank:2><column index:6>
+                self.bank = (word >> 6) & 3
+                self.column = word & 0x3F
+            case 0b10:
+                # row data                10<data:8>
+                shift = self.bank * 8
+                self.columns[self.column] = (self.columns[self.column] & ~(0xFF << shift)) | ((word & 0xFF) << shift)
+            case 0b11:
+                # load buffer             1100000000
+                self.frames.append(tuple(self.columns))
+
+    def frame(self, n=-1):
+        # columns of a frame, blank before the first load buffer
+        return self.frames[n] if self.frames else (0,) * DISPLAY_WIDTH
+
+def frame_text(columns):
+    # rows of '#' for pixels on and '.' for off, like the images read by shilpi
+    return ''.join(''.join('#' if (c >> (31 - row)) & 1 else '.' for c in columns) + '\n' for row in range(DISPLAY_HEIGHT))
+
+def frame_pbm(columns):
+    # plain PBM (P1), 1 is black
+    return f'P1\n{DISPLAY_WIDTH} {DISPLAY_HEIGHT}\n' + frame_text(columns).replace('#', '1').replace('.', '0')
+
+def write_frame(columns, file):
+    Path(file).write_text(frame_pbm(columns) if Path(file).suffix.lower() == '.pbm' else frame_text(columns))
+
+# profiling
+
+def read_debug_map(file):
+    # debug map written by rochoyita -g
+    try:
+        with open(file, 'r') as map_file:
+            entry = json.load(map_file)
+    except OSError:
+        error_raw(f'debug map "{file}" not found!')
+    except json.JSONDecodeError as e:
+        error_raw(f'invalid debug map "{file}"', str(e))
+
+    if not isinstance(entry, dict) or entry.get('format') != rochoyita.DEBUG_MAP_FORMAT:
+        error_raw(f'"{file}" is not a rochoyita debug map')
+
+    return entry
+
+class Profiler(Machine):
+    '''
+    Machine counting the cycles spent at every address, interpreting word by word.
+
+    With a debug map (see rochoyita.debug_map) cycles are added up per source line as well, and
+    folded stacks are kept from CALL/RETURN nesting: a jump out of the words of a CALL statement
+    enters a frame, one out of a RETURN statement leaves it. An interrupt starts over with no frames,
+    as an ISR does not return. Frames are named after the label before the address, the root after
+    the section, main or ISR.
+    '''
+
+    def __init__(self, memory, debug_map=None, output=None):
+        super().__init__(memory, output)
+        self.debug_map = debug_map
+        self.frames = ()    # addresses of the CALL jumps entered
+        self.counts = collections.defaultdict(collections.Counter)    # frames -> address -> cycles
+
+        self.statements = {}    # address -> (file, line, statement)
+        self.transfers = {}     # address -> (first, last + 1 address of the statement, CALL or RETURN)
+        self.labels = []        # (address, label) sorted
+
+        if debug_map is not None:
+            files = debug_map['files']
+            for start, words, file, line_number, statement in debug_map['ranges']:
+                for address in range(start, start + words):
+                    self.statements[address] = (files[file], line_number, statement)
+
+                instruction = statement.split()[0] if statement else None
+                if instruction in ('CALL', 'RETURN'):
+                    for address in range(start, start + words):
+                        self.transfers[address] = (start, start + words, instruction == 'CALL')
+
+            self.labels = sorted((address, label) for label, address in debug_map['labels'].items())
+
+    def step(self):
+        if self.halted:
+            return False
+
+        if self.interrupt_pending():
+            if not self.has_isr():
+                self.halted = True
+                return False
+            self.pc = Constants.ISR_ADDRESS
+            self.frames = ()
+
+        self.execute(1)
+        return not self.halted
+
+    def execute(self, budget):
+        memory = self.memory
+        dispatch = self.dispatch
+        transfers = self.transfers
+        counts = self.counts[self.frames]
+
+        pc = self.pc
+        executed = budget
+        for i in range(budget):
+            address = pc
+            counts[address] += 1
+            pc = dispatch[memory[pc]](pc + 1)
+
+            if pc != address + 1 and address in transfers:
+                first, end, call = transfers[address]
+                if not first <= pc & ADDRESS_MASK < end:
+                    if call:
+                        self.frames += (address,)
+                    elif self.frames:
+                        self.frames = self.frames[:-1]
+                    counts = self.counts[self.frames]
+
+            if pc > ADDRESS_MASK:
+                executed = i + 1
+                break
+
+        self.cycles += executed
+        if pc & HALTED:
+            self.halted = True
+        self.pc = pc & ADDRESS_MASK
+
+    def address_cycles(self):
+        total = collections.Counter()
+        for counts in self.counts.values():
+            total.update(counts)
+        return total
+
+    def line_cycles(self):
+        # [(cycles, file, line, statement, addresses)] most cycles first, addresses outside the map by themselves
+        lines = {}
+        for address, cycles in self.address_cycles().items():
+            key = self.statements.get(address, (None, address, None))
+            entry = lines.setdefault(key, [0, set()])
+            entry[0] += cycles
+            entry[1].add(address)
+
+        return sorted(((cycles, *key, sorted(addresses)) for key, (cycles, addresses) in lines.items()),
+                      key=lambda l: (-l[0], l[4][0]))
+
+    def state(self):
+        state = super().state()
+        state['profile'] = [{'cycles': cycles, 'file': file, 'line': line_number, 'statement': statement, 'addresses': addresses}
+                            for cycles, file, line_number, statement, addresses in self.line_cycles()]
+        return state
+
+    def label(self, address):
+        # label at or before the address in its section
+        i = bisect.bisect_left(self.labels, (address + 1,)) - 1
+        if i < 0 or (self.labels[i][0] >= Constants.ISR_ADDRESS) != (address >= Constants.ISR_ADDRESS):
+            return None
+        return self.labels[i][1]
+
+    def folded(self):
+        # 'root;frame;...;label' -> cycles, as read by flamegraph.pl and speedscope
+        stacks = collections.Counter()
+        for frames, counts in self.counts.items():
+            for address, cycles in counts.items():
+                root = frames[0] if frames else address
+                names = ['ISR' if root >= Constants.ISR_ADDRESS else 'main']
+                names += [n for n in map(self.label, (*frames, address)) if n is not None]
+                stacks[';'.join(names)] += cycles
+        return stacks
+
+def write_folded(stacks, file):
+    Path(file).write_text(''.join(f'{stack} {cycles}\n' for stack, cycles in sorted(stacks.items())))
+
+# batch simulation
+
+PAGE_BITS = 6
+PAGE_SIZE = 1 << PAGE_BITS
+
+@functools.cache
+def decode_tables():
+    # word -> instruction index, source slot, destination slot and data operand, as arrays
+    names = list(rochoyita.instructions)
+    kind, source, destination, data = (np.zeros(1024, dtype=np.uint16) for _ in range(4))
+
+    for word in range(1024):
+        name, operands = decoded_words[word] or ('NOOP', ())
+        kind[word] = names.index(name)
+
+        for operand, value in zip(rochoyita.instructions[name].operands, operands):
+            match operand.type:
+                case rochoyita.OperandType.SOURCE:
+                    source[word] = SOURCE_SLOTS[value]
+                case rochoyita.OperandType.DESTINATION:
+                    destination[word] = value
+                case rochoyita.OperandType.DATA:
+                    data[word] = value
+
+    return names, kind, source, destination, data
+
+def alu_vector(flags, a, b):
+    # rochoyita.alu over arrays -> (result, status)
+    flags, a, b = (x.astype(np.int32) for x in (flags, a, b))
+    a = np.where(flags & ALU_AZ, 0, a) ^ np.where(flags & ALU_AC, 0x3FF, 0)
+    b = np.where(flags & ALU_BZ, 0, b) ^ np.where(flags & ALU_BC, 0x3FF, 0)
+
+    nand = flags & ALU_N
+    total = a + b + ((flags & ALU_CIN) != 0)
+    result = np.where(nand, (a & b) ^ 0x3FF, total & 0x3FF) ^ np.where(flags & ALU_OC, 0x3FF, 0)
+    carry = np.where(nand, 0, total >> 10)
+
+    return result, (carry << 2) | ((result >> 9) << 1) | (result == 0)
+
+class BatchMachine:
+    '''
+    Many Sutra-1 CPUs running the same memory image in lockstep, as NumPy arrays. Needs NumPy.
+
+    Every step executes one word on each instance that has not halted, grouped by instruction so
+    that instances at different addresses are handled together as well. The image is shared and
+    never written: a STORE copies the 64 word page it hits for every instance, and later reads of
+    that page go to the copies.
+
+    `registers` maps register names to an initial value or one per instance. `interrupts` is a list
+    of {cycle: lines} per instance, like Machine.run.
+    '''
+
+    def __init__(self, memory, count, registers=None, interrupts=None):
+        if np is None:
+            error_raw('batch simulation needs NumPy, install it with "pip install numpy"')
+
+        self.count = count
+        self.image = np.array(memory, dtype=np.uint16)
+        self.pages = {}     # page -> words of every instance, (count, PAGE_SIZE)
+
+        self.registers = np.zeros((LOCK + 1, count), dtype=np.uint16)
+        for name, value in (registers or {}).items():
+            self.registers[REGISTERS.index(name)] = value
+
+        self.pc = np.zeros(count, dtype=np.uint32)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.halted = np.zeros(count, dtype=bool)
+        self.has_isr = bool(self.image[Constants.ISR_ADDRESS:MEMORY_SIZE - Constants.STACK_LENGTH].any())
+        self.out = []       # (instances, words) of every OUT
+
+        # n-th interrupt of every instance, -1 where there is none
+        interrupts = [sorted(i.items()) for i in interrupts or []]
+        self.interrupts = []
+        for n in range(max(map(len, interrupts), default=0)):
+            cycles = np.full(count, -1, dtype=np.int64)
+            lines = np.zeros(count, dtype=np.uint16)
+            for instance, schedule in enumerate(interrupts):
+                if n < len(schedule):
+                    cycles[instance], lines[instance] = schedule[n]
+            self.interrupts.append((cycles, lines & INTERRUPT_LINES))
+
+    def read(self, instances, addresses):
+        words = self.image[addresses]
+        pages = addresses >> PAGE_BITS
+        for page, copies in self.pages.items():
+            hit = pages == page
+            if hit.any():
+                words[hit] = copies[instances[hit], addresses[hit] & (PAGE_SIZE - 1)]
+        return words
+
+    def write(self, instances, addresses, words):
+        pages = addresses >> PAGE_BITS
+        for page in np.unique(pages):
+            if page not in self.pages:
+                self.pages[page] = np.tile(self.image[page << PAGE_BITS:(page + 1) << PAGE_BITS], (self.count, 1))
+            hit = pages == page
+            self.pages[page][instances[hit], addresses[hit] & (PAGE_SIZE - 1)] = words[hit]
+
+    def address(self, instances):
+        r = self.registers
+        return (r[MARH, instances].astype(np.uint32) << 10) | r[MARL, instances]
+
+    def step(self):
+        # one cycle of every instance that has not halted, False once all have
+        r = self.registers
+        running = ~self.halted
+
+        for cycles, lines in self.interrupts:
+            r[ISR, running & (cycles == self.cycles)] |= lines[running & (cycles == self.cycles)]
+
+        pending = running & ((r[ISR] & ~r[IMR] & INTERRUPT_LINES) != 0) & (r[LOCK] == 0)
+        if pending.any():
+            if self.has_isr:
+                self.pc[pending] = Constants.ISR_ADDRESS
+            else:
+                self.halted[pending] = True
+                running &= ~pending
+
+        instances = np.flatnonzero(running)
+        if instances.size == 0:
+            return False
+
+        pc = self.pc[instances]
+        words = self.read(instances, pc)
+        self.pc[instances] = (pc + 1) & ADDRESS_MASK
+        self.cycles[instances] += 1
+
+        names, kind, source, destination, data = decode_tables()
+        kinds = kind[words]
+        present = np.flatnonzero(np.bincount(kinds, minlength=len(names)))
+
+        for k in present:
+            if len(present) == 1:
+                group, group_words = instances, words
+            else:
+                hit = kinds == k
+                group, group_words = instances[hit], words[hit]
+
+            self.execute(names[k], group, source[group_words], destination[group_words], data[group_words])
+
+        return True
+
+    def execute(self, name, instances, source, destination, data):
+        r = self.registers
+
+        match name:
+            case 'COPY':
+                r[destination, instances] = r[source, instances]
+            case 'LOADIU':
+                r[destination, instances] = (data << 5) | (r[destination, instances] & 0x1F)
+            case 'LOADIL':
+                r[destination, instances] = (r[destination, instances] & 0x3E0) | data
+            case 'ALUFSET':
+                r[FLAGS, instances] = data
+            case 'ALUFSETR':
+                r[FLAGS, instances] = r[source, instances] & 0x7F
+            case 'ALUEVAL':
+                r[RESULT, instances], r[STATUS, instances] = alu_vector(r[FLAGS, instances], r[A, instances], r[source, instances])
+            case 'ALUSTOREF':
+                r[destination, instances] = r[STATUS, instances]
+            case 'ALUSTORER':
+                r[destination, instances] = r[RESULT, instances]
+            case 'AOP':
+                a = r[A, instances]
+                r[A, instances] = np.where(data == 1, a >> 1, np.where(data == 2, (a << 1) & 0x3FF, a))
+            case 'STORE':
+                self.write(instances, self.address(instances), r[source, instances])
+            case 'LOAD':
+                r[destination, instances] = self.read(instances, self.address(instances))
+            case 'JUMP':
+                status = r[STATUS, instances]
+                taken = (data == 0) | ((data == 1) & (status & STATUS_ZERO != 0)) | ((data == 2) & (status & STATUS_NEGATIVE != 0)) | ((data == 3) & (status & STATUS_CARRY != 0))
+                self.pc[instances[taken]] = self.address(instances[taken])
+            case 'OUT':
+                self.out.append((instances, r[source, instances]))
+            case 'LOADISR':
+                r[ISR, instances] = data
+            case 'ILOCKSET':
+                r[LOCK, instances] = data
+            case 'HALT':
+                self.halted[instances] = True
+                self.pc[instances] = (self.pc[instances] - 1) & ADDRESS_MASK
+
+    def run(self, max_cycles=None):
+        # step until every instance halted or max_cycles, returns whether all halted
+        steps = itertools.count() if max_cycles is None else range(max_cycles)
+        for _ in steps:
+            if not self.step():
+                break
+
+        return bool(self.halted.all())
+
+    def outputs(self):
+        # words output by every instance
+        outputs = [[] for _ in range(self.count)]
+        for instances, words in self.out:
+            for instance, word in zip(instances.tolist(), words.tolist()):
+                outputs[instance].append(word)
+        return outputs
+
+    def states(self):
+        # Machine.state() of every instance
+        r = self.registers.tolist()
+        pc, cycles, halted = self.pc.tolist(), self.cycles.tolist(), self.halted.tolist()
+
+        return [{name: r[slot][i] for slot, name in enumerate(REGISTERS)} | {
+            'PC': pc[i],
+            'flags': r[FLAGS][i],
+            'result': r[RESULT][i],
+            'status': r[STATUS][i],
+            'lock': r[LOCK][i],
+            'cycles': cycles[i],
+            'halted': halted[i],
+            'outputs': outputs,
+        } for i, outputs in enumerate(self.outputs())]
+
+engines = {
+    'blocks': BlockMachine,
+    'interpreter': Machine,
+}
+
+def simulate(file, max_cycles=None, interrupts=None, engine='blocks', **kwargs):
+    # run a hex or assembly source file until HALT or max_cycles, -> Machine
+    machine = engines[engine](load(file, **kwargs))
+    machine.run(max_cycles, interrupts)
+    return machine
+
+def print_state(machine, seconds=None):
+    state = machine.state()
+
+    print('\033[36m')
+    print('======Registers======')
+    for name in REGISTERS:
+        print(name.ljust(10), format(state[name], 'X').zfill(3), format(state[name], 'b').zfill(10), state[name], sep='\t')
+    print('PC'.ljust(10), format(state['PC'], 'X').zfill(5), sep='\t')
+    print('=====================')
+    print('HALTED' if machine.halted else 'STOPPED', f'after {machine.cycles} cycles', sep='\t')
+    if seconds:
+        print(f'{seconds:.3f} s, {machine.cycles / seconds / 1e6:.2f} million cycles per second')
+    if machine.outputs:
+        print('=======Outputs=======')
+        print(' '.join(format(w, 'X').zfill(3) for w in machine.outputs))
+    print('\033[0m')
+
+def print_profile(profiler, top):
+    lines = profiler.line_cycles()
+    total = profiler.cycles or 1
+
+    print('\033[36m')
+    print('=======Profile=======')
+    print('CYCLES'.rjust(10), '%'.rjust(6), 'ADDRESS'.ljust(7), 'SOURCE'.ljust(20), 'STATEMENT', sep='\t')
+    for cycles, file, line_number, statement, addresses in lines[:top]:
+        source = f'{Path(file).name}:{line_number}' if file is not None else ''
+        print(str(cycles).rjust(10), f'{cycles / total * 100:6.2f}', format(addresses[0], 'X').zfill(5), source.ljust(20), statement or '', sep='\t')
+    if len(lines) > top:
+        print(f'{len(lines) - top} more lines, {sum(l[0] for l in lines[top:])} cycles')
+    print('\033[0m')
+
+def print_batch_state(machine, seconds):
+    cycles = sorted(machine.cycles.tolist())
+
+    print('\033[36m')
+    print('========Batch========')
+    print('INSTANCES'.ljust(10), machine.count, sep='\t')
+    print('HALTED'.ljust(10), int(machine.halted.sum()), sep='\t')
+    print('CYCLES'.ljust(10), f'{cycles[0]} min', f'{cycles[len(cycles) // 2]} median', f'{cycles[-1]} max', sep='\t')
+    print('=====================')
+    print(f'{seconds:.3f} s, {sum(cycles) / seconds / 1e6:.2f} million cycles per second over all instances')
+    print('\033[0m')
+
+def read_vectors(file):
+    # [{register: value, 'interrupts': {cycle: lines}}] -> (registers, interrupts) for BatchMachine
+    try:
+        with open(file, 'r') as vectors_file:
+            vectors = json.load(vectors_file)
+    except OSError:
+        error_raw(f'vectors file "{file}" not found!')
+    except json.JSONDecodeError as e:
+        error_raw(f'invalid vectors file "{file}"', str(e))
+
+    if not isinstance(vectors, list) or not vectors:
+        error_raw(f'vectors file "{file}" must be a non empty list')
+
+    registers = {}
+    interrupts = []
+    for i, vector in enumerate(vectors):
+        for name, value in vector.items():
+            if name == 'interrupts':
+                continue
+            if name not in REGISTERS or not isinstance(value, int):
+                error_raw(f'invalid register value "{name}" in vector #{i}')
+            registers.setdefault(name, [0] * len(vectors))[i] = value & 0x3FF
+
+        interrupts.append({int(cycle): int(lines, 2) if isinstance(lines, str) else lines
+                           for cycle, lines in vector.get('interrupts', {}).items()})
+
+    return registers, interrupts
+
+def parse_register_value(text, parser):
+    name, _, value = text.partition('=')
+    if name.upper() not in REGISTERS or not value:
+        parser.error(f'invalid register value "{text}"')
+    try:
+        return name.upper(), int(value, 0)
+    except ValueError:
+        parser.error(f'invalid register value "{text}"')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='anukoron',
+        description='Instruction set simulator for the Sutra-1 System',
+        epilog='Copyright (C) 2025 Debayan "rnayabed" Sutradhar',
+    )
+
+    input_group = parser.add_mutually_exclusive_group()
+    input_group.add_argument('-v', '--version', action='store_true', help='Version and copyright information')
+    input_group.add_argument('input', nargs='?', help='Memory image output by rochoyita, or assembly source file to assemble first')
+    parser.add_argument('-D', '--define', action='append', default=[], metavar='MACRO[=VALUE]', help='Define a macro when assembling the input')
+    parser.add_argument('-I', '--include', action='append', default=[], metavar='DIR', help='Add directory to #include search path when assembling the input')
+    parser.add_argument('-m', '--max-cycles', type=int, default=10_000_000, metavar='N', help='Stop after N cycles if the program has not halted (default: %(default)s)')
+    parser.add_argument('-i', '--interrupt', action='append', default=[], metavar='CYCLE:LINES', help='Set interrupt lines (binary, I3 to I0) at the start of a cycle')
+    parser.add_argument('--vectors', metavar='FILE', help='Run one instance per input vector in FILE in lockstep (needs NumPy)')
+    parser.add_argument('--display', metavar='FILE', help='Write the last frame of the display as text, or PBM if FILE ends with .pbm')
+    parser.add_argument('--frames', metavar='DIR', help='Write every frame of the display to DIR as PBM')
+    parser.add_argument('--engine', choices=list(engines), default='blocks', help='Run compiled basic blocks (default), or interpret word by word')
+    parser.add_argument('--profile', action='store_true', help='Interpret word by word, counting cycles per address and source line, and print the hot spots')
+    parser.add_argument('--top', type=int, default=20, metavar='N', help='Source lines printed by --profile (default: %(default)s)')
+    parser.add_argument('--folded', metavar='FILE', help='Write folded stacks of --profile for flame graphs to FILE')
+    parser.add_argument('--debug-map', metavar='FILE', help='Debug map output by rochoyita -g for a memory image input of --profile')
+    parser.add_argument('-e', '--expect', action='append', default=[], metavar='REGISTER=VALUE', help='Exit with status 1 unless the register holds VALUE at the end')
+    parser.add_argument('--json', metavar='FILE', help='Write the final state as JSON to FILE, - for standard output')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print the final state')
+    args = parser.parse_args(argv)
+
+    if args.version:
+        print(f'''anukoron version {VERSION}
+Copyright (C) 2025 Debayan Sutradhar
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>. ''')
+        exit()
+
+    if not args.input:
+        parser.error('no input file')
+
+    interrupts = {}
+    for i in args.interrupt:
+        cycle, _, lines = i.partition(':')
+        try:
+            interrupts[int(cycle)] = interrupts.get(int(cycle), 0) | int(lines, 2)
+        except ValueError:
+            parser.error(f'invalid interrupt "{i}"')
+
+    expected = [parse_register_value(e, parser) for e in args.expect]
+
+    if args.folded or args.debug_map:
+        args.profile = True
+
+    if args.profile and args.vectors:
+        parser.error('--profile can not be used with --vectors')
+
+    defines = {}
+    for d in args.define:
+        name, _, value = d.partition('=')
+        defines[name] = value if value else '1'
+
+    try:
+        if args.profile:
+            memory, debug_map = load_debug(args.input, defines, args.include)
+            if args.debug_map:
+                debug_map = read_debug_map(args.debug_map)
+        else:
+            memory = load(args.input, defines, args.include)
+
+        if args.vectors:
+            if interrupts:
+                parser.error('-i can not be used with --vectors, set interrupts per vector instead')
+
+            if args.display or args.frames:
+                parser.error('--display and --frames can not be used with --vectors')
+
+            registers, vector_interrupts = read_vectors(args.vectors)
+            machine = BatchMachine(memory, len(vector_interrupts), registers, vector_interrupts)
+        else:
+            display = Display() if args.display or args.frames else None
+            machine = Profiler(memory, debug_map, display) if args.profile else engines[args.engine](memory, display)
+    except (AssemblerError, SimulatorError) as e:
+        print_error(*e.text)
+
+    start = time.perf_counter()
+    if args.vectors:
+        machine.run(args.max_cycles)
+    else:
+        machine.run(args.max_cycles, interrupts)
+    seconds = time.perf_counter() - start
+
+    states = machine.states() if args.vectors else [machine.state()]
+
+    if not args.quiet:
+        if args.vectors:
+            print_batch_state(machine, seconds)
+        else:
+            print_state(machine, seconds)
+            if display is not None:
+                print(f'\033[36m{len(display.frames)} display frames\033[0m')
+            if args.profile:
+                print_profile(machine, args.top)
+
+    if args.folded:
+        write_folded(machine.folded(), args.folded)
+
+    if not args.vectors and display is not None:
+        if args.display:
+            write_frame(display.frame(), args.display)
+
+        if args.frames:
+            Path(args.frames).mkdir(parents=True, exist_ok=True)
+            for n, columns in enumerate(display.frames):
+                write_frame(columns, Path(args.frames) / f'{n:04}.pbm')
+
+    if args.json:
+        text = json.dumps(states if args.vectors else states[0], indent=4)
+        if args.json == '-':
+            print(text)
+        else:
+            Path(args.json).write_text(text + '\n')
+
+    failed = [f'{f'instance #{i}: ' if args.vectors else ''}{name} is {state[name]}, expected {value}'
+              for i, state in enumerate(states) for name, value in expected if state[name] != value]
+    if failed:
+        print_error(*failed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/bin/python
+# bench - Benchmarks for rochoyita and shilpi
+# SPDX-License-Identifier: GPL-3.0-only
+
+'''
+Generates synthetic workloads of growing size, times the tools on each of them in a fresh process
+(best of a few runs, like a build would see) and saves the results as JSON to compare commits.
+Older versions of the tools, without the flags added since, are timed as they are.
+'''
+
+import argparse, json, os, platform, random, re, statistics, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+VERSION = 1.0
+
+# workloads
+
+REGISTERS = 'ABCD'
+
+def native_line(rng):
+    r = rng.choice(REGISTERS)
+    match rng.randrange(6):
+        case 0: return f'LOADIU {r} {rng.randrange(32):05b}'
+        case 1: return f'LOADIL {r} {rng.randrange(32):05b}'
+        case 2: return f'COPY {r} {rng.choice(REGISTERS)}'
+        case 3: return f'ALUEVAL {r}'
+        case 4: return f'ALUSTORER {r}'
+        case 5: return f'OUT {r}'
+
+def native(directory, n, rng):
+    # n native instructions
+    return write(directory, 'native.S', [native_line(rng) for _ in range(n)] + ['HALT'])
+
+def defines(directory, n, rng):
+    # n chained #defines, each expanding to the previous one, used by as many lines
+    lines = ['#define M0 1']
+    lines += [f'#define M{i} M{i - 1}' for i in range(1, n)]
+    lines += [f'LOADI {rng.choice(REGISTERS)} M{rng.randrange(n)}' for _ in range(n)]
+    return write(directory, 'defines.S', lines + ['HALT'])
+
+def includes(directory, n, rng):
+    # chain of n files, each including the next one
+    for i in range(n):
+        lines = [native_line(rng) for _ in range(10)]
+        if i + 1 < n:
+            lines.append(f'#include "include-{i + 1}.S"')
+        write(directory, f'include-{i}.S', lines)
+
+    return write(directory, 'includes.S', ['#include "include-0.S"', 'HALT'])
+
+def labels(directory, n, rng):
+    # n labels, every one jumped to and every tenth one called
+    lines = [f'J :l0']
+    routines = max(1, n // 10)
+
+    for i in range(n):
+        lines.append(f':l{i}')
+        lines.append(native_line(rng))
+        if i % 10 == 0:
+            lines.append(f'CALL :f{rng.randrange(routines)}')
+        lines.append(f'J :l{i + 1}' if i + 1 < n else 'HALT')
+
+    for i in range(routines):
+        lines += [f':f{i}', native_line(rng), 'RETURN']
+
+    return write(directory, 'labels.S', lines)
+
+def isr(directory, n, rng):
+    # n instructions in the program and up to 1024 in the ISR section, which can not hold much more
+    lines = [native_line(rng) for _ in range(n)] + ['HALT', ':ISR']
+    lines += [native_line(rng) for _ in range(min(n, 1024))] + ['HALT']
+    return write(directory, 'isr.S', lines)
+
+def display(directory, n, rng):
+    # 64x32 display image with n percent of the pixels lit
+    pixels = [i < 64 * 32 * n // 100 for i in range(64 * 32)]
+    rng.shuffle(pixels)
+    rows = [''.join('#' if p else '.' for p in pixels[r * 64:(r + 1) * 64]) for r in range(32)]
+    return write(directory, 'display.txt', rows)
+
+def write(directory, name, lines):
+    path = directory / name
+    path.write_text('\n'.join(lines) + '\n')
+    return path
+
+# name -> (generator, sizes, quick sizes, tools)
+workloads = {
+    'native':   (native,   [1000, 10000, 100000, 400000], [1000, 10000], ('rochoyita',)),
+    'defines':  (defines,  [100, 1000, 5000, 20000],      [100, 1000],   ('rochoyita',)),
+    'includes': (includes, [10, 50, 100, 200],            [10, 50],      ('rochoyita',)),
+    'labels':   (labels,   [100, 1000, 10000, 50000],     [100, 1000],   ('rochoyita',)),
+    'isr':      (isr,      [1000, 10000, 100000],         [1000, 10000], ('rochoyita',)),
+    'display':  (display,  [0, 25, 50, 75, 100],          [0, 100],      ('shilpi', 'rochoyita')),
+}
+
+# timing
+
+def run(command, repeat):
+    # seconds of every run of a command
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append(time.perf_counter() - start)
+
+        if result.returncode != 0:
+            raise RuntimeError(f'{' '.join(map(str, command))} failed\n{result.stderr}')
+
+    return times
+
+def options(tool):
+    # option strings a tool accepts, older versions lack the ones added since
+    result = subprocess.run([sys.executable, tool, '-h'], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'{tool} -h failed\n{result.stderr}')
+
+    return set(re.findall(r'(?<![\w-])--?[A-Za-z][\w-]*', result.stdout))
+
+def measure(workload, size, directory, repeat, tools_directory, rochoyita_args, stats):
+    generate, sizes, quick_sizes, tools = workloads[workload]
+    source = generate(directory, size, random.Random(size))
+    result = {'size': size}
+
+    for tool in tools:
+        if tool == 'shilpi':
+            assembly = directory / 'display-image.S'
+            times = run([sys.executable, tools_directory / 'shilpi.py', source, '-o', assembly], repeat)
+            source = assembly
+        else:
+            stats_file = directory / 'stats.json'
+            command = [sys.executable, tools_directory / 'rochoyita.py', source, '-o', directory / 'out.hex', *rochoyita_args]
+            times = run(command + ['--stats-json', stats_file] if stats else command, repeat)
+            if stats:
+                result['phases'] = json.loads(stats_file.read_text())['phases']
+            result['lines'] = sum(1 for _ in open(source))
+
+        result[tool] = {'best': min(times), 'median': statistics.median(times)}
+
+    return result
+
+def git_commit(directory):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# reports
+
+def print_results(results):
+    for workload, points in results['workloads'].items():
+        print(f'\033[36m====={workload}=====\033[0m')
+        for p in points:
+            times = '\t'.join(f'{tool} {p[tool]['best'] * 1000:9.1f} ms' for tool in ('shilpi', 'rochoyita') if tool in p)
+            print(str(p['size']).rjust(8), times, sep='\t')
+
+def print_comparison(old, new):
+    print(f'{old.get('commit')} -> {new.get('commit')}, best of each run')
+
+    for workload, points in new['workloads'].items():
+        before = {p['size']: p for p in old['workloads'].get(workload, [])}
+
+        print(f'\033[36m====={workload}=====\033[0m')
+        for p in points:
+            if p['size'] not in before:
+                continue
+
+            columns = []
+            for tool in ('shilpi', 'rochoyita'):
+                if tool in p and tool in before[p['size']]:
+                    a = before[p['size']][tool]['best']
+                    b = p[tool]['best']
+                    columns.append(f'{tool} {a * 1000:9.1f} -> {b * 1000:9.1f} ms ({b / a:5.2f}x)')
+            print(str(p['size']).rjust(8), *columns, sep='\t')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='bench',
+        description='Benchmarks for rochoyita and shilpi',
+    )
+
+    parser.add_argument('workload', nargs='*', help=f'Workloads to run: {', '.join(workloads)} (default: all)')
+    parser.add_argument('-o', '--output', help='Output JSON file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per measurement, the best one counts (default: 3)')
+    parser.add_argument('--quick', action='store_true', help='Only the smallest sizes')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two results files instead of running')
+    parser.add_argument('-O', '--optimize', action='store_true', help='Assemble with -O')
+    parser.add_argument('--tools', metavar='DIR', help='Directory with the rochoyita.py and shilpi.py to time, like a git worktree of another commit (default: this one)')
+    args = parser.parse_args(argv)
+
+    for workload in args.workload:
+        if workload not in workloads:
+            parser.error(f'unknown workload "{workload}"')
+
+    if args.compare:
+        old, new = (json.loads(Path(f).read_text()) for f in args.compare)
+        print_comparison(old, new)
+        return
+
+    tools_directory = Path(args.tools).resolve() if args.tools else ROOT
+    accepted = options(tools_directory / 'rochoyita.py')
+
+    if args.optimize and '-O' not in accepted:
+        parser.error(f'{tools_directory / 'rochoyita.py'} has no -O')
+
+    # without --stats-json only the wall clock time is measured
+    stats = '--stats-json' in accepted
+    rochoyita_args = ['-O'] if args.optimize else []
+    if '-q' in accepted:
+        rochoyita_args.append('-q')
+
+    commit = git_commit(tools_directory)
+    results = {
+        'version': VERSION,
+        'commit': commit,
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'optimize': args.optimize,
+        'stats': stats,
+        'workloads': {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for workload in args.workload or workloads:
+            generate, sizes, quick_sizes, tools = workloads[workload]
+            results['workloads'][workload] = [measure(workload, size, Path(directory), args.repeat, tools_directory, rochoyita_args, stats)
+                                              for size in (quick_sizes if args.quick else sizes)]
+
+    print_results(results)
+
+    output_file_path = Path(args.output) if args.output else ROOT / 'benchmarks' / 'results' / f'{commit or 'results'}.json'
+    output_file_path.parent.mkdir(parents=True, exist_ok=True)
+    output_file_path.write_text(json.dumps(results, indent=4))
+    print(f'results written to {output_file_path}')
+
+if __name__ == '__main__':
+    main()
@@ -2,52 +2,27 @@
 # rochoyita - Simple assembler for Sutra-1
 # SPDX-License-Identifier: GPL-3.0-only
 
-import math, enum, re, argparse, itertools, pathlib, os
-from dataclasses import dataclass, field
+import enum, re, argparse, itertools, os, bisect, copy, hashlib, json, base64, dataclasses, time, contextlib
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from dataclasses import dataclass, field, asdict
 from pathlib import Path
 
-VERSION = 1.0
+VERSION = 1.1
 
-# handle args
-parser = argparse.ArgumentParser(
-    prog='rochoyita',
-    description='Simple assembler from the Sutra-1 System',
-    epilog='Copyright (C) 2025 Debayan "rnayabed" Sutradhar',
-)
-
-input_group = parser.add_mutually_exclusive_group()
-input_group.add_argument('-v', '--version', action='store_true', help='Version and copyright information')
-input_group.add_argument('input', nargs='?', help='Input assembly source file')
-parser.add_argument('-o', '--output', help='Output Logisim Evolution memory image file')
-parser.add_argument('-r', '--raw', help='Disable preprocessor', action='store_true')
-args = parser.parse_args()
-
-DISABLE_PREPROCESSOR = args.raw
-
-if args.version:
-    print(f'''rochoyita version {VERSION}
-Copyright (C) 2025 Debayan Sutradhar
-
-This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3.
-
-This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
-
-You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>. ''')
-    exit()
+class AssemblerError(Exception):
+    def __init__(self, *text):
+        super().__init__('\n'.join(text))
+        self.text = text
 
 def error_raw(*text):
-    print('\033[1;4;7;31m') # red with blue, underline, inverted text
-    print('\n'.join(text))
-    print('\033[0m')
-    exit(1)
+    raise AssemblerError(*text)
 
-input_file_path = args.input
-
-p = Path(input_file_path)
-if not p.is_file():
-    error_raw(f'input file "{input_file_path}" not found!')
-
-output_file_path = args.output if args.output else f'{Path.cwd()}{os.sep}{p.stem}.hex'
+def error(line_number, line, error):
+    error_raw(
+        f'ERROR{f' in line #{line_number}' if line_number is not None else ''}: "{line}"',
+        error
+    )
 
 # guidelines
 # total             00000 - FFFFF       1048576 words
@@ -55,6 +30,11 @@ output_file_path = args.output if args.output else f'{Path.cwd()}{os.sep}{p.stem
 # ISR               FF800 - FFE0B          1548 words
 # stack             FFE0C - FFFFF           500 words
 
+class Verbosity(enum.IntEnum):
+    SILENT = 0      # errors only
+    SUMMARY = 1     # memory layout report
+    FULL = 2        # per line trace
+
 class Constants:
     ISR_ADDRESS = 0xff800
     PROGRAM_MAX_LENGTH = ISR_ADDRESS
@@ -70,12 +50,25 @@ class OperandType(enum.Enum):
 class Operand:
     type: OperandType
     length: int
+    shift: int = 0
 
 @dataclass
 class Instruction:
     op_code: str
     operands: tuple[Operand] = field(default_factory=list)
 
+    def __post_init__(self):
+        # op code occupies the upper bits, followed by the operands
+        shift = 10 - len(self.op_code)
+        self.value = int(self.op_code, 2) << shift
+
+        for operand in self.operands:
+            shift -= operand.length
+            operand.shift = shift
+
+        if shift != 0:
+            raise ValueError(f'instruction {self.op_code} does not match standard length')
+
 instructions = {
     'COPY'      : Instruction(
         '0001',
@@ -176,136 +169,17 @@ instructions = {
 destination_registers = ('A', 'B', 'C', 'D', 'SP', 'IMR', 'MARL', 'MARH')
 source_registers = ('A', 'B', 'C', 'D', 'SP', 'IMR', 'ISR')
 
-def error(line_number, line, error):
-    error_raw(
-        f'ERROR{f' in line #{line_number}' if line_number is not None else ''}: "{line}"',
-        error
-    )
-
-# pre process
-
-
-define_replace = {}
-source_lines = []
-
-def preprocess(file):
-    if not Path(file).is_file():
-        error_raw(f'input file "{file}" not found!')
-
-    extension = file[file.rindex('.'):]
-    if not extension.upper() != 'S':
-        error_raw(f'invalid file extension "{extension}". only .s and .S files are supported')
-
-    source_file = open(file, 'r')
-
-    multi_line_comment_block = False
-    line_number = 0
-
-    branched_ignore = []
-
-    for line in source_file:
-        line_number +=1
-        line = line.strip()
-
-        if line.startswith('/*'):
-            multi_line_comment_block = True
-
-        if line.startswith('//') or multi_line_comment_block or not line:
-            if line.endswith('*/'):
-                multi_line_comment_block = False
-            continue # Ignore comments and empty lines
-
-        # Ignore trailing comments
-        if '//' in line:
-            line = line[:line.index('//')]
-
-        if line.startswith('#'):
-            if (extension == 's' and os.name != 'nt') or DISABLE_PREPROCESSOR:
-                error(line_number, line, f'preprocessor is not allowed in raw .s mode')
-
-            space_index = line.find(' ')            
-            directive = (line[1:] if space_index == -1 else line[1:space_index])
+destination_register_indices = {r: i for i, r in enumerate(destination_registers)}
+source_register_indices = {r: i for i, r in enumerate(source_registers)}
 
-            if directive == 'define': 
-                tokens = line.split() 
-                if len(tokens) != 3:
-                    error(line_number, line, f'"{line}" is not a valid #define statement')
-
-                macro_value = tokens[2]
-                for name, value in define_replace.items():
-                    macro_value = re.sub(rf'\b{name}\b', value, macro_value)
-
-                define_replace[tokens[1]] = macro_value
-            elif directive == 'undef':
-                tokens = line.split()
-
-                if len(tokens) != 2:
-                    error(line_number, line, f'"{line}" is not a valid #undef statement')
-
-                key = tokens[1]
-                if not define_replace.pop(key, False):
-                    error(line_number, line, f'"{key}" is not defined')
-            elif directive == 'include':
-                l_index = line.find('"')
-                r_index = line.rfind('"')
-                if l_index == -1 or r_index == -1:
-                    error(line_number, line, f'"{line}" is not a valid #include statement')
-
-                file_path = line[l_index + 1:r_index]
-
-                print('\033[36mINCLUDE'.ljust(15), f'"{file_path}"', sep='\t')
-                preprocess(f'{Path(file).resolve().parent}{os.sep}{file_path}')
-            elif directive == 'ifdef' or directive == 'ifndef':
-                tokens = line.split()
-
-                if len(tokens) != 2:
-                    error(line_number, line, f'"{line}" is not a valid #ifdef statement')
-
-                key = tokens[1]
-
-                branched_ignore.append((key not in define_replace) if directive == 'ifdef' else (key in define_replace))
-            elif directive == 'endif':
-                if len(branched_ignore) == 0:
-                    error(line_number, line, f'"{line}" is not a valid #endif statement. not in a conditional block')
-                branched_ignore.pop()
-
-            elif directive == 'else':
-                if len(branched_ignore) == 0:
-                    error(line_number, line, f'invalid #else placement. not in a conditional block')
-
-                branched_ignore[-1] = not branched_ignore[-1]
-            else:
-                error(line_number, line, f'invalid preprocessor directive')
-        else:
-            for name, value in define_replace.items():
-                line = re.sub(rf'\b{name}\b', value, line)
-
-            if len(branched_ignore) == 0 or not branched_ignore[-1]:
-                source_lines.append((file, line_number, line))
-
-    source_file.close()
-
-preprocess(input_file_path)
-
-# assemble
-multi_line_comment_block = False
-program_output = []
-isr_output = []
-label_addresses = {
-    ':ISR': Constants.ISR_ADDRESS
-}
-label_unassembled_lines = []
-
-# mnemonic -> hex
-def assemble(line, tokens, line_number=None):
+# mnemonic -> 10 bit word
+def assemble_mnemonic(line, tokens, line_number=None):
     instruction = instructions[tokens[0]]
 
-    print('\033[32mASSEMBLE'.ljust(15), line.ljust(25), sep='\t', end='\t')
-
     if (len(tokens) - 1) != len(instruction.operands):
         error(line_number, line, f'operands mismatch. expected {len(instruction.operands)}, given {len(tokens) - 1}')
 
-    output_instruction = instruction.op_code
+    word = instruction.value
 
     for i in range(len(tokens) - 1):
 
@@ -314,42 +188,44 @@ def assemble(line, tokens, line_number=None):
         token = tokens[i + 1]
         
         if operand_info.type == OperandType.DESTINATION:
-            if token not in destination_registers:
+            index = destination_register_indices.get(token)
+            if index is None:
                 error(line_number, line, f'"{token}" is not a valid destination register')
             
-            index = destination_registers.index(token)
-            if index >= 2 ** operand_info.length:
+            if index >> operand_info.length:
                 error(line_number, line, f'destination register "{token}" not allowed. it must be between {', '.join(destination_registers[i] for i in range(2 ** operand_info.length))}')
 
-            output_instruction += format(index, 'b').zfill(operand_info.length)
-
         elif operand_info.type == OperandType.SOURCE:
-            if token not in source_registers:
+            index = source_register_indices.get(token)
+            if index is None:
                 error(line_number, line, f'"{token}" is not a valid source register')
 
-            index = source_registers.index(token)
-            if index >= 2 ** operand_info.length:
+            if index >> operand_info.length:
                 error(line_number, line, f'source register "{token}" not allowed. it must be between {', '.join(source_registers[i] for i in range(2 ** operand_info.length))}')
-
-            output_instruction += format(index, 'b').zfill(operand_info.length)
             
         elif operand_info.type == OperandType.DATA:
             if operand_info.length != len(token):
                 error(line_number, line, f'operand "{token}" length mismatch. expected {operand_info.length}, given {len(token)}')
 
-            if any(c not in '01' for c in token):
+            if token.strip('01'):
                 error(line_number, line, f'"{token}" is not a valid binary number')
 
-            output_instruction += token
+            index = int(token, 2)
 
+        word |= index << operand_info.shift
 
-    if len(output_instruction) != 10:
-        error(line_number, line, f'resultant assembled instruction {output_instruction} does not match standard length')
+    return word
 
-    hex_ = format(int(output_instruction, 2), 'X').zfill(3)
-    print(output_instruction, hex_ + '\033[0m', sep='\t')
+# 10 bit word -> (mnemonic, operand values), None if the word is not an instruction
+def decode_word(word):
+    for name, instruction in instructions.items():
+        shift = 10 - len(instruction.op_code)
+        if word >> shift == instruction.value >> shift:
+            return name, tuple((word >> o.shift) & ((1 << o.length) - 1) for o in instruction.operands)
 
-    return hex_
+    return None
+
+decoded_words = [decode_word(w) for w in range(1024)]
 
 # Helper funcs
 
@@ -385,6 +261,8 @@ def generate_binary(line_number, line, value_str, signed, bits):
 
             value = format(abs(value_int), 'b').zfill(bits)           
 
+    except AssemblerError:
+        raise
     except Exception as e:
         error(line_number, line, f'{value_str} is not a valid integer')
     
@@ -423,6 +301,32 @@ def pseudo_assemble_loadi(line, tokens, line_number, **kwargs):
 '''
 
 
+ALU_AZ, ALU_AC, ALU_BZ, ALU_BC, ALU_CIN, ALU_N, ALU_OC = (1 << i for i in range(7))
+
+def alu(flags, a, b):
+    # -> (result, zero, negative, carry)
+    if flags & ALU_AZ:
+        a = 0
+    if flags & ALU_AC:
+        a ^= 0x3FF
+    if flags & ALU_BZ:
+        b = 0
+    if flags & ALU_BC:
+        b ^= 0x3FF
+
+    if flags & ALU_N:
+        result = (a & b) ^ 0x3FF
+        carry = 0
+    else:
+        result = a + b + (1 if flags & ALU_CIN else 0)
+        carry = result >> 10
+        result &= 0x3FF
+
+    if flags & ALU_OC:
+        result ^= 0x3FF
+
+    return result, result == 0, result >> 9, carry
+
 def pseudo_assemble_alu_op(line, tokens, line_number, **kwargs):
     # ALUFSETO <option>
 
@@ -538,14 +442,18 @@ def pseudo_assemble_stack_pop(line, tokens, line_number, **kwargs):
 def pseudo_assemble_call(line, tokens, line_number, **kwargs):
     # CALL :label
 
+    if kwargs.get('call_abi') == 'compact':
+        return pseudo_assemble_call_compact(line, tokens, line_number, **kwargs)
+
     address = tokens[1]
 
     output = []
 
     # back up A, B, C, D, address upper, lower to stack
 
-    # registers
-    for r in 'ABC':
+    # registers, only the ones still needed after returning with -O
+    saved = kwargs.get('saved_registers', 'ABC')
+    for r in saved:
         output += pseudo_assemble_stack_push(line, (None, r), line_number)
 
     # copy current address
@@ -572,11 +480,11 @@ def pseudo_assemble_call(line, tokens, line_number, **kwargs):
 
     output += pseudo_assemble_jump(line, ('J', address), line_number)
 
-    label_addresses[return_address] = format(current_ins_address + len(output), 'b').zfill(20)
+    kwargs['label_addresses'][return_address] = current_ins_address + len(output)
 
     # executed after RETURN
     # pop D, C, B, A
-    for r in 'CBA':
+    for r in reversed(saved):
         output += pseudo_assemble_stack_pop(line, (None, r), line_number)
     
     return output
@@ -584,6 +492,10 @@ def pseudo_assemble_call(line, tokens, line_number, **kwargs):
 def pseudo_assemble_return(line, tokens, line_number, **kwargs):
     # RETURN
 
+    if kwargs.get('call_abi') == 'compact':
+        kwargs['call_stubs'].setdefault(RETURN_STUB_LABEL, (line, line_number, None))
+        return pseudo_assemble_jump(line, ('J', RETURN_STUB_LABEL), line_number)
+
     output = []
 
     # pop lower to B and upper to A
@@ -602,6 +514,169 @@ def pseudo_assemble_return(line, tokens, line_number, **kwargs):
     return output
 
 
+# Compact calls
+#
+# Call sites save A and B and pass the return address in A, B to an entry stub shared by all calls of
+# a routine, which saves C and the return address. RETURN jumps to a single return stub restoring all
+# of them. Stack frame, from the top: C, B, A, return address upper, lower
+
+RETURN_STUB_LABEL = ':INTERNAL-return'
+
+def call_stub_label(line, address, line_number):
+    if not address.startswith(':'):
+        address = format(int(generate_binary(line_number, line, address, signed=False, bits=20), 2), 'X')
+
+    return f':INTERNAL-enter-{address.lstrip(':')}'
+
+def pseudo_assemble_call_compact(line, tokens, line_number, **kwargs):
+    # CALL :label
+
+    address = tokens[1]
+    stub = call_stub_label(line, address, line_number)
+    kwargs['call_stubs'].setdefault(stub, (line, line_number, address))
+
+    current_ins_address = kwargs['current_ins_address']
+    return_address = f':INTERNAL{current_ins_address}'
+
+    output = [
+        # copy SP - 3 and SP - 4 to MAR, leaving room for the return address
+        'ALUFSET 0000111',                  # AZ, AC, BZ -> 111... + 0 = 111...(n-1)
+        'ALUEVAL A',                        # does not matter
+        'ALUSTORER MARH',                   # upper bits
+        'ALUFSET 0000011',                  # AZ, AC -> 111... + B = B - 1 (Decrement SP)
+        'ALUEVAL SP',
+        'ALUSTORER SP',
+        'ALUEVAL SP',
+        'ALUSTORER SP',
+
+        'ALUEVAL SP',
+        'ALUSTORER SP',
+        'ALUSTORER MARL',
+        'STORE A',
+
+        'ALUEVAL SP',
+        'ALUSTORER SP',
+        'ALUSTORER MARL',
+        'STORE B',
+
+        # jump to the entry stub, A is not free to load MAR
+        f'>LOADIU B {stub}_0_5',
+        f'>LOADIL B {stub}_5_10',
+        'COPY B MARH',
+        f'>LOADIU B {stub}_10_15',
+        f'>LOADIL B {stub}_15_20',
+        'COPY B MARL',
+
+        f'>LOADIU A {return_address}_0_5',
+        f'>LOADIL A {return_address}_5_10',
+        f'>LOADIU B {return_address}_10_15',
+        f'>LOADIL B {return_address}_15_20',
+        'JUMP 00',
+    ]
+
+    kwargs['label_addresses'][return_address] = current_ins_address + len(output)
+
+    return output
+
+def call_enter_stub(line, address, line_number):
+    # SP - 4 on entry, return address upper in A and lower in B
+
+    output = [
+        'ALUFSET 0000111',                  # AZ, AC, BZ -> 111... + 0 = 111...(n-1)
+        'ALUEVAL A',                        # does not matter
+        'ALUSTORER MARH',                   # upper bits
+
+        'ALUFSET 0000011',                  # AZ, AC -> 111... + B = B - 1 (Decrement SP)
+        'ALUEVAL SP',
+        'ALUSTORER SP',
+        'ALUSTORER MARL',
+        'STORE C',
+
+        # C is saved, use it to count up to the return address
+        'ALUFSET 0010001',                  # AZ, Cin -> 0 + B + 1 (Increment)
+        'ALUEVAL SP',
+        'ALUSTORER C',
+        'ALUEVAL C',
+        'ALUSTORER C',
+        'ALUEVAL C',
+        'ALUSTORER C',
+        'ALUSTORER MARL',
+        'STORE A',
+        'ALUEVAL C',
+        'ALUSTORER MARL',
+        'STORE B',
+
+        # restore argument
+        'COPY SP MARL',
+        'LOAD C',
+    ]
+
+    output += pseudo_assemble_jump(line, ('J', address), line_number)
+
+    return output
+
+# no register is free to hold the return address while A, B and C are restored, so SP and the ALU
+# result register count up to it, and the return address is loaded straight into MAR
+return_stub = (
+    'ALUFSET 0000111',                      # AZ, AC, BZ -> 111... + 0 = 111...(n-1)
+    'ALUEVAL A',                            # does not matter
+    'ALUSTORER MARH',                       # upper bits
+
+    'COPY SP MARL',
+    'LOAD C',
+
+    'ALUFSET 0010001',                      # AZ, Cin -> 0 + B + 1 (Increment)
+    'ALUEVAL SP',
+    'ALUSTORER MARL',
+    'LOAD B',
+
+    'ALUSTORER SP',
+    'ALUEVAL SP',
+    'ALUSTORER MARL',
+    'LOAD A',
+
+    'ALUSTORER SP',
+    'ALUEVAL SP',
+    'ALUSTORER MARL',
+    'ALUSTORER SP',
+    'ALUEVAL SP',
+    'LOAD SP',                              # return address upper
+    'ALUSTORER MARL',
+    'LOAD MARL',                            # return address lower
+    'COPY SP MARH',
+
+    # SP past the frame
+    'ALUSTORER SP',
+    'ALUEVAL SP',
+    'ALUSTORER SP',
+
+    'JUMP 00',
+)
+
+@dataclass
+class CallCost:
+    # one CALL with either ABI, not counting the routine itself or -O
+    file: str
+    line_number: int
+    line: str
+    words: tuple        # (inline, compact) words at the call site
+    cycles: tuple       # (inline, compact) from CALL until execution continues after it
+    stub: str           # compact entry stub
+
+def call_cost(file, line, tokens, line_number):
+    inline = pseudo_assemble_call(line, tokens, line_number, current_ins_address=0, label_addresses={})
+    compact = pseudo_assemble_call_compact(line, tokens, line_number, current_ins_address=0, label_addresses={}, call_stubs={})
+    inline_return = pseudo_assemble_return(None, ('RETURN',), None)
+    compact_return = pseudo_assemble_jump(None, ('J', RETURN_STUB_LABEL), None)
+    stub = call_enter_stub(line, tokens[1], line_number)
+
+    return CallCost(
+        file, line_number, line,
+        (len(inline), len(compact)),
+        (len(inline) + len(inline_return), len(compact) + len(stub) + len(compact_return) + len(return_stub)),
+        call_stub_label(line, tokens[1], line_number)
+    )
+
 '''
 JUMP MODES:
 b1 b0   
@@ -703,138 +778,2630 @@ for pj in pseudo_jumps.keys():
     pseudo_instructions[pj] = [pseudo_assemble_jump,    1] 
 
 
-isr_being_processed = False
-output = program_output
-for file, line_number, line in source_lines:
+class Macros:
+    """
+    #define table.
 
-    if line.startswith('/*'):
-        multi_line_comment_block = True
+    Expanding a line is a single tokenizer pass with one dictionary lookup per identifier. Substituting
+    macros one after another means the value of a macro is itself expanded by every macro that comes
+    after it in the table, so that chained result is precomputed per macro. A new #define only expands
+    the values using its name, the table is rebuilt after a redefinition or #undef.
+    """
+
+    identifier = re.compile(r'\w+')
+
+    def __init__(self, defines=None, count=False):
+        self.values = dict(defines) if defines else {}
+        self.expanded = None
+        self.users = {}     # identifier -> names of macros whose expanded value contains it
+        self.count = count      # count substitutions, for --stats
+        self.substitutions = 0
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def define(self, name, value):
+        value = self.expand(value)
+
+        if name in self.values or not self.expanded or not self.identifier.fullmatch(name):
+            self.values[name] = value
+            self.expanded = None
+            return
+
+        # the new macro comes last, so only values containing its name change
+        self.values[name] = value
+        expanded = self.expanded
+        for user in self.users.pop(name, ()):
+            expanded[user] = self.identifier.sub(lambda m: value if m[0] == name else m[0], expanded[user])
+            self.use(user, value)
+
+        expanded[name] = value
+        self.use(name, value)
+
+    def undef(self, name):
+        if name not in self.values:
+            return False
+
+        del self.values[name]
+        self.expanded = None
+        return True
+
+    def build(self):
+        names = list(self.values)
+
+        if not all(self.identifier.fullmatch(name) for name in names):
+            # names with non identifier characters can not be looked up per token
+            return False
+
+        expanded = {}
+        later = {}
+
+        for name in reversed(names):
+            value = self.values[name]
+            expanded[name] = self.identifier.sub(lambda m: later.get(m[0], m[0]), value) if later else value
+            later[name] = expanded[name]
+
+        self.users = {}
+        for name, value in expanded.items():
+            self.use(name, value)
+
+        return expanded
+
+    def use(self, name, value):
+        for token in self.identifier.findall(value):
+            self.users.setdefault(token, set()).add(name)
+
+    def expand(self, line):
+        if not self.values:
+            return line
+
+        if self.expanded is None:
+            self.expanded = self.build() or False
+
+        if self.expanded is False:
+            for name, value in self.values.items():
+                line, substitutions = re.subn(rf'\b{name}\b', value, line)
+                self.substitutions += substitutions
+            return line
+
+        expanded = self.expanded
+
+        if self.count:
+            def substitute(m):
+                value = expanded.get(m[0])
+                if value is None:
+                    return m[0]
+                self.substitutions += 1
+                return value
+
+            return self.identifier.sub(substitute, line)
+
+        return self.identifier.sub(lambda m: expanded.get(m[0], m[0]), line)
+
+@dataclass(slots=True)
+class Fixup:
+    # relocation: OR bits start..stop of a label's 20 bit address into an already encoded word
+    isr: bool
+    index: int
+    label: str
+    start: int
+    stop: int
+    shift: int
+    mnemonic: str
+    line_number: int
+    line: str
+
+def label_slice(address, start, stop):
+    # bits start..stop of a 20 bit address, counted from the most significant bit
+    return (address >> (20 - stop)) & ((1 << (stop - start)) - 1)
+
+def parse_fixup(mnemonic, line_number=None):
+    # '>LOADIU A :label_0_5' -> (word with zero data bits, label, start, stop, shift)
+    tokens = mnemonic[1:].split()
+
+    for i, token in enumerate(tokens):
+        if '_' in token:
+            break
 
-    if line.startswith('//') or line.startswith('#') or multi_line_comment_block or not line:
-        if line.endswith('*/'):
-            multi_line_comment_block = False
-        continue # Ignore comments and empty lines
+    label, start_index, stop_index = token.split('_')
+    start_index = int(start_index)
+    stop_index = int(stop_index)
 
+    operand_info = instructions[tokens[0]].operands[i - 1]
+    if operand_info.type != OperandType.DATA or operand_info.length != stop_index - start_index:
+        error(line_number, mnemonic, f'label slice "{token}" does not fit operand')
 
-    current_ins_address = len(output) + (Constants.ISR_ADDRESS if isr_being_processed else 0)
+    tokens[i] = '0' * operand_info.length
+    word = assemble_mnemonic(mnemonic, tokens, line_number)
 
-    if line.startswith(':'):
-        if re.search(r'[\s_]', line):
-            error(line_number, line, f'invalid label "{line}". It MUST not contain whitespace or "_"')
+    return word, label, start_index, stop_index, operand_info.shift
 
-        if line[1:] == 'ISR':
-            # move all further lines to ISR address
-            isr_being_processed = True
-            output = isr_output
-            print(f'\033[35mISR'.ljust(15), line.ljust(10), format(Constants.ISR_ADDRESS, 'X').zfill(4), '\033[0m', sep='\t')
+@dataclass
+class ObjectCode:
+    # assembled output whose label references are not resolved yet
+    program: array      # array('H') of 10-bit words
+    isr: array
+    labels: dict        # label -> 20 bit address
+    fixups: list[Fixup]
+    listing: list[tuple] = None     # (address, file, line number, mnemonic, statement) per word
+    calls: list[CallCost] = field(default_factory=list)
+    optimizations: dict = field(default_factory=dict)   # optimization pass -> words removed
+    inlined: list = field(default_factory=list)
+    call_abi: str = 'inline'
+    file: str = None
+
+    def remove(self, removed_program, removed_isr):
+        # drop words by index and move labels, fixups and the listing along with the remaining words
+        removed_program = sorted(set(removed_program))
+        removed_isr = sorted(set(removed_isr))
+
+        def new_address(address):
+            if address >= Constants.ISR_ADDRESS:
+                return address - bisect.bisect_left(removed_isr, address - Constants.ISR_ADDRESS)
+            return address - bisect.bisect_left(removed_program, address)
+
+        for section, removed in ((self.program, removed_program), (self.isr, removed_isr)):
+            for index in reversed(removed):
+                del section[index]
+
+        for label, address in self.labels.items():
+            self.labels[label] = new_address(address)
+
+        dropped_program = set(removed_program)
+        dropped_isr = set(removed_isr)
+
+        fixups = []
+        for f in self.fixups:
+            if f.index in (dropped_isr if f.isr else dropped_program):
+                continue
+
+            f.index -= bisect.bisect_left(removed_isr if f.isr else removed_program, f.index)
+            fixups.append(f)
+        self.fixups = fixups
+
+        if self.listing is not None:
+            listing = []
+            for address, *entry in self.listing:
+                if address >= Constants.ISR_ADDRESS:
+                    if address - Constants.ISR_ADDRESS in dropped_isr:
+                        continue
+                elif address in dropped_program:
+                    continue
+
+                listing.append((new_address(address), *entry))
+            self.listing = listing
+
+@dataclass
+class Program:
+    program: array      # array('H') of 10-bit words
+    isr: array
+    listing: list[tuple] = None     # (address, file, line number, mnemonic, statement) per word
+    optimizations: dict = field(default_factory=dict)   # optimization pass -> words removed
+    calls: list[CallCost] = field(default_factory=list)
+    inlined: list = field(default_factory=list)     # Inlining per CALL replaced by -O
+    labels: dict = None     # label -> 20 bit address
+
+# Optimization
+
+UNKNOWN = (None, None)
+
+def register_int(value):
+    # (upper 5 bits, lower 5 bits) -> int, None unless both halves are known numbers
+    hi, lo = value
+    if type(hi) is int and type(lo) is int:
+        return (hi << 5) | lo
+    return None
+
+def block_leaders(code, fixed_targets=()):
+    # indices per section where code may be jumped to from elsewhere: labels, and the targets of jumps to fixed addresses
+    leaders = (set(), set())
+    for address in (*code.labels.values(), *fixed_targets):
+        isr, index = section_index(address)
+        if index <= len(code.isr if isr else code.program):
+            leaders[isr].add(index)
+
+    return leaders
+
+def peephole_section(code, isr, jump_targets, fixed_targets=()):
+    """
+    Find words that can be removed from one section without changing what the program computes.
+
+    Register, MAR and ALU flag contents are tracked per 5 bit half, either as numbers or as label
+    address slices, and forgotten at every label and every address in `fixed_targets`, since the
+    state of the code jumping there is not known. Loads of a value a register already holds are redundant. Writes to register A (the scratch
+    register of pseudo instructions), the ALU flags and the ALU result that are overwritten before
+    being read are dead.
+    """
+
+    words = code.program if not isr else code.isr
+    base = Constants.ISR_ADDRESS if isr else 0
+
+    leaders = block_leaders(code, fixed_targets)[isr]
+    fixups_at = {f.index: f for f in code.fixups if f.isr == isr}
+
+    removed = []
+
+    registers = {}
+    flags = result = None
+    pending_a = [None, None]
+    pending_flags = pending_result = None
+
+    for i, word in enumerate(words):
+        decoded = decoded_words[word]
+
+        if i in leaders or decoded is None:
+            registers = {}
+            flags = result = None
+            pending_a = [None, None]
+            pending_flags = pending_result = None
+
+            if decoded is None:
+                continue
+
+        name, operands = decoded
+
+        if name == 'LOADIU' or name == 'LOADIL':
+            destination = destination_registers[operands[0]]
+            half = 0 if name == 'LOADIU' else 1
+
+            f = fixups_at.get(i)
+            value = (f.label, f.start, f.stop) if f else operands[1]
+
+            current = registers.get(destination, UNKNOWN)
+            if current[half] == value:
+                removed.append(i)
+                continue
+
+            if destination == 'A':
+                if pending_a[half] is not None:
+                    removed.append(pending_a[half])
+                pending_a[half] = i
+
+            registers[destination] = (value, current[1]) if half == 0 else (current[0], value)
+
+        elif name == 'COPY':
+            source = source_registers[operands[0]]
+            destination = destination_registers[operands[1]]
+
+            value = registers.get(source, UNKNOWN)
+            if None not in value and registers.get(destination) == value:
+                removed.append(i)
+                continue
+
+            if source == 'A':
+                pending_a = [None, None]
+            if destination == 'A':
+                removed.extend(p for p in pending_a if p is not None)
+                pending_a = [None, None]
+
+            registers[destination] = value
+
+        elif name == 'ALUFSET':
+            if flags == operands[0]:
+                removed.append(i)
+                continue
+
+            if pending_flags is not None:
+                removed.append(pending_flags)
+            pending_flags = i
+            flags = operands[0]
+
+        elif name == 'ALUFSETR':
+            source = source_registers[operands[0]]
+            if source == 'A':
+                pending_a = [None, None]
+
+            if pending_flags is not None:
+                removed.append(pending_flags)
+            pending_flags = i
+
+            value = register_int(registers.get(source, UNKNOWN))
+            flags = value & 0x7F if value is not None else None
+
+        elif name == 'ALUEVAL':
+            source = source_registers[operands[0]]
+
+            if pending_result is not None:
+                removed.append(pending_result)
+            pending_result = i
+            pending_a = [None, None]
+            pending_flags = None
+
+            result = None
+            if flags is not None:
+                # zeroed operands need not be known
+                a = 0 if flags & ALU_AZ else register_int(registers.get('A', UNKNOWN))
+                b = 0 if flags & ALU_BZ else register_int(registers.get(source, UNKNOWN))
+                if a is not None and b is not None:
+                    result = alu(flags, a, b)[0]
+
+        elif name == 'ALUSTORER':
+            destination = destination_registers[operands[0]]
+            pending_result = None
+
+            value = (result >> 5, result & 0x1F) if result is not None else UNKNOWN
+            if result is not None and registers.get(destination) == value:
+                removed.append(i)
+                continue
+
+            if destination == 'A':
+                removed.extend(p for p in pending_a if p is not None)
+                pending_a = [None, None]
+
+            registers[destination] = value
+
+        elif name == 'ALUSTOREF':
+            destination = destination_registers[operands[0]]
+            pending_result = pending_flags = None
+
+            if destination == 'A':
+                removed.extend(p for p in pending_a if p is not None)
+                pending_a = [None, None]
+
+            registers[destination] = UNKNOWN
+
+        elif name == 'AOP':
+            pending_a = [None, None]
+            value = register_int(registers.get('A', UNKNOWN))
+
+            match operands[0]:
+                case 0b00:
+                    pass
+                case 0b01 if value is not None:
+                    registers['A'] = (value >> 6, (value >> 1) & 0x1F)
+                case 0b10 if value is not None:
+                    value = (value << 1) & 0x3FF
+                    registers['A'] = (value >> 5, value & 0x1F)
+                case _:
+                    registers['A'] = UNKNOWN
+
+        elif name == 'STORE' or name == 'OUT':
+            if source_registers[operands[0]] == 'A':
+                pending_a = [None, None]
+
+        elif name == 'LOAD':
+            destination = destination_registers[operands[0]]
+            if destination == 'A':
+                removed.extend(p for p in pending_a if p is not None)
+                pending_a = [None, None]
+
+            registers[destination] = UNKNOWN
+
+        elif name == 'JUMP' or name == 'HALT':
+            # everything may be read at the jump target, or inspected after halting
+            pending_a = [None, None]
+            pending_flags = pending_result = None
+
+            if name == 'JUMP':
+                target = register_int(registers.get('MARH', UNKNOWN)), register_int(registers.get('MARL', UNKNOWN))
+                if None not in target:
+                    jump_targets.append((target[0] << 10) | target[1])
+
+    return removed
+
+def peephole(code):
+    # remove redundant and dead words until nothing changes, returns the number of words removed
+    total = 0
+    fixed_targets = set()
+
+    while True:
+        jump_targets = []
+        removed_program = peephole_section(code, False, jump_targets, fixed_targets)
+        removed_isr = peephole_section(code, True, jump_targets, fixed_targets)
+
+        if not fixed_targets.issuperset(jump_targets):
+            # jumps to fixed addresses are only known once reached, look again with blocks starting there
+            fixed_targets.update(jump_targets)
+            continue
+
+        if not removed_program and not removed_isr:
+            return total
+
+        check_fixed_jumps(jump_targets, removed_program, removed_isr)
+
+        total += len(set(removed_program)) + len(set(removed_isr))
+        code.remove(removed_program, removed_isr)
+
+def check_fixed_jumps(jump_targets, removed_program, removed_isr):
+    for target in jump_targets:
+        # jumps to fixed addresses can not follow the code they point at
+        if target >= Constants.ISR_ADDRESS:
+            moved = any(i < target - Constants.ISR_ADDRESS for i in removed_isr)
         else:
-            addr_binary = format(current_ins_address, 'b').zfill(20) # generate 20 bit address
-            label_addresses[line] = addr_binary
-            print(f'\033[35mLABEL'.ljust(15), line.ljust(10), format(current_ins_address, 'X').zfill(4), str(current_ins_address).ljust(5), '\033[0m', sep='\t')
-        
-        continue # Ignore label
+            moved = any(i < target for i in removed_program)
+
+        if moved:
+            error_raw(f'jump to fixed address {format(target, 'X').zfill(5)} can not be optimized, use a label instead')
+
+# Jump relaxation
+
+UNKNOWN_HALF = (None, frozenset(), False)   # (value, labels whose address bits it holds, loaded from a number)
+UNKNOWN_REGISTER = (UNKNOWN_HALF, UNKNOWN_HALF)
+
+def meet_registers(x, y):
+    # register contents where two paths of execution join
+    registers = {}
+
+    for key in x.keys() | y.keys():
+        a = x.get(key)
+        b = y.get(key)
+
+        if key == 'flags':
+            if a == b:
+                registers[key] = a
+            continue
+
+        a = a or UNKNOWN_REGISTER
+        b = b or UNKNOWN_REGISTER
+        value = tuple((p[0] if p[0] == q[0] else None, p[1] | q[1], p[2] or q[2]) for p, q in zip(a, b))
+        if value != UNKNOWN_REGISTER:
+            registers[key] = value
+
+    return registers
+
+def register_labels(registers, key):
+    hi, lo = registers.get(key, UNKNOWN_REGISTER)
+    return hi[1] | lo[1]
+
+def flow_word(registers, name, operands, fixup, labels, taken):
+    # update register contents for one word, labels whose address is read as data are added to `taken`
+    match name:
+        case 'LOADIU' | 'LOADIL':
+            destination = destination_registers[operands[0]]
+            if fixup:
+                address = labels.get(fixup.label)
+                value = label_slice(address, fixup.start, fixup.stop) if address is not None else None
+                half = (value, frozenset((fixup.label,)), False)
+            else:
+                half = (operands[1], frozenset(), True)
 
-    # Ignore trailing comments
-    if '//' in line:
-        line = line[:line.index('//')]
+            hi, lo = registers.get(destination, UNKNOWN_REGISTER)
+            registers[destination] = (half, lo) if name == 'LOADIU' else (hi, half)
 
-    tokens = line.split()
-    instruction = tokens[0]
-    
-    if instruction in instructions:
-        output.append(assemble(line, tokens, line_number))
-    elif instruction in pseudo_instructions:
-        # TODO: use placeholders for colours
-        print('\033[33mPSEUDO'.ljust(15), line.ljust(20), '\033[0m', sep='\t')
+        case 'COPY':
+            registers[destination_registers[operands[1]]] = registers.get(source_registers[operands[0]], UNKNOWN_REGISTER)
 
-        max_length = pseudo_instructions[instruction][1] + 1
-        if len(tokens) != max_length:
-            error(line_number, line, f'invalid {tokens[0]} syntax')
+        case 'ALUFSET':
+            registers['flags'] = operands[0]
 
-        output_mnemonics = pseudo_instructions[instruction][0](line, tokens, line_number, current_ins_address=current_ins_address)
+        case 'ALUFSETR':
+            taken |= register_labels(registers, source_registers[operands[0]])
+            registers.pop('flags', None)
 
-        for m in output_mnemonics:
-            if m[0] == '>':
-                print('\033[32mASSEMBLE LATER'.ljust(15), m.ljust(20), '\033[0m', sep='\t')
-                label_unassembled_lines.append((len(output), line_number, line, isr_being_processed))
-                output.append(m)
+        case 'ALUEVAL':
+            # zeroed operands are not read
+            flags = registers.get('flags')
+            result = frozenset()
+            if flags is None or not flags & ALU_AZ:
+                result |= register_labels(registers, 'A')
+            if flags is None or not flags & ALU_BZ:
+                result |= register_labels(registers, source_registers[operands[0]])
+
+            half = (None, result, False)
+            registers['result'] = (half, half)
+
+        case 'ALUSTORER':
+            registers[destination_registers[operands[0]]] = registers.get('result', UNKNOWN_REGISTER)
+
+        case 'ALUSTOREF' | 'LOAD':
+            registers.pop(destination_registers[operands[0]], None)
+
+        case 'STORE' | 'OUT':
+            taken |= register_labels(registers, source_registers[operands[0]])
+
+        case 'AOP':
+            if operands[0]:
+                taken |= register_labels(registers, 'A')
+                registers.pop('A', None)
+
+def section_index(address):
+    if address >= Constants.ISR_ADDRESS:
+        return True, address - Constants.ISR_ADDRESS
+    return False, address
+
+def register_flow(code, leaders, taken, jump_targets, assumed):
+    """
+    Find the register contents at the start of every basic block, keyed by (isr, index).
+
+    Jumps whose target is known start a block there and join the register contents of both sides, the
+    leaders already hold labels and fixed jump targets found before. Labels in `taken` had their
+    address read as data and may be reached by any jump to an address held in registers, so nothing is
+    known at their start. Nothing is known at the start of the ISR, and MARH is 0 on power on.
+
+    MARH is set to the value in `assumed`, keyed by (isr, index), before the word at that index runs.
+
+    Returns None when a new jump target or taken label was found and the flow has to be computed again.
+    """
+
+    sections = (code.program, code.isr)
+    fixups_at = ({}, {})
+    for f in code.fixups:
+        fixups_at[f.isr][f.index] = f
+
+    block_ends = {}
+    for isr in (False, True):
+        starts = sorted(leaders[isr])
+        for start, end in zip(starts, starts[1:] + [len(sections[isr])]):
+            block_ends[isr, start] = end
+
+    states = {}
+    work = []
+
+    def merge(key, registers):
+        current = states.get(key, registers)
+        merged = meet_registers(current, registers)
+        if key not in states or merged != current:
+            states[key] = merged
+            work.append(key)
+
+    zero = (0, frozenset(), False)
+    merge((False, 0), {'MARH': (zero, zero)})
+
+    if len(code.isr) > 0:
+        merge((True, 0), {})
+
+    for label in taken:
+        isr, index = section_index(code.labels[label])
+        if index < len(sections[isr]):
+            merge((isr, index), {})
+
+    found = set()
+
+    while work:
+        isr, start = work.pop()
+        words = sections[isr]
+        registers = dict(states[isr, start])
+
+        for i in range(start, block_ends[isr, start]):
+            if (isr, i) in assumed:
+                registers['MARH'] = assumed[isr, i]
+
+            decoded = decoded_words[words[i]]
+            if decoded is None:
+                registers = {}
+                continue
+
+            name, operands = decoded
+
+            if name == 'HALT':
+                break
+
+            if name == 'JUMP':
+                marh = registers.get('MARH', UNKNOWN_REGISTER)
+                marl = registers.get('MARL', UNKNOWN_REGISTER)
+                halves = marh + marl
+
+                if any(half[0] is None for half in halves):
+                    # jump to an address held in registers
+                    for key, value in registers.items():
+                        if key != 'flags':
+                            found |= value[0][1] | value[1][1]
+                else:
+                    target = (((marh[0][0] << 5) | marh[1][0]) << 10) | (marl[0][0] << 5) | marl[1][0]
+                    if marl[0][2] or marl[1][2]:
+                        jump_targets.append(target)
+
+                    target_isr, index = section_index(target)
+                    if index < len(sections[target_isr]):
+                        if index not in leaders[target_isr]:
+                            leaders[target_isr].add(index)
+                            return None
+                        merge((target_isr, index), registers)
+
+                if operands[0] == 0b00:
+                    break
+                continue
+
+            flow_word(registers, name, operands, fixups_at[isr].get(i), code.labels, found)
+        else:
+            end = block_ends[isr, start]
+            if end < len(words):
+                merge((isr, end), registers)
+
+    if not found <= taken:
+        taken |= found
+        return None
+
+    return states
+
+def word_registers(code, jump_targets, assumed={}, taken=(), fixed_targets=()):
+    # (isr, index, register contents before the word) for every reachable word, labels in `taken` may be jumped to from anywhere
+    leaders = block_leaders(code, fixed_targets)
+    for isr, words in ((False, code.program), (True, code.isr)):
+        leaders[isr].add(0)
+        for i, word in enumerate(words):
+            decoded = decoded_words[word]
+            if decoded is not None and decoded[0] == 'JUMP':
+                leaders[isr].add(i + 1)
+
+    taken = set(taken)
+    while True:
+        targets = []
+        states = register_flow(code, leaders, taken, targets, assumed)
+        if states is not None:
+            break
+
+    jump_targets.extend(targets)
+
+    sections = (code.program, code.isr)
+    fixups_at = ({}, {})
+    for f in code.fixups:
+        fixups_at[f.isr][f.index] = f
+
+    for (isr, start), registers in sorted(states.items()):
+        registers = dict(registers)
+        words = sections[isr]
+
+        i = start
+        while i < len(words) and (i == start or i not in leaders[isr]):
+            yield isr, i, dict(registers)
+
+            if (isr, i) in assumed:
+                registers['MARH'] = assumed[isr, i]
+
+            decoded = decoded_words[words[i]]
+            if decoded is None:
+                registers = {}
+            elif decoded[0] in ('HALT', 'JUMP'):
+                break
             else:
-                output.append(assemble(m, m.split(), None))
+                flow_word(registers, *decoded, fixups_at[isr].get(i), code.labels, set())
+            i += 1
+
+def mar_loads(code):
+    # MARH loads that are followed by a full load of A: (isr, index, upper half, lower half)
+    fixups_at = ({}, {})
+    for f in code.fixups:
+        fixups_at[f.isr][f.index] = f
+
+    for isr, words in ((False, code.program), (True, code.isr)):
+        for i in range(len(words) - 4):
+            decoded = [decoded_words[w] for w in words[i:i + 5]]
+            if None in decoded:
+                continue
+
+            names = [d[0] for d in decoded]
+            if names != ['LOADIU', 'LOADIL', 'COPY', 'LOADIU', 'LOADIL']:
+                continue
+
+            if not (decoded[0][1][0] == decoded[1][1][0] == decoded[3][1][0] == decoded[4][1][0] == destination_register_indices['A']):
+                continue
+
+            if decoded[2][1] != (source_register_indices['A'], destination_register_indices['MARH']):
+                continue
+
+            halves = []
+            for j in (i, i + 1):
+                f = fixups_at[isr].get(j)
+                halves.append((f.label, f.start, f.stop) if f else decoded[j - i][1][1])
+
+            yield isr, i, *halves
+
+def half_value(half, labels):
+    # MARH load half -> (value, labels, loaded from a number) like the register flow
+    if type(half) is int:
+        return half, frozenset(), True
+
+    label, start, stop = half
+    return label_slice(labels[label], start, stop), frozenset((label,)), False
+
+def relax(code):
+    """
+    Remove MARH loads of jumps and LOADMARI whose value MARH provably holds already, like jumps within
+    the same 1024 word page as the last one. Every removal moves the code after it, so this repeats until
+    nothing changes. Removed loads are assumed to still load their value when looking for more, and the
+    ones that no longer hold after the labels moved are kept in place and the relaxation starts over.
+    Returns the number of words removed.
+    """
+
+    original = copy.deepcopy(code)
+    pinned = set()      # (isr, original index of the word after the MARH load)
+    fixed_targets = set()
+
+    while True:
+        current = copy.deepcopy(original)
+        origins = (list(range(len(current.program))), list(range(len(current.isr))))
+        relaxed = {}
+        total = 0
+
+        while True:
+            indices = ({o: i for i, o in enumerate(origins[False])}, {o: i for i, o in enumerate(origins[True])})
+
+            assumed = {}
+            for (isr, origin), (hi, lo) in relaxed.items():
+                assumed[isr, indices[isr][origin]] = (half_value(hi, current.labels), half_value(lo, current.labels))
+
+            jump_targets = []
+            before = {(isr, i): registers.get('MARH', UNKNOWN_REGISTER) for isr, i, registers in word_registers(current, jump_targets, assumed, fixed_targets=fixed_targets)}
+            fixed_targets.update(jump_targets)
+
+            # labels moved since these loads were removed
+            broken = {key for key in assumed if key in before and tuple(h[0] for h in before[key]) != tuple(h[0] for h in assumed[key])}
+            if broken:
+                pinned |= {(isr, origins[isr][i]) for isr, i in broken}
+                break
+
+            removed = ([], [])
+            for isr, i, hi, lo in mar_loads(current):
+                key = (isr, origins[isr][i + 3])
+                if key in pinned or (isr, i) not in before:
+                    continue
+
+                if tuple(h[0] for h in before[isr, i]) == (half_value(hi, current.labels)[0], half_value(lo, current.labels)[0]):
+                    removed[isr].extend((i, i + 1, i + 2))
+                    relaxed[key] = (hi, lo)
+
+            if not removed[False] and not removed[True]:
+                vars(code).update(vars(current))
+                return total
+
+            check_fixed_jumps(jump_targets, *removed)
+
+            for isr in (False, True):
+                for i in reversed(removed[isr]):
+                    del origins[isr][i]
+
+            total += len(removed[False]) + len(removed[True])
+            current.remove(*removed)
+
+def source_statements(source_lines):
+    # (index, file, line number, line) of every label and instruction in preprocessed source
+    multi_line_comment_block = False
 
-    else:
-        error(line_number, line, f'"{instruction}" is not a valid instruction')
-        exit(1)
+    for index, (file, line_number, line) in enumerate(source_lines):
+
+        if line.startswith('/*'):
+            multi_line_comment_block = True
+
+        if line.startswith('//') or line.startswith('#') or multi_line_comment_block or not line:
+            if line.endswith('*/'):
+                multi_line_comment_block = False
+            continue # Ignore comments and empty lines
 
+        yield index, file, line_number, line
+
+# Register liveness
+
+LIVENESS_REGISTERS = frozenset(('A', 'B', 'C', 'D', 'SP'))
+
+def register_effect(tokens):
+    # statement -> (registers read, registers overwritten)
+    def registers(*names):
+        return LIVENESS_REGISTERS.intersection(names)
+
+    match tokens[0]:
+        case 'COPY':
+            return registers(tokens[1]), registers(tokens[2])
+        case 'LOADIU' | 'LOADIL':
+            # the other half is kept
+            return frozenset(), frozenset()
+        case 'LOADI' | 'LOADI_SIGNED':
+            return frozenset(), registers(tokens[1])
+        case 'ALUEVAL':
+            return registers('A', tokens[1]), frozenset()
+        case 'ALUSTORER' | 'ALUSTOREF' | 'LOAD':
+            return frozenset(), registers(tokens[1])
+        case 'STORE' | 'OUT' | 'ALUFSETR':
+            return registers(tokens[1]), frozenset()
+        case 'AOP' | 'AOPT':
+            return registers('A'), frozenset()
+        case 'LOADMARI' | 'J' | 'JZ' | 'JN' | 'JC':
+            # A is used for loading MAR
+            return frozenset(), registers('A')
+        case 'STACKPUSH':
+            return registers(tokens[1], 'SP'), registers('SP')
+        case 'STACKPOP':
+            return registers('SP'), registers(tokens[1], 'SP')
+        case 'CALL':
+            # arguments, A, B and C are restored by the call site
+            return registers('C', 'D', 'SP'), frozenset()
+        case 'RETURN':
+            # result, the caller restores its own A, B and C
+            return registers('D', 'SP'), frozenset()
+        case 'HALT' | 'JUMP':
+            # registers are inspected after halting, a jump through MAR may go anywhere
+            return LIVENESS_REGISTERS, frozenset()
+
+    return frozenset(), frozenset()
+
+def call_liveness(source_lines):
+    """
+    Find the registers each CALL has to save, keyed by source line index.
+
+    A CALL preserves A, B and C by pushing them before and popping them after the routine, which is
+    only needed for registers that are read again before being overwritten. Statements are linked to
+    the ones that may run next (the next one, jump targets, nothing after RETURN or HALT), and the
+    registers read later are propagated backwards until nothing changes. An interrupt may run the ISR
+    after any statement, so whatever the ISR reads is live everywhere.
+    """
+
+    statements = []     # (source line index, tokens, section)
+    labels = {}
+    isr = False
+
+    for index, file, line_number, line in source_statements(source_lines):
+        if line.startswith(':'):
+            if line[1:] == 'ISR':
+                isr = True
+            labels[line] = len(statements)
+            continue
 
-if len(label_unassembled_lines) > 0:
-    print('\n\033[36mResolve labels \033[0m')
+        if '//' in line:
+            line = line[:line.index('//')]
 
-# post process label_addresses
-for l in label_unassembled_lines:
-    line_number, original_line_number, original_line, is_isr = l
+        statements.append((index, line.split(), isr))
 
-    output = isr_output if is_isr else program_output
+    successors = []
+    for i, (index, tokens, isr) in enumerate(statements):
+        following = [i + 1] if i + 1 < len(statements) and statements[i + 1][2] == isr else []
+        target = labels.get(tokens[1]) if len(tokens) > 1 else None
 
-    line = output[line_number][1:]  # remove leading '>'
+        match tokens[0]:
+            case 'J':
+                following = [target] if target is not None else None
+            case 'JZ' | 'JN' | 'JC':
+                following = following + [target] if target is not None else None
+            case 'RETURN' | 'HALT':
+                following = []
 
-    # f'>LOADIU A {address}_0_5',
+        successors.append(following)
 
-    for token in line.split():
-        if '_' in token:
-            break
-    
-    label, start_index, stop_index = token.split('_')
+    effects = [register_effect(tokens) for index, tokens, isr in statements]
 
-    if label not in label_addresses:
-        error(original_line_number, original_line, f'unable to resolve label {label}')
+    isr_start = labels.get(':ISR')
+    live_in = [frozenset()] * len(statements)
 
-    line = line.replace(token, label_addresses[label][int(start_index):int(stop_index)])
-    
-    output[line_number] = assemble(line, line.split())
-
-# generate report
-print('\033[36m')
-print('====Memory Layout====')
-print('PROGRAM'.ljust(10), '00000', format(len(program_output) - 1, 'X').zfill(5), f'{len(program_output)} words', sep='\t')
-if len(isr_output) > 0:
-    print('ISR  '.ljust(10), format(Constants.ISR_ADDRESS, 'X').zfill(5), format(Constants.ISR_ADDRESS + len(program_output) - 1, 'X').zfill(5), f'{len(isr_output)} words', sep='\t')
-print('=====================')
-print('\033[0m')
-
-if len(isr_output) > 0:
-    ex = []
-    if len(program_output) > Constants.PROGRAM_MAX_LENGTH:
-        ex.append(f'program code exceeds max size and overlaps with ISR code space by {len(program_output) - Constants.PROGRAM_MAX_LENGTH} words')
-    
-    if len(isr_output) > Constants.ISR_MAX_LENGTH:
-        ex.append(f'ISR code exceeds max size and overlaps with stack space by {len(isr_output) - Constants.ISR_MAX_LENGTH} words!')
-    
-    if ex: error_raw(ex)
-elif len(isr_output) == 0 and len(program_output) > (Constants.PROGRAM_MAX_LENGTH + Constants.ISR_MAX_LENGTH):
-    error_raw(f'program code exceeds max size and overlaps with stack space by {len(program_output) - (Constants.PROGRAM_MAX_LENGTH + Constants.ISR_MAX_LENGTH)} words')
-    pass
+    changed = True
+    while changed:
+        changed = False
+        isr_live = live_in[isr_start] if isr_start is not None and isr_start < len(statements) else frozenset()
 
-# generate output
-output_file = open(output_file_path, 'w')
-output_lines = ['v3.0 hex words addressed\n']
-
-def add_output_lines(output, base_address=0):
-    output_index = 0
-    for i in range(math.ceil(len(output) / 16)):
-        line_number_str = format(base_address + (i * 16), 'X');
-        output_line = line_number_str.zfill(5) + ':'
-    
-        for j in range(16):
-            if output_index >= len(output):
-                output_line += ' 000'
+        for i in reversed(range(len(statements))):
+            following = successors[i]
+            if following is None or not following and statements[i][1][0] not in ('RETURN', 'HALT'):
+                # jump to an unknown address, or running past the end of the section
+                live_out = LIVENESS_REGISTERS
             else:
-                output_line += ' ' + output[output_index]
-                output_index += 1
+                live_out = isr_live.union(*(live_in[j] for j in following))
+
+            read, written = effects[i]
+            live = read | (live_out - written)
+            if live != live_in[i]:
+                live_in[i] = live
+                changed = True
+
+    saves = {}
+    for i, (index, tokens, isr) in enumerate(statements):
+        if tokens[0] == 'CALL':
+            live_out = isr_live.union(*(live_in[j] for j in successors[i])) if successors[i] else LIVENESS_REGISTERS
+            saves[index] = ''.join(r for r in 'ABC' if r in live_out)
+
+    return saves
+
+# Inlining
+
+INLINE_MAX_WORDS = 16   # largest routine body copied into call sites
+
+@dataclass
+class Inlining:
+    # one CALL replaced by -O
+    file: str
+    line_number: int
+    line: str
+    replacement: str    # routine inlined, or the jump a tail call became
+    words: tuple        # (before, after) words at the call site
+    cycles: tuple       # (before, after) from CALL until execution continues after it, not counting the routine
+
+def statement_words(line, tokens, line_number):
+    # native words a statement assembles to, None if it is not valid
+    if tokens[0] in instructions:
+        return 1
+    if tokens[0] not in pseudo_instructions or len(tokens) != pseudo_instructions[tokens[0]][1] + 1:
+        return None
+    return len(pseudo_instructions[tokens[0]][0](line, tokens, line_number, current_ins_address=0, label_addresses={}, call_stubs={}))
+
+def call_words(line, tokens, line_number, call_abi, saved_registers):
+    # (words at the call site, cycles from CALL until execution continues after it), not counting the routine
+    kwargs = dict(current_ins_address=0, label_addresses={}, call_abi=call_abi, call_stubs={}, saved_registers=saved_registers)
+    call = pseudo_assemble_call(line, tokens, line_number, **kwargs)
+    cycles = len(call) + len(pseudo_assemble_return(line, ('RETURN',), line_number, **kwargs))
+    if call_abi == 'compact':
+        cycles += len(call_enter_stub(line, tokens[1], line_number)) + len(return_stub)
+    return len(call), cycles
+
+def leaf_routines(statements):
+    """
+    Find routines which can be copied into their call sites, label -> (labels, body, words, registers written).
+
+    A leaf routine runs from its label straight to a RETURN, calls nothing, leaves the stack alone and
+    only jumps to labels of its own, so a copy with fresh labels behaves the same in place of the CALL.
+    """
+
+    routines = {}
+
+    for start, (index, file, line_number, line, tokens) in enumerate(statements):
+        if not line.startswith(':') or line == ':ISR':
+            continue
+
+        labels = []
+        body = []
+        words = 0
+        written = set()
+        targets = []
+
+        for position in range(start, len(statements)):
+            index, file, line_number, line, tokens = statements[position]
+            if line.startswith(':'):
+                if line == ':ISR':
+                    break
+                labels.append(line)
+                body.append((file, line_number, line, tokens))
+                continue
+
+            instruction = tokens[0]
+            if instruction == 'RETURN':
+                if all(t in labels for t in targets):
+                    routines[labels[0]] = (labels, body, words, written)
+                break
+
+            if instruction in ('CALL', 'JUMP', 'STACKPUSH', 'STACKPOP') or 'SP' in tokens:
+                break
+
+            if instruction in pseudo_jumps:
+                if not tokens[-1].startswith(':'):
+                    break
+                targets.append(tokens[-1])
+
+            count = statement_words(line, tokens, line_number)
+            if count is None:
+                break
+
+            words += count
+            if words > INLINE_MAX_WORDS:
+                break
+
+            written |= register_effect(tokens)[1]
+            if instruction in ('LOADIU', 'LOADIL'):
+                written.add(tokens[1])
+            body.append((file, line_number, line, tokens))
+
+    return routines
+
+def inline_calls(source_lines, call_abi):
+    """
+    Replace CALLs that cost more than the routine they call, returns the new source lines and an Inlining per CALL.
+
+    `CALL :x` followed by `RETURN` becomes `J :x`, the RETURN of the routine then returns straight to
+    the caller of this one. A CALL of a small leaf routine becomes a copy of its body when that is no
+    larger than the CALL, pushing and popping only the registers the body overwrites which are still
+    needed afterwards. Either way the code gets faster, as the routine itself is left in place.
+    """
+
+    statements = []
+    for index, file, line_number, line in source_statements(source_lines):
+        if '//' in line:
+            line = line[:line.index('//')].strip()
+        statements.append((index, file, line_number, line, line.split()))
+
+    routines = leaf_routines(statements)
+    saves = call_liveness(source_lines)
+
+    replaced = {}       # source line index -> new source lines
+    inlined = []
+
+    for i, (index, file, line_number, line, tokens) in enumerate(statements):
+        if tokens[0] != 'CALL' or len(tokens) != 2 or not tokens[1].startswith(':'):
+            continue
+
+        target = tokens[1]
+        saved = saves.get(index, 'ABC') if call_abi == 'inline' else 'ABC'
+        words, cycles = call_words(line, tokens, line_number, call_abi, saved)
+        return_words, return_cycles = call_words(line, tokens, line_number, call_abi, '')
+        return_cycles -= return_words
+
+        following = statements[i + 1] if i + 1 < len(statements) else None
+        if following is not None and following[4] == ['RETURN']:
+            jump = f'J {target}'
+            jump_words = statement_words(jump, jump.split(), line_number)
+            ret = statement_words(following[3], following[4], following[2])
+
+            replaced[index] = [(file, line_number, jump)]
+            replaced[following[0]] = []
+            inlined.append(Inlining(file, line_number, line, jump, (words + ret, jump_words), (cycles + return_cycles, jump_words + return_cycles)))
+            continue
+
+        if target not in routines or index in replaced:
+            continue
+
+        labels, body, body_words, written = routines[target]
+        restore = [r for r in 'ABC' if r in written and r in saved]
+        restore_words = sum(len(pseudo_assemble_stack_push(line, (None, r), line_number)) + len(pseudo_assemble_stack_pop(line, (None, r), line_number))
+                            for r in restore)
+
+        if restore_words + body_words > words:
+            continue
+
+        fresh = {label: f':INTERNAL-inline{index}-{label[1:]}' for label in labels}
+
+        def rename(token):
+            label, _, rest = token.partition('_')
+            return fresh[label] + _ + rest if label in fresh else token
+
+        # labels nothing jumps to would only split basic blocks for the other passes
+        used = {t.partition('_')[0] for entry in body if not entry[2].startswith(':') for t in entry[3]}
+
+        output = [(file, line_number, f'STACKPUSH {r}') for r in restore]
+        for body_file, body_line_number, body_line, body_tokens in body:
+            if body_line.startswith(':') and body_line not in used:
+                continue
+
+            renamed = [rename(t) for t in body_tokens]
+            output.append((body_file, body_line_number, body_line if renamed == body_tokens else ' '.join(renamed)))
+        output += [(file, line_number, f'STACKPOP {r}') for r in reversed(restore)]
+
+        replaced[index] = output
+        inlined.append(Inlining(file, line_number, line, target, (words, restore_words + body_words), (cycles, restore_words + body_words)))
+
+    if not replaced:
+        return source_lines, inlined
+
+    output = []
+    for index, source_line in enumerate(source_lines):
+        output += replaced.get(index, [source_line])
+
+    return output, inlined
+
+# Timing analysis
+#
+# Every native instruction takes one cycle, so the time taken by code only depends on the path
+# through it. Paths are followed over the linked words, with jump targets found by register_flow
+
+@dataclass
+class TimingExit:
+    address: int
+    kind: str           # HALT, return (jump to an address held in registers), leave (jump to the other section) or end
+    cycles: int = None  # worst case from the entry, None when a loop comes first
+
+@dataclass
+class RoutineTiming:
+    name: str
+    address: int
+    exits: list[TimingExit]
+    loops: list[int]    # first address of every loop
+
+    def worst(self, kinds=('HALT', 'return', 'leave', 'end')):
+        # longest path to an exit of one of the kinds, None if unbounded or there are none
+        cycles = [e.cycles for e in self.exits if e.kind in kinds]
+        if not cycles or None in cycles:
+            return None
+        return max(cycles)
+
+@dataclass
+class Timing:
+    labels: dict        # label -> cycles from the label to its first jump or HALT
+    statements: dict    # pseudo instruction -> (fewest, most) words of one use
+    routines: list[RoutineTiming]   # main, ISR and every CALLed routine
+
+def longest(a, b):
+    return None if a is None or b is None else max(a, b)
+
+def timing(program):
+    """
+    Cycle counts of a program assembled with a listing.
+
+    The program starts at address 0 and the ISR at its address. Jumps of CALL statements go to a
+    routine, which runs until it returns and is counted with its worst case. Loops have no known
+    bounds, so paths through them are unbounded.
+    """
+
+    sections = (program.program, program.isr)
+    code = ObjectCode(program.program, program.isr, dict(program.labels or {}), [])
+
+    statements = {address: statement for address, file, line_number, mnemonic, statement in program.listing}
+
+    def decoded_at(address):
+        isr, index = section_index(address)
+        return decoded_words[sections[isr][index]]
+
+    calls = {}      # JUMP address of a CALL -> routine
+    for address, statement in statements.items():
+        decoded = decoded_at(address)
+        tokens = statement.split()
+        if decoded is not None and decoded[0] == 'JUMP' and tokens[0] == 'CALL':
+            calls[address] = tokens[1]
+
+    # nothing is known about registers where a routine returns to
+    returns = {label for label, address in code.labels.items() if address - 1 in calls}
+
+    targets = {}    # JUMP address -> target address, None when held in registers
+    for isr, index, registers in word_registers(code, [], taken=returns):
+        decoded = decoded_words[sections[isr][index]]
+        if decoded is None or decoded[0] != 'JUMP':
+            continue
+
+        marh = registers.get('MARH', UNKNOWN_REGISTER)
+        marl = registers.get('MARL', UNKNOWN_REGISTER)
+        if any(half[0] is None for half in marh + marl):
+            target = None
+        else:
+            target = (((marh[0][0] << 5) | marh[1][0]) << 10) | (marl[0][0] << 5) | marl[1][0]
+        targets[index + (Constants.ISR_ADDRESS if isr else 0)] = target
+
+    def successors(address):
+        # (addresses execution may continue at, exit kind or None)
+        isr, index = section_index(address)
+        following = [address + 1] if index + 1 < len(sections[isr]) else []
+        decoded = decoded_at(address)
+
+        if decoded is None:
+            return following, None if following else 'end'
+
+        name, operands = decoded
+        if name == 'HALT':
+            return [], 'HALT'
+
+        if name != 'JUMP':
+            return following, None if following else 'end'
+
+        conditional = [address + 1] if operands[0] != 0b00 and following else []
+        target = targets.get(address)
+        if target is None:
+            return conditional, 'return'
+        if section_index(target)[0] != isr:
+            return conditional, 'leave'
+        if address in calls:
+            return following, None
+        return [target] + conditional, None
+
+    routines = {}
+    running = set()
+
+    def routine(name, entry):
+        # RoutineTiming from `entry`, a routine CALLing itself is unbounded
+        if entry in routines:
+            return routines[entry]
+
+        running.add(entry)
+
+        edges = {}
+        exits = {}
+        work = [entry]
+        while work:
+            address = work.pop()
+            if address in edges:
+                continue
+            edges[address], kind = successors(address)
+            if kind is not None:
+                exits[address] = kind
+            work += edges[address]
+
+        def cost(address):
+            if address not in calls or targets.get(address) is None:
+                return 1
+
+            target = targets[address]
+            if target in running:
+                return None
+
+            callee = routine(calls[address], target)
+            cycles = callee.worst(('return',))
+            return None if cycles is None else cycles + 1
+
+        # strongly connected components, last ones first
+        components = []
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        for root in edges:
+            if root in index:
+                continue
+
+            work = [(root, iter(edges[root]))]
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(edges[child])))
+                        break
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        low[work[-1][0]] = min(low[work[-1][0]], low[node])
+
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+
+        # longest path, None once a loop was passed
+        before = {entry: 0}
+        cycles = {}
+        routine_loops = []
+        for component in reversed(components):
+            looping = len(component) > 1 or component[0] in edges[component[0]]
+            if looping:
+                routine_loops.append(min(component))
+
+            for node in sorted(component):
+                start = before.get(node)
+                c = cost(node)
+                cycles[node] = None if looping or start is None or c is None else start + c
+
+                for child in edges[node]:
+                    if child not in component:
+                        before[child] = longest(before[child], cycles[node]) if child in before else cycles[node]
+
+        running.discard(entry)
+
+        routines[entry] = RoutineTiming(name, entry, [TimingExit(a, exits[a], cycles[a]) for a in sorted(exits)], sorted(routine_loops))
+        return routines[entry]
+
+    names = {}
+    for label, address in sorted(code.labels.items(), key=lambda l: l[1]):
+        if not label.startswith(':INTERNAL'):
+            names.setdefault(address, label)
+
+    timed = []
+    if len(program.program) > 0:
+        timed.append(routine('main', 0))
+    if len(program.isr) > 0:
+        timed.append(routine(':ISR', Constants.ISR_ADDRESS))
+    for address in sorted(calls):
+        target = targets.get(address)
+        if target is not None and target not in (r.address for r in timed):
+            timed.append(routine(calls[address], target))
+
+    labels = {}
+    for address, label in sorted(names.items()):
+        isr, index = section_index(address)
+        words = sections[isr]
+        if index >= len(words):
+            continue
+
+        end = index
+        while end < len(words) and (decoded_words[words[end]] or ('NOOP',))[0] not in ('JUMP', 'HALT'):
+            end += 1
+        labels[label] = min(end + 1, len(words)) - index
+
+    # one use of a statement is a run of words next to each other, -O inlining copies a routine's statements
+    uses = []   # [statement, address after the run, words]
+    for address, file, line_number, mnemonic, statement in sorted(program.listing, key=lambda l: l[0]):
+        if uses and uses[-1][1] == address and uses[-1][0] == (file, line_number, statement):
+            uses[-1][1] += 1
+            uses[-1][2] += 1
+        else:
+            uses.append([(file, line_number, statement), address + 1, 1])
+
+    pseudo = {}
+    for (file, line_number, statement), end, words in uses:
+        name = statement.split()[0]
+        if name in pseudo_instructions:
+            fewest, most = pseudo.get(name, (words, words))
+            pseudo[name] = (min(fewest, words), max(most, words))
+
+    return Timing(labels, dict(sorted(pseudo.items())), timed)
+
+# Linking
+
+def combine_objects(objects):
+    """
+    Place relocatable objects one after another, returns a single ObjectCode for Assembler.link.
+
+    Program sections follow each other from address 0 and ISR sections from the ISR address, in the
+    order given. Labels and fixups move along with their words. Labels generated by pseudo instructions
+    start with :INTERNAL and are local to their object, every other label is global and must be defined
+    only once.
+    """
+
+    combined = ObjectCode(array('H'), array('H'), {':ISR': Constants.ISR_ADDRESS}, [], [],
+                          call_abi=objects[0].call_abi if objects else 'inline')
+    defined = {}    # global label -> file defining it
+
+    for n, code in enumerate(objects):
+        if code.call_abi != combined.call_abi:
+            error_raw(f'"{code.file}" uses the {code.call_abi} call ABI while "{objects[0].file}" uses {combined.call_abi}, their stack frames are not compatible')
+
+        program_base = len(combined.program)
+        isr_base = len(combined.isr)
+
+        def relocate(address):
+            return address + (isr_base if address >= Constants.ISR_ADDRESS else program_base)
+
+        def rename(label):
+            return f':INTERNAL-o{n}-{label[len(':INTERNAL'):]}' if label.startswith(':INTERNAL') else label
+
+        for label, address in code.labels.items():
+            if label == ':ISR':
+                continue
+
+            label = rename(label)
+            if label in defined:
+                error_raw(f'label {label} is defined in both "{defined[label]}" and "{code.file}"')
+
+            defined[label] = code.file
+            combined.labels[label] = relocate(address)
+
+        for f in code.fixups:
+            combined.fixups.append(dataclasses.replace(f, index=f.index + (isr_base if f.isr else program_base), label=rename(f.label)))
+
+        if combined.listing is not None and code.listing is not None:
+            combined.listing += [(relocate(address), *entry) for address, *entry in code.listing]
+        else:
+            combined.listing = None
+
+        combined.program += code.program
+        combined.isr += code.isr
+        combined.calls += code.calls
+        combined.inlined += code.inlined
+        for name, words in code.optimizations.items():
+            combined.optimizations[name] = combined.optimizations.get(name, 0) + words
+
+    return combined
+
+# Source files
+
+@dataclass
+class SourceFile:
+    # an included file without comments, reused while it is unchanged
+    modified: tuple     # (mtime in ns, size) when read
+    lines: list         # (line number, line)
+    digest: str         # content hash
+    guard: str = None   # macro of an #ifndef guard around the whole file
+
+def strip_comments(lines, stats=None):
+    # (line number, line) of lines that are not empty or comments, trailing comments removed
+    multi_line_comment_block = False
+    line_number = 0
+
+    for line in lines:
+        line_number += 1
+        line = line.strip()
+
+        if line.startswith('/*'):
+            multi_line_comment_block = True
+
+        if line.startswith('//') or multi_line_comment_block or not line:
+            if line.endswith('*/'):
+                multi_line_comment_block = False
+            continue # Ignore comments and empty lines
+
+        # Ignore trailing comments
+        if '//' in line:
+            line = line[:line.index('//')]
+
+        yield line_number, line
+
+    if stats is not None:
+        stats.count('lines read', line_number)
+
+def include_guard(lines):
+    # X of a file wrapped in #ifndef X ... #endif, which has nothing to add once X is defined
+    if not lines or lines[0][1].split()[0] != '#ifndef' or len(lines[0][1].split()) != 2:
+        return None
+
+    depth = 0
+    for i, (line_number, line) in enumerate(lines):
+        directive = line.split()[0]
+
+        if directive in ('#ifdef', '#ifndef'):
+            depth += 1
+        elif directive == '#endif':
+            depth -= 1
+            if depth == 0 and i != len(lines) - 1:
+                return None
+        elif directive == '#else' and depth == 1:
+            return None
+
+    return lines[0][1].split()[1] if depth == 0 else None
+
+# Build statistics
+
+class Stats:
+    """
+    Wall time per build phase and counters, for --stats.
+
+    Phases may nest, the time of an inner phase is only counted for that phase. Preprocessing runs
+    interleaved with assembling as lines are streamed, so it is timed per line through `timed`.
+    """
+
+    def __init__(self):
+        self.phases = {}        # phase -> seconds
+        self.counters = {}
+        self.pseudo_words = {}  # pseudo instruction -> words emitted
+        self.running = []       # [phase, start, seconds spent in inner phases]
+
+    def start(self, name):
+        self.running.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        name, start, inner = self.running.pop()
+        elapsed = time.perf_counter() - start
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed - inner
+        if self.running:
+            self.running[-1][2] += elapsed
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def timed(self, name, iterator):
+        iterator = iter(iterator)
+        while True:
+            self.start(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def maximum(self, name, value):
+        self.counters[name] = max(self.counters.get(name, 0), value)
+
+    def as_dict(self):
+        return {
+            'phases': self.phases,
+            'counters': self.counters,
+            'pseudo_words': self.pseudo_words,
+        }
+
+    def merge(self, other):
+        # add up the stats of another build, a dict from as_dict
+        for name, seconds in other['phases'].items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        for name, value in other['counters'].items():
+            if name in MAXIMUM_COUNTERS:
+                self.maximum(name, value)
+            else:
+                self.count(name, value)
+        for name, words in other['pseudo_words'].items():
+            self.pseudo_words[name] = self.pseudo_words.get(name, 0) + words
+
+MAXIMUM_COUNTERS = ('include depth',)
+
+def print_stats(stats):
+    print('\033[36m')
+    print('=====Build Stats=====')
+    for name, seconds in stats.phases.items():
+        print(name.upper().ljust(10), f'{seconds * 1000:.2f} ms', sep='\t')
+    print('TOTAL'.ljust(10), f'{sum(stats.phases.values()) * 1000:.2f} ms', sep='\t')
+    print('=====================')
+    for name, value in stats.counters.items():
+        print(name.ljust(24), value, sep='\t')
+    if stats.pseudo_words:
+        print('=====================')
+        for name, words in sorted(stats.pseudo_words.items(), key=lambda i: -i[1]):
+            print(name.ljust(24), f'{words} words', sep='\t')
+    print('\033[0m')
+
+def write_stats(stats, output_file_path):
+    with open(output_file_path, 'w') as output_file:
+        json.dump({'version': VERSION, **stats.as_dict()}, output_file, indent=4)
+
+# Build cache
+
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def hashed_lines(lines, digest):
+    # pass lines through while hashing them, same as content_hash of the whole text
+    for line in lines:
+        digest.update(line.encode())
+        yield line
+
+def default_cache_directory():
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'rochoyita'
+
+class BuildCache:
+    """
+    On disk cache of assembled programs, one JSON file per translation unit.
+
+    An entry is named after a hash of everything the result depends on that is known before reading
+    any include: the assembler version, the input file and its contents, defines, include paths and
+    options. Included files are only known after preprocessing, so the entry records the hash of every
+    file that was read and is discarded when any of them changed. The least recently used entries are
+    removed once the directory grows past `max_size` bytes.
+    """
+
+    def __init__(self, directory=None, max_size=CACHE_MAX_SIZE):
+        self.directory = Path(directory) if directory is not None else default_cache_directory()
+        self.max_size = max_size
+
+    def key(self, assembler, file, source):
+        return content_hash(json.dumps([
+            VERSION,
+            file,
+            str(Path(file).resolve()) if Path(file).is_file() else None,
+            content_hash(source),
+            sorted(assembler.defines.items()),
+            [str(p.resolve()) for p in assembler.include_paths],
+            assembler.raw,
+            assembler.listing,
+            assembler.optimize,
+            assembler.call_abi,
+        ]))
+
+    def path(self, key):
+        return self.directory / f'{key}.json'
+
+    def load(self, key):
+        path = self.path(key)
+
+        try:
+            with open(path, 'r') as entry_file:
+                entry = json.load(entry_file)
+
+            for file, digest in entry['dependencies'].items():
+                with open(file, 'r') as dependency:
+                    if content_hash(dependency.read()) != digest:
+                        return None
+
+            program = Program(
+                decode_words(entry['program']),
+                decode_words(entry['isr']),
+                [tuple(l) for l in entry['listing']] if entry['listing'] is not None else None,
+                entry['optimizations'],
+                [CallCost(**c) for c in entry['calls']],
+                [Inlining(**c) for c in entry['inlined']],
+                entry['labels'],
+            )
+            for c in program.calls + program.inlined:
+                c.words = tuple(c.words)
+                c.cycles = tuple(c.cycles)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        # most recently used
+        os.utime(path)
+
+        return program
+
+    def store(self, key, dependencies, program):
+        entry = {
+            'version': VERSION,
+            'dependencies': dependencies,
+            'program': encode_words(program.program),
+            'isr': encode_words(program.isr),
+            'listing': program.listing,
+            'optimizations': program.optimizations,
+            'calls': [asdict(c) for c in program.calls],
+            'inlined': [asdict(c) for c in program.inlined],
+            'labels': program.labels,
+        }
+
+        path = self.path(key)
+        temporary = path.with_suffix(f'.{os.getpid()}.tmp')
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(temporary, 'w') as entry_file:
+                json.dump(entry, entry_file, separators=(',', ':'))
+            os.replace(temporary, path)
+        except OSError:
+            # a cache that cannot be written only makes the next build slower
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(e[1] for e in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            size -= entry_size
+
+def encode_words(words):
+    return base64.b64encode(words.tobytes()).decode()
+
+def decode_words(text):
+    words = array('H')
+    words.frombytes(base64.b64decode(text))
+    return words
+
+class Assembler:
+    """
+    Assembles Sutra-1 source into program and ISR memory images.
+
+    All state lives on the instance, so one process can assemble any number of programs back to back.
+    """
+
+    def __init__(self, defines=None, include_paths=(), raw=False, verbosity=Verbosity.SILENT, listing=False, optimize=False, call_abi='inline', cache=None, sources=None, stats=None):
+        self.defines = dict(defines) if defines else {}
+        self.include_paths = [Path(p) for p in include_paths]
+        self.raw = raw
+        self.verbosity = verbosity
+        self.listing = listing
+        self.optimize = optimize
+        self.call_abi = call_abi
+        self.cache = cache      # BuildCache, or None
+        self.sources = sources if sources is not None else {}  # resolved path -> SourceFile, may be shared by assemblers
+        self.stats = stats      # Stats, or None
+
+    def phase(self, name):
+        return self.stats.phase(name) if self.stats is not None else contextlib.nullcontext()
+
+    def begin(self):
+        # state of one build
+        self.macros = Macros(self.defines, count=self.stats is not None)
+        self.dependencies = {}      # file read from disk -> content hash
+        self.include_depth = 0
+        self.once = set()           # resolved paths of files with #pragma once
+
+    def preprocessed(self, file, source):
+        source_lines = self.preprocess(file, source)
+        return self.stats.timed('preprocess', source_lines) if self.stats is not None else source_lines
+
+    def count_preprocessed(self):
+        if self.stats is not None:
+            self.stats.count('files read', len(self.dependencies))
+            self.stats.count('macro substitutions', self.macros.substitutions)
+
+    def resolve_include(self, file, file_path):
+        # relative to the including file first, then the include search paths
+        candidates = [Path(file).resolve().parent if file else Path.cwd()] + self.include_paths
+
+        for directory in candidates:
+            path = directory / file_path
+            if path.is_file():
+                return str(path)
+
+        return f'{candidates[0]}{os.sep}{file_path}'
+
+    # pre process
+
+    def preprocess(self, file, source=None):
+        """
+        Generate (file, line number, line) for every line that reaches the assembler.
+
+        Lines of the input file are produced as they are read, so it is never held in memory. Included
+        files are kept in `sources` instead, since they are usually small and included again.
+        """
+
+        if source is None:
+            if not Path(file).is_file():
+                error_raw(f'input file "{file}" not found!')
+
+            digest = hashlib.sha256()
+            with open(file, 'r') as source_file:
+                yield from self.preprocess_lines(file, strip_comments(hashed_lines(source_file, digest), self.stats))
+
+            self.dependencies[file] = digest.hexdigest()
+            return
+
+        yield from self.preprocess_lines(file, strip_comments(source.splitlines(), self.stats))
+
+    def source_file(self, file):
+        if not Path(file).is_file():
+            error_raw(f'input file "{file}" not found!')
+
+        path = os.path.realpath(file)
+        stat = os.stat(path)
+        modified = (stat.st_mtime_ns, stat.st_size)
+
+        source = self.sources.get(path)
+        if source is not None and source.modified == modified:
+            if self.stats is not None:
+                self.stats.count('include cache hits')
+            return source
+
+        with open(path, 'r') as source_file:
+            text = source_file.read()
+
+        lines = list(strip_comments(text.splitlines(), self.stats))
+        source = self.sources[path] = SourceFile(modified, lines, content_hash(text), include_guard(lines))
+
+        return source
+
+    def include(self, file):
+        source = self.source_file(file)
+        self.dependencies[file] = source.digest
+
+        if os.path.realpath(file) in self.once or (source.guard is not None and source.guard in self.macros):
+            if self.stats is not None:
+                self.stats.count('includes skipped')
+            return
+
+        yield from self.preprocess_lines(file, source.lines)
+
+    def preprocess_lines(self, file, lines):
+        # lines are (line number, line) without comments
+        extension = Path(file).suffix
+        if not extension.upper() != 'S':
+            error_raw(f'invalid file extension "{extension}". only .s and .S files are supported')
+
+        macros = self.macros
+
+        branched_ignore = []
+
+        for line_number, line in lines:
+            if line.startswith('#'):
+                if (extension == 's' and os.name != 'nt') or self.raw:
+                    error(line_number, line, f'preprocessor is not allowed in raw .s mode')
+
+                space_index = line.find(' ')            
+                directive = (line[1:] if space_index == -1 else line[1:space_index])
+
+                if directive == 'define': 
+                    tokens = line.split() 
+                    if len(tokens) != 3:
+                        error(line_number, line, f'"{line}" is not a valid #define statement')
+
+                    macros.define(tokens[1], tokens[2])
+                elif directive == 'undef':
+                    tokens = line.split()
+
+                    if len(tokens) != 2:
+                        error(line_number, line, f'"{line}" is not a valid #undef statement')
+
+                    key = tokens[1]
+                    if not macros.undef(key):
+                        error(line_number, line, f'"{key}" is not defined')
+                elif directive == 'include':
+                    l_index = line.find('"')
+                    r_index = line.rfind('"')
+                    if l_index == -1 or r_index == -1:
+                        error(line_number, line, f'"{line}" is not a valid #include statement')
+
+                    file_path = line[l_index + 1:r_index]
+
+                    if self.verbosity >= Verbosity.FULL:
+                        print('\033[36mINCLUDE'.ljust(15), f'"{file_path}"', sep='\t')
+
+                    self.include_depth += 1
+                    if self.stats is not None:
+                        self.stats.maximum('include depth', self.include_depth)
+
+                    yield from self.include(self.resolve_include(file, file_path))
+                    self.include_depth -= 1
+                elif directive == 'pragma':
+                    if line.split()[1:] != ['once']:
+                        error(line_number, line, 'unknown #pragma')
+
+                    self.once.add(os.path.realpath(file))
+                elif directive == 'ifdef' or directive == 'ifndef':
+                    tokens = line.split()
+
+                    if len(tokens) != 2:
+                        error(line_number, line, f'"{line}" is not a valid #ifdef statement')
+
+                    key = tokens[1]
+
+                    branched_ignore.append((key not in macros) if directive == 'ifdef' else (key in macros))
+                elif directive == 'endif':
+                    if len(branched_ignore) == 0:
+                        error(line_number, line, f'"{line}" is not a valid #endif statement. not in a conditional block')
+                    branched_ignore.pop()
+
+                elif directive == 'else':
+                    if len(branched_ignore) == 0:
+                        error(line_number, line, f'invalid #else placement. not in a conditional block')
+
+                    branched_ignore[-1] = not branched_ignore[-1]
+                else:
+                    error(line_number, line, f'invalid preprocessor directive')
+            else:
+                line = macros.expand(line)
+
+                if len(branched_ignore) == 0 or not branched_ignore[-1]:
+                    yield file, line_number, line
+
+    # assemble
+
+    def assemble(self, source, file='<source>'):
+        """
+        Assemble source text. Include paths are resolved relative to `file`.
+        """
+
+        self.begin()
+
+        key = None
+        if self.cache is not None:
+            with self.phase('cache'):
+                if source is None and Path(file).is_file():
+                    with open(file, 'r') as source_file:
+                        source = source_file.read()
+
+                    self.dependencies[file] = content_hash(source)
+
+                if source is not None:
+                    key = self.cache.key(self, file, source)
+                    program = self.cache.load(key)
+
+            if key is not None and program is not None:
+                if self.verbosity >= Verbosity.FULL:
+                    print('\033[36mCACHED'.ljust(15), f'"{file}"', '\033[0m', sep='\t')
+                if self.stats is not None:
+                    self.stats.count('cache hits')
+                return program
+
+        program = self.assemble_lines(self.preprocessed(file, source))
+        self.count_preprocessed()
+
+        if key is not None:
+            with self.phase('cache'):
+                self.cache.store(key, self.dependencies, program)
+
+        return program
+
+    def assemble_file(self, file):
+        return self.assemble(None, str(file))
+
+    def assemble_object(self, source, file='<source>'):
+        """
+        Assemble source text into relocatable ObjectCode, whose labels are resolved by link_objects.
+        """
+
+        self.begin()
+
+        code = self.compile_lines(self.preprocessed(file, source))
+        code.file = file
+        self.count_preprocessed()
+
+        return code
+
+    def link_objects(self, objects):
+        """
+        Link ObjectCode from assemble_object or read_object, in order, into a program.
+        """
+
+        with self.phase('link'):
+            code = combine_objects(objects)
+
+        if self.optimize:
+            # addresses are only final once all objects are placed
+            with self.phase('optimize'):
+                code.optimizations['relax'] = relax(code)
+
+        return self.link(code)
+
+    def assemble_lines(self, source_lines):
+        code = self.compile_lines(source_lines)
+
+        if self.optimize:
+            with self.phase('optimize'):
+                code.optimizations['relax'] = relax(code)
+
+        return self.link(code)
+
+    def compile_lines(self, source_lines):
+        # source lines are only held in memory for the optimizations looking at all of them
+        optimizations = {}
+
+        inlined = []
+        call_saves = {}
+        if self.optimize:
+            source_lines = list(source_lines)
+
+            with self.phase('optimize'):
+                source_lines, inlined = inline_calls(source_lines, self.call_abi)
+
+                if self.call_abi == 'inline':
+                    call_saves = call_liveness(source_lines)
+                    optimizations['liveness'] = sum(len(pseudo_assemble_stack_push(None, (None, r), None)) + len(pseudo_assemble_stack_pop(None, (None, r), None))
+                                                    for saved in call_saves.values() for r in 'ABC' if r not in saved)
+
+        with self.phase('assemble'):
+            code = self.assemble_code(source_lines, call_saves)
+
+        if self.optimize:
+            with self.phase('optimize'):
+                optimizations['peephole'] = peephole(code)
+
+        code.optimizations = optimizations
+        code.inlined = inlined
+        code.call_abi = self.call_abi
+
+        return code
+
+    def assemble_code(self, source_lines, call_saves={}):
+        program_output = array('H')
+        isr_output = array('H')
+        label_addresses = {
+            ':ISR': Constants.ISR_ADDRESS
+        }
+        fixups = []
+
+        trace = self.verbosity >= Verbosity.FULL
+        listing = [] if self.listing else None
+
+        # mnemonic -> word, pseudo instruction expansions repeat the same few mnemonics
+        encoded = {}
+        encoded_fixups = {}
+
+        call_stubs = {}     # label -> (line, line number, address) of the first use
+        calls = []
+
+        native_instructions = 0
+        pseudo_count = 0
+        pseudo_words = {}   # pseudo instruction -> words emitted
+
+        isr_being_processed = False
+        output = program_output
+
+        def emit(m, file, line_number, line, statement=None):
+            if listing is not None:
+                listing.append((len(output) + (Constants.ISR_ADDRESS if isr_being_processed else 0), file, line_number, m.lstrip('>'), statement or line))
+
+            if m[0] == '>':
+                if trace:
+                    print('\033[32mASSEMBLE LATER'.ljust(15), m.ljust(20), '\033[0m', sep='\t')
+
+                fixup = encoded_fixups.get(m)
+                if fixup is None:
+                    fixup = encoded_fixups[m] = parse_fixup(m, line_number)
+
+                word, label, start_index, stop_index, shift = fixup
+                fixups.append(Fixup(isr_being_processed, len(output), label, start_index, stop_index, shift, m[1:], line_number, line))
+                output.append(word)
+            else:
+                word = encoded.get(m)
+                if word is None:
+                    word = encoded[m] = assemble_mnemonic(m, m.split(), None)
+
+                output.append(word)
+                if trace:
+                    trace_assemble(m, output[-1])
+
+        for index, file, line_number, line in source_statements(source_lines):
+            current_ins_address = len(output) + (Constants.ISR_ADDRESS if isr_being_processed else 0)
+
+            if line.startswith(':'):
+                if re.search(r'[\s_]', line):
+                    error(line_number, line, f'invalid label "{line}". It MUST not contain whitespace or "_"')
+
+                if line[1:] == 'ISR':
+                    # move all further lines to ISR address
+                    isr_being_processed = True
+                    output = isr_output
+                    if trace:
+                        print(f'\033[35mISR'.ljust(15), line.ljust(10), format(Constants.ISR_ADDRESS, 'X').zfill(4), '\033[0m', sep='\t')
+                else:
+                    label_addresses[line] = current_ins_address
+                    if trace:
+                        print(f'\033[35mLABEL'.ljust(15), line.ljust(10), format(current_ins_address, 'X').zfill(4), str(current_ins_address).ljust(5), '\033[0m', sep='\t')
+                
+                continue # Ignore label
+
+            # Ignore trailing comments
+            if '//' in line:
+                line = line[:line.index('//')]
+
+            tokens = line.split()
+            instruction = tokens[0]
             
-        output_lines.append(output_line + '\n')
+            if instruction in instructions:
+                if listing is not None:
+                    listing.append((current_ins_address, file, line_number, line, line))
+
+                word = encoded.get(line)
+                if word is None:
+                    word = encoded[line] = assemble_mnemonic(line, tokens, line_number)
+
+                output.append(word)
+                native_instructions += 1
+                if trace:
+                    trace_assemble(line, output[-1])
+            elif instruction in pseudo_instructions:
+                # TODO: use placeholders for colours
+                if trace:
+                    print('\033[33mPSEUDO'.ljust(15), line.ljust(20), '\033[0m', sep='\t')
+
+                max_length = pseudo_instructions[instruction][1] + 1
+                if len(tokens) != max_length:
+                    error(line_number, line, f'invalid {tokens[0]} syntax')
+
+                output_mnemonics = pseudo_instructions[instruction][0](line, tokens, line_number, current_ins_address=current_ins_address, label_addresses=label_addresses, call_abi=self.call_abi, call_stubs=call_stubs, saved_registers=call_saves.get(index, 'ABC'))
+
+                if instruction == 'CALL':
+                    calls.append(call_cost(file, line, tokens, line_number))
+
+                pseudo_count += 1
+                pseudo_words[instruction] = pseudo_words.get(instruction, 0) + len(output_mnemonics)
+
+                for m in output_mnemonics:
+                    emit(m, file, line_number, line)
+
+            else:
+                error(line_number, line, f'"{instruction}" is not a valid instruction')
+
+        # shared compact CALL/RETURN stubs go after the program
+        isr_being_processed = False
+        output = program_output
+
+        for label, (line, line_number, address) in call_stubs.items():
+            label_addresses[label] = len(output)
+            if trace:
+                print(f'\033[35mLABEL'.ljust(15), label.ljust(10), format(len(output), 'X').zfill(4), str(len(output)).ljust(5), '\033[0m', sep='\t')
+
+            for m in (call_enter_stub(line, address, line_number) if address else return_stub):
+                emit(m, label, line_number, line, label)
+
+        if self.stats is not None:
+            self.stats.count('native instructions', native_instructions)
+            self.stats.count('pseudo instructions', pseudo_count)
+            for name, words in pseudo_words.items():
+                self.stats.pseudo_words[name] = self.stats.pseudo_words.get(name, 0) + words
+            self.stats.count('words emitted', len(program_output) + len(isr_output))
+
+        return ObjectCode(program_output, isr_output, label_addresses, fixups, listing, calls)
+
+    def link(self, code):
+        program_output = code.program
+        isr_output = code.isr
+
+        if len(code.fixups) > 0 and self.verbosity >= Verbosity.FULL:
+            print('\n\033[36mResolve labels \033[0m')
+
+        with self.phase('link'):
+            self.resolve_fixups(code.fixups, code.labels, program_output, isr_output, self.verbosity >= Verbosity.FULL)
+
+        if self.stats is not None:
+            self.stats.count('labels', len(code.labels) - 1)
+            self.stats.count('fixups resolved', len(code.fixups))
+
+        if len(isr_output) > 0:
+            ex = []
+            if len(program_output) > Constants.PROGRAM_MAX_LENGTH:
+                ex.append(f'program code exceeds max size and overlaps with ISR code space by {len(program_output) - Constants.PROGRAM_MAX_LENGTH} words')
+            
+            if len(isr_output) > Constants.ISR_MAX_LENGTH:
+                ex.append(f'ISR code exceeds max size and overlaps with stack space by {len(isr_output) - Constants.ISR_MAX_LENGTH} words!')
+            
+            if ex: error_raw(*ex)
+        elif len(isr_output) == 0 and len(program_output) > (Constants.PROGRAM_MAX_LENGTH + Constants.ISR_MAX_LENGTH):
+            error_raw(f'program code exceeds max size and overlaps with stack space by {len(program_output) - (Constants.PROGRAM_MAX_LENGTH + Constants.ISR_MAX_LENGTH)} words')
+
+        return Program(program_output, isr_output, code.listing, code.optimizations, code.calls, code.inlined, code.labels)
+
+    def resolve_fixups(self, fixups, label_addresses, program_output, isr_output, trace=False):
+        for f in fixups:
+            address = label_addresses.get(f.label)
+            if address is None:
+                error(f.line_number, f.line, f'unable to resolve label {f.label}')
+
+            output = isr_output if f.isr else program_output
+            output[f.index] |= label_slice(address, f.start, f.stop) << f.shift
+
+            if trace:
+                trace_assemble(f.mnemonic, output[f.index])
+
+def trace_assemble(line, word):
+    print('\033[32mASSEMBLE'.ljust(15), line.ljust(25), format(word, 'b').zfill(10), format(word, 'X').zfill(3) + '\033[0m', sep='\t')
+
+def assemble(source, defines=None, include_paths=(), raw=False, file='<source>', **kwargs):
+    """
+    Assemble Sutra-1 source text and return the program and ISR images as arrays of 10-bit words.
+    """
+
+    return Assembler(defines, include_paths, raw, **kwargs).assemble(source, file)
+
+def assemble_file(file, defines=None, include_paths=(), raw=False, **kwargs):
+    return Assembler(defines, include_paths, raw, **kwargs).assemble_file(file)
+
+def assemble_object(source, defines=None, include_paths=(), raw=False, file='<source>', **kwargs):
+    return Assembler(defines, include_paths, raw, listing=True, **kwargs).assemble_object(source, file)
+
+def link_objects(objects, **kwargs):
+    return Assembler(**kwargs).link_objects(objects)
+
+def build(assembler, input_file_path, compile=False, link=()):
+    # an object file from -c, a program linked with objects, or a program
+    p = Path(input_file_path)
+
+    if compile:
+        return assembler.assemble_object(None, input_file_path)
+
+    if link or p.suffix == '.o':
+        objects = [read_object(input_file_path) if p.suffix == '.o' else assembler.assemble_object(None, input_file_path)]
+        objects += [read_object(o) for o in link]
+        return assembler.link_objects(objects)
+
+    return assembler.assemble_file(input_file_path)
+
+def write_output(program, output_file_path, listing_file_path=None, compile=False, debug_map_file_path=None):
+    if compile:
+        write_object(program, output_file_path)
+    else:
+        write_hex(program, output_file_path)
+
+    if listing_file_path:
+        write_listing(program, listing_file_path)
+
+    if debug_map_file_path:
+        write_debug_map(program, debug_map_file_path)
+
+# Batch assembly
+
+@dataclass
+class BatchResult:
+    input: str
+    output: str
+    error: tuple = None     # AssemblerError text
+    program_words: int = 0
+    isr_words: int = 0
+    seconds: float = 0
+    stats: dict = None      # Stats.as_dict() with --stats
+
+batch_sources = None    # include files shared by every build in a worker process
+
+def batch_worker_init():
+    global batch_sources
+    batch_sources = {}
+
+def batch_assemble(input_file_path, output_file_path, listing_file_path, debug_map_file_path, compile, link, assembler_args, assembler_kwargs, stats=False):
+    start = time.perf_counter()
+    stats = Stats() if stats else None
+    assembler = Assembler(*assembler_args, **assembler_kwargs, sources=batch_sources, stats=stats)
+
+    try:
+        program = build(assembler, input_file_path, compile, link)
+        with assembler.phase('output'):
+            write_output(program, output_file_path, listing_file_path, compile, debug_map_file_path)
+    except AssemblerError as e:
+        return BatchResult(input_file_path, output_file_path, e.text, seconds=time.perf_counter() - start)
+    except OSError as e:
+        return BatchResult(input_file_path, output_file_path, (str(e),), seconds=time.perf_counter() - start)
+
+    return BatchResult(input_file_path, output_file_path, None, len(program.program), len(program.isr), time.perf_counter() - start,
+                       stats.as_dict() if stats else None)
+
+def batch(tasks, jobs=None):
+    """
+    Run batch_assemble for every task, a tuple of its arguments, returns a BatchResult per task in order.
+
+    Programs are independent, so they are spread over a pool of `jobs` processes (one per CPU by
+    default). Each worker keeps the include files it read, so a library included by many programs is
+    read once per worker instead of once per program.
+    """
+
+    if jobs == 1 or len(tasks) <= 1:
+        batch_worker_init()
+        return [batch_assemble(*t) for t in tasks]
+
+    with ProcessPoolExecutor(jobs, initializer=batch_worker_init) as pool:
+        return list(pool.map(batch_assemble, *zip(*tasks), chunksize=max(1, len(tasks) // (4 * (jobs or os.cpu_count() or 1)))))
+
+def print_batch_report(results, seconds, jobs):
+    print('\033[36m')
+    print('====Batch  Report====')
+    for r in results:
+        status = 'FAILED' if r.error else f'{r.program_words} + {r.isr_words} words'
+        print(Path(r.input).name.ljust(20), status.ljust(20), f'{r.seconds * 1000:.1f} ms', sep='\t')
+    print('=====================')
+
+    failed = [r for r in results if r.error]
+    print(f'{len(results) - len(failed)} built, {len(failed)} failed in {seconds:.2f} s ({sum(r.seconds for r in results):.2f} s of work with -j {jobs})')
+    print('\033[0m')
+
+    for r in failed:
+        print('\033[1;31m' + r.input + '\033[0m')
+        print('\n'.join(r.error))
+
+# generate output
+
+hex_words = [format(w, 'X').zfill(3) for w in range(1024)]
+
+HEX_ROW_LENGTH = 16
+
+def hex_lines(output, base_address=0):
+    # Logisim Evolution v3.0 addressed rows. Repeated words are run length encoded as N*value and
+    # zero runs of a row or more are skipped, since memory that is not addressed is zero.
+    address = base_address
+    row_address = address
+    row = []
+
+    for word, run in itertools.groupby(output):
+        count = sum(1 for _ in run)
+
+        if word == 0 and count >= HEX_ROW_LENGTH:
+            if row:
+                yield f'{format(row_address, 'X').zfill(5)}: {' '.join(row)}\n'
+                row = []
+
+            address += count
+            continue
+
+        if not row:
+            row_address = address
+
+        row.append(hex_words[word] if count == 1 else f'{count}*{hex_words[word]}')
+        address += count
+
+        if len(row) == HEX_ROW_LENGTH:
+            yield f'{format(row_address, 'X').zfill(5)}: {' '.join(row)}\n'
+            row = []
+
+    # trailing zeros need not be written
+    while row and row[-1].rpartition('*')[2] == hex_words[0]:
+        row.pop()
+
+    if row:
+        yield f'{format(row_address, 'X').zfill(5)}: {' '.join(row)}\n'
+
+def write_hex(program, output_file_path):
+    # rows are streamed to the file instead of being collected first
+    with open(output_file_path, 'w') as output_file:
+        output_file.write('v3.0 hex words addressed\n')
+
+        for line in hex_lines(program.program):
+            output_file.write(line)
+
+        for line in hex_lines(program.isr, Constants.ISR_ADDRESS):
+            output_file.write(line)
+
+def write_listing(program, output_file_path):
+    output_lines = ['address\thex\tbinary\tfile\tline\tinstruction\n']
+
+    for address, file, line_number, mnemonic, statement in program.listing:
+        word = program.isr[address - Constants.ISR_ADDRESS] if address >= Constants.ISR_ADDRESS else program.program[address]
+        output_lines.append(f'{format(address, 'X').zfill(5)}\t{hex_words[word]}\t{format(word, 'b').zfill(10)}\t{file}\t{line_number}\t{mnemonic}\n')
+
+    with open(output_file_path, 'w') as output_file:
+        output_file.write(''.join(output_lines))
+
+DEBUG_MAP_FORMAT = 'rochoyita debug map'
+
+def debug_map(program):
+    '''
+    Address to source statement map of a program assembled with a listing, as JSON data.
+
+    Consecutive words of one statement are a single range [address, words, file, line, statement],
+    file being an index of `files`. Labels generated by the assembler are left out, except the ones
+    of shared CALL/RETURN stubs.
+    '''
+
+    files = {}
+    ranges = []
+    for address, file, line_number, mnemonic, statement in sorted(program.listing, key=lambda l: l[0]):
+        index = files.setdefault(file, len(files))
+        last = ranges[-1] if ranges else None
+        if last and last[0] + last[1] == address and last[2:] == [index, line_number, statement.strip()]:
+            last[1] += 1
+        else:
+            ranges.append([address, 1, index, line_number, statement.strip()])
+
+    labels = {label: address for label, address in (program.labels or {}).items()
+              if not label.startswith(':INTERNAL') or re.match(r':INTERNAL(-o\d+-)?-(enter-|return)', label)}
+
+    return {
+        'format': DEBUG_MAP_FORMAT,
+        'version': VERSION,
+        'files': list(files),
+        'labels': labels,
+        'ranges': ranges,
+    }
+
+def write_debug_map(program, output_file_path):
+    with open(output_file_path, 'w') as output_file:
+        json.dump(debug_map(program), output_file, separators=(',', ':'))
+
+OBJECT_FORMAT = 'rochoyita object'
+
+def write_object(code, output_file_path):
+    with open(output_file_path, 'w') as output_file:
+        json.dump({
+            'format': OBJECT_FORMAT,
+            'version': VERSION,
+            'file': code.file,
+            'call_abi': code.call_abi,
+            'program': encode_words(code.program),
+            'isr': encode_words(code.isr),
+            'labels': code.labels,
+            'fixups': [asdict(f) for f in code.fixups],
+            'listing': code.listing,
+            'optimizations': code.optimizations,
+            'calls': [asdict(c) for c in code.calls],
+            'inlined': [asdict(c) for c in code.inlined],
+        }, output_file, separators=(',', ':'))
+
+def read_object(file):
+    try:
+        with open(file, 'r') as object_file:
+            entry = json.load(object_file)
+    except (OSError, ValueError):
+        error_raw(f'unable to read object file "{file}"')
+
+    if not isinstance(entry, dict) or entry.get('format') != OBJECT_FORMAT:
+        error_raw(f'"{file}" is not a rochoyita object file')
+
+    if entry['version'] != VERSION:
+        error_raw(f'"{file}" was assembled by rochoyita version {entry['version']}, reassemble it with version {VERSION}')
+
+    code = ObjectCode(
+        decode_words(entry['program']),
+        decode_words(entry['isr']),
+        entry['labels'],
+        [Fixup(**f) for f in entry['fixups']],
+        [tuple(l) for l in entry['listing']] if entry['listing'] is not None else None,
+        [CallCost(**c) for c in entry['calls']],
+        entry['optimizations'],
+        [Inlining(**c) for c in entry['inlined']],
+        entry['call_abi'],
+        entry['file'],
+    )
+    for c in code.calls + code.inlined:
+        c.words = tuple(c.words)
+        c.cycles = tuple(c.cycles)
+
+    return code
+
+def print_memory_layout(program):
+    program_output = program.program
+    isr_output = program.isr
+
+    print('\033[36m')
+    print('====Memory Layout====')
+    print('PROGRAM'.ljust(10), '00000', format(len(program_output) - 1, 'X').zfill(5), f'{len(program_output)} words', sep='\t')
+    if len(isr_output) > 0:
+        print('ISR  '.ljust(10), format(Constants.ISR_ADDRESS, 'X').zfill(5), format(Constants.ISR_ADDRESS + len(isr_output) - 1, 'X').zfill(5), f'{len(isr_output)} words', sep='\t')
+    print('=====================')
+
+    for name, words in program.optimizations.items():
+        print(name.upper().ljust(10), f'{words} words removed', sep='\t')
+
+    if program.inlined:
+        print('=====INLINING======')
+        for c in program.inlined:
+            print(f'{Path(c.file).name}:{c.line_number}'.ljust(10), c.line.ljust(20), c.replacement.ljust(20), f'{c.words[0]} -> {c.words[1]} words', f'{c.cycles[0]} -> {c.cycles[1]} cycles', sep='\t')
+
+    if program.calls:
+        print('=====CALL  ABI=====')
+        print('inline -> compact, excluding shared stubs and -O')
+        for c in program.calls:
+            print(f'{Path(c.file).name}:{c.line_number}'.ljust(10), c.line.ljust(20), f'{c.words[0]} -> {c.words[1]} words', f'{c.cycles[0]} -> {c.cycles[1]} cycles', sep='\t')
+
+        stubs = len({c.stub for c in program.calls}) * len(call_enter_stub(None, ':routine', None)) + len(return_stub)
+        print('STUBS'.ljust(10), f'{stubs} words shared by compact calls', sep='\t')
+
+    print('\033[0m')
+
+def print_timing(timing, program):
+    sources = {address: f'{Path(file).name}:{line_number}' for address, file, line_number, mnemonic, statement in program.listing}
+
+    def where(address):
+        return f'{format(address, 'X').zfill(5)} {sources.get(address, '')}'.ljust(20)
+
+    def cycles(c):
+        return 'unbounded' if c is None else f'{c} cycle{'s' if c != 1 else ''}'
+
+    print('\033[36m')
+    print('=======Timing========')
+    print('straight line from the label to its first jump or HALT')
+    for label, c in timing.labels.items():
+        print(label.ljust(20), cycles(c), sep='\t')
+
+    if timing.statements:
+        print('======Pseudo ops=====')
+        print('words of one use, a CALL without the routine it runs')
+        for name, (fewest, most) in timing.statements.items():
+            print(name.ljust(20), f'{fewest} word{'s' if fewest != 1 else ''}' if fewest == most else f'{fewest} to {most} words', sep='\t')
+
+    print('======Worst case=====')
+    for r in timing.routines:
+        print(f'{r.name} {format(r.address, 'X').zfill(5)}')
+        for e in r.exits:
+            print(''.ljust(4), e.kind.ljust(8), where(e.address), cycles(e.cycles), sep='\t')
+        for address in r.loops:
+            print(''.ljust(4), 'loop'.ljust(8), where(address), 'no known bound', sep='\t')
+        if not r.exits:
+            print(''.ljust(4), 'never reaches HALT or returns', sep='\t')
+
+    print('\033[0m')
+
+def print_error(*text):
+    print('\033[1;4;7;31m') # red with blue, underline, inverted text
+    print('\n'.join(text))
+    print('\033[0m')
+    exit(1)
+
+def main(argv=None):
+    # handle args
+    parser = argparse.ArgumentParser(
+        prog='rochoyita',
+        description='Simple assembler from the Sutra-1 System',
+        epilog='Copyright (C) 2025 Debayan "rnayabed" Sutradhar',
+    )
+
+    # several inputs can not be in a mutually exclusive group before Python 3.13
+    parser.add_argument('-v', '--version', action='store_true', help='Version and copyright information')
+    parser.add_argument('input', nargs='*', help='Input assembly source file, or several with --batch')
+    parser.add_argument('-o', '--output', help='Output Logisim Evolution memory image file, or directory with --batch')
+    parser.add_argument('-r', '--raw', help='Disable preprocessor', action='store_true')
+    parser.add_argument('-D', '--define', action='append', default=[], metavar='MACRO[=VALUE]', help='Define a macro before preprocessing')
+    parser.add_argument('-I', '--include', action='append', default=[], metavar='DIR', help='Add directory to #include search path')
+    parser.add_argument('-O', '--optimize', action='store_true', help='Remove redundant loads and ALU flag sets')
+    parser.add_argument('--call-abi', choices=['inline', 'compact'], default='inline', help='CALL/RETURN code: inline at every use (default), or shared save and restore stubs')
+    parser.add_argument('--cache', nargs='?', const=default_cache_directory(), metavar='DIR', help='Reuse results of unchanged builds, stored in DIR (default: ~/.cache/rochoyita)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_SIZE // (1024 * 1024), metavar='MB', help='Remove least recently used cache entries above this size (default: %(default)s)')
+    parser.add_argument('-c', '--compile', action='store_true', help='Output a relocatable object file to link later, instead of a memory image')
+    parser.add_argument('--link', action='append', default=[], metavar='OBJECT', help='Link with an object file output by -c. The input may be an object file as well')
+    parser.add_argument('-l', '--listing', metavar='LISTING', help='Output tab separated listing file (address, hex, binary, source file, line), or directory with --batch')
+    parser.add_argument('-g', '--debug-map', metavar='FILE', help='Output address to source statement map for anukoron --profile, or directory with --batch')
+    parser.add_argument('--timing', action='store_true', help='Print cycle counts of labels and pseudo instructions, and worst case paths of the program, ISR and routines')
+    parser.add_argument('--isr-budget', type=int, metavar='CYCLES', help='Fail unless every path from :ISR to HALT, return or the program takes at most CYCLES')
+    parser.add_argument('--batch', action='store_true', help='Assemble every input as a separate program, in parallel')
+    parser.add_argument('--manifest', metavar='FILE', help='Read --batch inputs from FILE, one per line')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Processes used by --batch (default: number of CPUs)')
+    parser.add_argument('--stats', action='store_true', help='Print time spent per build phase and counters')
+    parser.add_argument('--stats-json', metavar='FILE', help='Write --stats as JSON to FILE')
+    parser.add_argument('--verbosity', choices=[v.name.lower() for v in Verbosity], default='summary', help='Console output level, full adds a per line trace (default: summary)')
+    parser.add_argument('-q', '--quiet', action='store_const', dest='verbosity', const='silent', help='Same as --verbosity silent')
+    args = parser.parse_args(argv)
+
+    if args.version and args.input:
+        parser.error('argument -v/--version: not allowed with argument input')
+
+    if args.version:
+        print(f'''rochoyita version {VERSION}
+Copyright (C) 2025 Debayan Sutradhar
+
+This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>. ''')
+        exit()
+
+    inputs = list(args.input)
+    if args.manifest:
+        args.batch = True
+        try:
+            with open(args.manifest, 'r') as manifest:
+                inputs += [l.strip() for l in manifest if l.strip() and not l.lstrip().startswith('#')]
+        except OSError:
+            print_error(f'manifest file "{args.manifest}" not found!')
+
+    if not inputs:
+        parser.error('no input file')
+
+    if len(inputs) > 1 and not args.batch:
+        parser.error('more than one input file, use --batch')
+
+    for input_file_path in inputs:
+        if not Path(input_file_path).is_file():
+            print_error(f'input file "{input_file_path}" not found!')
+
+    if args.compile and args.link:
+        print_error('--link can not be used with -c')
+
+    if args.compile and args.debug_map:
+        print_error('--debug-map can not be used with -c')
+
+    if args.isr_budget is not None:
+        args.timing = True
+
+    if args.timing and (args.compile or args.batch):
+        print_error('--timing can not be used with -c or --batch')
+
+    defines = {}
+    for d in args.define:
+        name, _, value = d.partition('=')
+        defines[name] = value if value else '1'
+
+    verbosity = Verbosity[args.verbosity.upper()]
+    extension = 'o' if args.compile else 'hex'
+    stats = args.stats or args.stats_json is not None
+
+    assembler_args = (defines, args.include, args.raw)
+    assembler_kwargs = dict(listing=args.listing is not None or args.debug_map is not None or args.timing or args.compile, optimize=args.optimize, call_abi=args.call_abi,
+                            cache=BuildCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None)
+
+    if args.batch:
+        output_directory = Path(args.output) if args.output else Path.cwd()
+        listing_directory = Path(args.listing) if args.listing else None
+        debug_map_directory = Path(args.debug_map) if args.debug_map else None
+
+        stems = {}
+        for input_file_path in inputs:
+            stem = Path(input_file_path).stem
+            if stem in stems:
+                print_error(f'"{stems[stem]}" and "{input_file_path}" would both be written to {stem}.{extension}')
+            stems[stem] = input_file_path
+
+        for directory in (output_directory, listing_directory, debug_map_directory):
+            if directory is not None:
+                directory.mkdir(parents=True, exist_ok=True)
+
+        tasks = [(input_file_path,
+                  str(output_directory / f'{Path(input_file_path).stem}.{extension}'),
+                  str(listing_directory / f'{Path(input_file_path).stem}.lst') if listing_directory else None,
+                  str(debug_map_directory / f'{Path(input_file_path).stem}.map') if debug_map_directory else None,
+                  args.compile, args.link, assembler_args, assembler_kwargs, stats) for input_file_path in inputs]
+
+        jobs = args.jobs or os.cpu_count() or 1
+        start = time.perf_counter()
+        results = batch(tasks, jobs)
+
+        if verbosity >= Verbosity.SUMMARY or any(r.error for r in results):
+            print_batch_report(results, time.perf_counter() - start, jobs)
+
+        if stats:
+            total = Stats()
+            for r in results:
+                if r.stats:
+                    total.merge(r.stats)
+            report_stats(total, args)
+
+        if any(r.error for r in results):
+            exit(1)
+        return
+
+    input_file_path = inputs[0]
+    output_file_path = args.output if args.output else f'{Path.cwd()}{os.sep}{Path(input_file_path).stem}.{extension}'
+
+    assembler = Assembler(*assembler_args, verbosity=verbosity, **assembler_kwargs, stats=Stats() if stats else None)
+
+    try:
+        program = build(assembler, input_file_path, args.compile, args.link)
+    except AssemblerError as e:
+        print_error(*e.text)
+
+    if verbosity >= Verbosity.SUMMARY:
+        print_memory_layout(program)
+
+    with assembler.phase('output'):
+        write_output(program, output_file_path, args.listing, args.compile, args.debug_map)
+
+    if args.timing:
+        with assembler.phase('timing'):
+            t = timing(program)
+
+        if verbosity >= Verbosity.SUMMARY:
+            print_timing(t, program)
+
+        if args.isr_budget is not None and len(program.isr) > 0:
+            isr = next(r for r in t.routines if r.address == Constants.ISR_ADDRESS)
+            worst = isr.worst()
+            if worst is None or worst > args.isr_budget:
+                print_error(f'ISR takes {'unbounded cycles' if worst is None else f'up to {worst} cycles'}, more than the budget of {args.isr_budget} cycles')
+
+    if stats:
+        report_stats(assembler.stats, args)
+
+def report_stats(stats, args):
+    if args.stats:
+        print_stats(stats)
 
-add_output_lines(program_output)
-add_output_lines(isr_output, Constants.ISR_ADDRESS)
+    if args.stats_json:
+        write_stats(stats, args.stats_json)
 
-output_file.writelines(output_lines)
-output_file.close() 
\ No newline at end of file
+if __name__ == '__main__':
+    main()
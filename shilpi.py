@@ -9,7 +9,7 @@ row data                10<data:8>
 load buffer             1100000000
 '''
 
-import argparse, math, os
+import argparse, functools, itertools, operator, os, time
 from pathlib import Path
 
 VERSION = 1.0
@@ -20,9 +20,8 @@ def error_raw(*text):
     print('\033[0m')
     exit(1)
 
-def generate_art_from_text(text):
-    chars = {
-        'A': '''
+FONT = {
+    'A': '''
 ........
 .######.
 .#....#.
@@ -32,7 +31,7 @@ def generate_art_from_text(text):
 .#....#.
 ........
 ''',
-        'B': '''
+    'B': '''
 ........
 .######.
 .#....#.
@@ -42,7 +41,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'C': '''
+    'C': '''
 ........
 .######.
 .#......
@@ -52,7 +51,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'D': '''
+    'D': '''
 ........
 .####...
 .#...#..
@@ -62,7 +61,7 @@ def generate_art_from_text(text):
 .####...
 ........
 ''',
-        'E': '''
+    'E': '''
 ........
 .######.
 .#......
@@ -72,7 +71,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'F': '''
+    'F': '''
 ........
 .######.
 .#......
@@ -82,7 +81,7 @@ def generate_art_from_text(text):
 .#......
 ........
 ''',
-        'G': '''
+    'G': '''
 ........
 .######.
 .#......
@@ -92,7 +91,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'H': '''
+    'H': '''
 ........
 .#....#.
 .#....#.
@@ -102,7 +101,7 @@ def generate_art_from_text(text):
 .#....#.
 ........
 ''',
-        'I': '''
+    'I': '''
 ........
 .######.
 ...#....
@@ -112,7 +111,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'J': '''
+    'J': '''
 ........
 .######.
 ....#...
@@ -122,7 +121,7 @@ def generate_art_from_text(text):
 ..###...
 ........
 ''',
-        'K': '''
+    'K': '''
 ........
 .#...#..
 .#..#...
@@ -132,7 +131,7 @@ def generate_art_from_text(text):
 .#...#..
 ........
 ''',
-        'L': '''
+    'L': '''
 ........
 .#......
 .#......
@@ -142,7 +141,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'M': '''
+    'M': '''
 ........
 .##..##.
 .#.##.#.
@@ -152,7 +151,7 @@ def generate_art_from_text(text):
 .#....#.
 ........
 ''',
-        'N': '''
+    'N': '''
 ........
 .##...#.
 .#.#..#.
@@ -162,7 +161,7 @@ def generate_art_from_text(text):
 .#...##.
 ........
 ''',
-        'O': '''
+    'O': '''
 ........
 .######.
 .#....#.
@@ -172,7 +171,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'P': '''
+    'P': '''
 ........
 .######.
 .#....#.
@@ -182,7 +181,7 @@ def generate_art_from_text(text):
 .#......
 ........
 ''',
-        'Q': '''
+    'Q': '''
 ........
 .####...
 .#...#..
@@ -192,7 +191,7 @@ def generate_art_from_text(text):
 ......#.
 ........
 ''',
-        'R': '''
+    'R': '''
 ........
 .#####..
 .#....#.
@@ -202,7 +201,7 @@ def generate_art_from_text(text):
 .#..##..
 ........
 ''',
-        'S': '''
+    'S': '''
 ........
 .######.
 ..#.....
@@ -212,7 +211,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'T': '''
+    'T': '''
 ........
 .######.
 ...#....
@@ -222,7 +221,7 @@ def generate_art_from_text(text):
 ...#....
 ........
 ''',
-        'U': '''
+    'U': '''
 ........
 .#....#.
 .#....#.
@@ -232,7 +231,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'V': '''
+    'V': '''
 ........
 .#....#.
 .#...#..
@@ -242,7 +241,7 @@ def generate_art_from_text(text):
 .#......
 ........
 ''',
-        'W': '''
+    'W': '''
 ........
 .#....#.
 .#....#.
@@ -252,7 +251,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        'X': '''
+    'X': '''
 ........
 .#...#..
 ..#.#...
@@ -262,7 +261,7 @@ def generate_art_from_text(text):
 .#...#..
 ........
 ''',
-        'Y': '''
+    'Y': '''
 ........
 .#....#.
 .#....#.
@@ -272,7 +271,7 @@ def generate_art_from_text(text):
 ...#....
 ........
 ''',
-        'Z': '''
+    'Z': '''
 ........
 .######.
 .....##.
@@ -282,7 +281,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '0': '''
+    '0': '''
 ........
 .######.
 .#....#.
@@ -292,7 +291,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '1': '''
+    '1': '''
 ........
 ....#...
 ..###...
@@ -302,7 +301,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '2': '''
+    '2': '''
 ........
 .######.
 ......#.
@@ -312,7 +311,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '3': '''
+    '3': '''
 ........
 .######.
 ......#.
@@ -322,7 +321,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '4': '''
+    '4': '''
 ........
 .#....#.
 .#....#.
@@ -332,7 +331,7 @@ def generate_art_from_text(text):
 ......#.
 ........
 ''',
-        '5': '''
+    '5': '''
 ........
 .######.
 .#......
@@ -342,7 +341,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '6': '''
+    '6': '''
 ........
 .######.
 .#......
@@ -352,7 +351,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '7': '''
+    '7': '''
 ........
 .######.
 ......#.
@@ -362,7 +361,7 @@ def generate_art_from_text(text):
 ......#.
 ........
 ''',
-        '8': '''
+    '8': '''
 ........
 .######.
 .#....#.
@@ -372,7 +371,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        '9': '''
+    '9': '''
 ........
 .######.
 .#....#.
@@ -382,7 +381,7 @@ def generate_art_from_text(text):
 ......#.
 ........
 ''',
-        '0': '''
+    '0': '''
 ........
 .######.
 .#....#.
@@ -392,7 +391,7 @@ def generate_art_from_text(text):
 .######.
 ........
 ''',
-        ' ': '''
+    ' ': '''
 ........
 ........
 ........
@@ -402,67 +401,148 @@ def generate_art_from_text(text):
 ........
 ........
 '''
-    }
+}
 
-    # each character occupies 8 rows and 8 columns
-    # col = 7
-    # row = 7
-    # print(chars[' '].strip()[col + (9 * row)])
-    # exit()
+DISPLAY_WIDTH = 64
+DISPLAY_HEIGHT = 32
 
-    text_index = 0
+# A frame is 64 columns of 32 bit ints, like anukoron.Display keeps them. Row bank b is bits 8b to
+# 8b + 7 with the top row of a bank in its highest bit, so bank 3 is the top and row 0 is bit 31
 
-    # col_units = math.ceil(len(text) / 8)        # 9
-    
-    # row_units = math.ceil(col_units / (64/8))   # 9/8 = 2
+PIXELS = bytes(ord('1') if i == ord('#') else ord('0') for i in range(256))    # '#' -> 1, anything else -> 0
 
+def glyph_columns(glyph):
+    # 8 bytes, one per column from the left with the top row in the highest bit
+    rows = [int(row.encode('ascii', 'replace').translate(PIXELS), 2) for row in glyph.split()]
+    return bytes(sum(((rows[i] >> (7 - col)) & 1) << (7 - i) for i in range(8)) for col in range(8))
+
+GLYPHS = {char: glyph_columns(glyph) for char, glyph in FONT.items()}
+
+def parse_frames(text):
+    # frames of an image file, 32 rows of 64 pixels each and separated by empty lines
+    frames = []
+
+    for rows_follow, rows in itertools.groupby(text.splitlines(), bool):
+        if not rows_follow:
+            continue
+
+        rows = [row[:DISPLAY_WIDTH].ljust(DISPLAY_WIDTH, '.') for row in itertools.islice(rows, DISPLAY_HEIGHT)]
+        rows += ['.' * DISPLAY_WIDTH] * (DISPLAY_HEIGHT - len(rows))
+
+        frames.append([int(''.join(column).encode('ascii', 'replace').translate(PIXELS), 2) for column in zip(*rows)])
+
+    return frames or [[0] * DISPLAY_WIDTH]
+
+def frame_text(columns):
+    return ''.join(''.join('#' if (c >> (31 - row)) & 1 else '.' for c in columns) + '\n' for row in range(DISPLAY_HEIGHT))
+
+def generate_frame_from_text(text):
+    # 4 rows of 8 characters, each one 8x8 pixels
     text = text.upper()
 
     MAX_LEN = 8*4
     if len(text) > MAX_LEN:
         error_raw(f'Text too long! Max permitted length is {MAX_LEN}')
 
-    rows = []
-    for i in range(0, len(text), 8):
-        e = i+8
-        rows.append(text[i:e] if e < len(text) else text[i:].ljust(8))
-
-    rows = rows[:4]
-
-    if len(rows) < 4:
-        for i in range(4 - len(rows)):
-            rows.append(' '*8)
-
-    art = ''
-    for row_text in rows:
-        for row in range(8):
-            for char in row_text:
-                for col in range(8):
-                    if char not in chars:
-                        error_raw(f'character "{char}" in input text is not supported.')
-                    art += chars[char].strip()[col + (9 * row)]
-            art+='\n'
-    
-    return art
-
-
-
-# handle args
-parser = argparse.ArgumentParser(
-    prog='shilpi',
-    description='Simple pixel drawer from the Sutra-1 System',
-    epilog='Copyright (C) 2025 Debayan "rnayabed" Sutradhar'
-)
-
-input_group = parser.add_mutually_exclusive_group()
-input_group.add_argument('-v', '--version', action='store_true', help='Version and copyright information')
-input_group.add_argument('input', nargs='?', help='Input text or file')
-parser.add_argument('-o', '--output')
-parser.add_argument('-t', '--text', action='store_true')
-args = parser.parse_args()
-
-if args.version:
-    print(f'''shilpi version {VERSION}
+    for char in text:
+        if char not in GLYPHS:
+            error_raw(f'character "{char}" in input text is not supported.')
+
+    text = text.ljust(MAX_LEN)
+
+    columns = [0] * DISPLAY_WIDTH
+    for text_row in range(4):
+        shift = (3 - text_row) * 8
+        for i, char in enumerate(text[text_row * 8:text_row * 8 + 8]):
+            for col, data in enumerate(GLYPHS[char]):
+                columns[i * 8 + col] |= data << shift
+
+    return columns
+
+def generate_program(frames):
+    output = ['LOADI C b1100000000']
+
+    reg_values={}
+    def set_reg(reg, value):
+        if reg not in reg_values or reg_values[reg][:5] != value[:5]:
+            output.append(f'LOADIU {reg} {value[:5]}')
+        if reg not in reg_values or reg_values[reg][5:10] != value[5:10]:
+            output.append(f'LOADIL {reg} {value[5:10]}')
+
+        reg_values[reg] = value
+
+        output.append(f'OUT {reg}')
+
+    # A = row bank & col index
+    # B = row data
+    # C = load buffer command
+
+    # only banks that changed since the last frame are sent, the first one follows a blank display
+    shown = [0] * DISPLAY_WIDTH
+    for columns in frames:
+        for c, (column, previous) in enumerate(zip(columns, shown)):
+            changed = column ^ previous
+            if not changed:
+                continue
+
+            for rb in range(4):
+                if (changed >> (rb * 8)) & 0xFF:
+                    # select row and column   01<row bank:2><column index:6>
+                    set_reg('A', f'01{rb:02b}{c:06b}')
+
+                    # row data                10<data:8>
+                    set_reg('B', f'10{(column >> (rb * 8)) & 0xFF:08b}')
+
+                    output.append('OUT C')
+
+        shown = columns
+
+    output.append('HALT')
+
+    return output
+
+def check(frames, output):
+    # assemble and run the program on a model of the display
+    # -> (first frame not shown or None, its rows that differ from the display, seconds taken without importing)
+    import rochoyita, anukoron
+
+    start = time.perf_counter()
+    program = rochoyita.assemble('\n'.join(output), file='display-image.S')
+    display = anukoron.Display()
+    anukoron.Machine(anukoron.program_memory(program), display).run()
+
+    # generate_program loads the buffer once per row bank changed, the display is blank before that
+    shown = [(0,) * DISPLAY_WIDTH] + display.frames
+    previous = [0] * DISPLAY_WIDTH
+    loads = 0
+    for n, columns in enumerate(frames):
+        loads += sum(1 for a, b in zip(columns, previous) for rb in range(4) if ((a ^ b) >> (rb * 8)) & 0xFF)
+        previous = columns
+
+        difference = functools.reduce(operator.or_, (a ^ b for a, b in zip(columns, shown[min(loads, len(shown) - 1)])))
+        if difference:
+            return n, [row for row in range(DISPLAY_HEIGHT) if (difference >> (31 - row)) & 1], time.perf_counter() - start
+
+    return None, [], time.perf_counter() - start
+
+def main():
+    # handle args
+    parser = argparse.ArgumentParser(
+        prog='shilpi',
+        description='Simple pixel drawer from the Sutra-1 System',
+        epilog='Copyright (C) 2025 Debayan "rnayabed" Sutradhar'
+    )
+
+    input_group = parser.add_mutually_exclusive_group()
+    input_group.add_argument('-v', '--version', action='store_true', help='Version and copyright information')
+    input_group.add_argument('input', nargs='?', help='Input text or file')
+    parser.add_argument('-o', '--output')
+    parser.add_argument('-t', '--text', action='store_true')
+    parser.add_argument('-c', '--check', action='store_true', help='Run the output on a model of the display and compare it with the input')
+    args = parser.parse_args()
+
+    if args.version:
+        print(f'''shilpi version {VERSION}
 Copyright (C) 2025 Debayan Sutradhar
 
 This program is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License as published by the Free Software Foundation, version 3.
@@ -470,73 +550,33 @@ This program is free software: you can redistribute it and/or modify it under th
 This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License along with this program. If not, see <https://www.gnu.org/licenses/>. ''')
-    exit()
-
-if args.text:
-    art = generate_art_from_text(args.input)
-    output_file_name = args.output if args.output else 'display-image.S'
-    print(art)
-else:
-    input_file_name = args.input
-
-    output_file_name = args.output if args.output else f'{Path.cwd()}{os.sep}display-image.S'
-
-    with open(input_file_name, 'r') as f:
-        # art = f.readlines()
-        art = f.read().strip()
-
-def get_pixel(row, col):
-    return art[col + (65 * row)] == '#'
-    # return art[row][col] == '#'
-
-output = ['LOADI C b1100000000']
-
-reg_values={}
-def set_reg(reg, value):
-    if reg not in reg_values or reg_values[reg][:5] != value[:5]:
-        output.append(f'LOADIU {reg} {value[:5]}')
-    if reg not in reg_values or reg_values[reg][5:10] != value[5:10]:
-        output.append(f'LOADIL {reg} {value[5:10]}')
-
-    reg_values[reg] = value
-
-    # output.append(f'LOADI {reg} b{value}')
-    output.append(f'OUT {reg}')
-    # print(f'reg {reg}, value {value}')
-
-# A = row bank & col index
-# B = row data
-# C = load buffer command
-
-
-for c in range(64):
-    for rb in range(4):
-        o = ''
-        empty = True
-        for i in range(8):
-            row = (((3 - rb)) * 8) + i
-            # 24,25,26,27, 28,29,30,31 (rb = 0)
-            # 16,17,18,19, 20,21,22,23 (rb = 1)
-            # 8,9,10,11,   12,13,14,15 (rb = 2)
-            # 0,1,2,3,     4,5,6,7
-            if get_pixel(row, c):
-                o += '1'
-                empty = False
-            else:
-                o += '0' 
-        
-        if not empty:
-            # select row and column   01<row bank:2><column index:6>
-            # print(f'row bank {rb}, column {c}')
-            set_reg('A', f'01{format(rb, 'b').zfill(2)}{format(c, 'b').zfill(6)}')
-            
-            # row data                10<data:8>
-            set_reg('B', '10' + o)
-
-            output.append('OUT C')
-
-output.append('HALT')
-
-with open(output_file_name, 'w') as f:
-    for l in output:
-        f.write(l + '\n')
\ No newline at end of file
+        exit()
+
+    if args.text:
+        frames = [generate_frame_from_text(args.input)]
+        output_file_name = args.output if args.output else 'display-image.S'
+        print(frame_text(frames[0]))
+    else:
+        input_file_name = args.input
+
+        output_file_name = args.output if args.output else f'{Path.cwd()}{os.sep}display-image.S'
+
+        with open(input_file_name, 'r') as f:
+            frames = parse_frames(f.read())
+
+    output = generate_program(frames)
+
+    with open(output_file_name, 'w') as f:
+        for l in output:
+            f.write(l + '\n')
+
+    if args.check:
+        frame, rows, seconds = check(frames, output)
+
+        if frame is not None:
+            error_raw(f'display does not match {f'frame {frame} of ' if len(frames) > 1 else ''}the input in rows {', '.join(map(str, rows))}')
+
+        print(f'display matches the input{f', {len(frames)} frames' if len(frames) > 1 else ''} ({seconds * 1000:.1f} ms)')
+
+if __name__ == '__main__':
+    main()
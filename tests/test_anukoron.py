@@ -0,0 +1,99 @@
+# Machine, BlockMachine and BatchMachine running the same programs
+# SPDX-License-Identifier: GPL-3.0-only
+
+import sys, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import anukoron, rochoyita
+
+EXAMPLES = sorted((ROOT / 'examples').glob('*.S'))
+
+MAX_CYCLES = 20000      # dot.S never halts
+
+# interrupt lines set by cycle, every line once and two at the same time
+INTERRUPTS = {300: 0b1000, 1500: 0b0001, 4000: 0b0100, 7000: 0b0010, 9000: 0b0011}
+
+def run(engine, memory, interrupts=None):
+    machine = engine(list(memory))
+    machine.run(MAX_CYCLES, interrupts)
+    return machine.state()
+
+def run_batch(memory, interrupts=None, count=3):
+    machine = anukoron.BatchMachine(list(memory), count, interrupts=[interrupts or {}] * count)
+    machine.run(MAX_CYCLES)
+    return machine.states()
+
+class EnginesTest(unittest.TestCase):
+    def assert_engines_agree(self, memory, interrupts=None):
+        expected = run(anukoron.Machine, memory, interrupts)
+        self.assertGreater(expected['cycles'], 0)
+
+        self.assertEqual(run(anukoron.BlockMachine, memory, interrupts), expected)
+
+        if anukoron.np is not None:
+            for state in run_batch(memory, interrupts):
+                self.assertEqual(state, expected)
+
+    def test_examples(self):
+        for example in EXAMPLES:
+            memory = anukoron.program_memory(rochoyita.assemble_file(str(example), include_paths=[str(ROOT / 'examples')]))
+
+            with self.subTest(example=example.name):
+                self.assert_engines_agree(memory)
+
+            with self.subTest(example=example.name, interrupts=True):
+                self.assert_engines_agree(memory, INTERRUPTS)
+
+    def test_store_into_code(self):
+        # the block of the loop is compiled, then its NOOP is overwritten with HALT (1023) once C is 3
+        program = rochoyita.assemble('''
+LOADI C 0
+LOADI D 3
+:loop
+NOOP
+ALUFSET 0010001
+ALUEVAL C
+ALUSTORER C
+COPY C A
+ALUFSETO SUB
+ALUEVAL D
+JZ :patch
+J :loop
+:patch
+LOADI A 0
+COPY A MARH
+LOADI A 4
+COPY A MARL
+LOADI B 1023
+STORE B
+J :loop
+''')
+        state = run(anukoron.Machine, anukoron.program_memory(program))
+        self.assertTrue(state['halted'])
+        self.assertEqual((state['PC'], state['C']), (4, 3))
+
+        self.assert_engines_agree(anukoron.program_memory(program))
+
+    def test_registers(self):
+        # BatchMachine instances start from their own registers
+        if anukoron.np is None:
+            self.skipTest('needs NumPy')
+
+        memory = anukoron.program_memory(rochoyita.assemble('ALUFSETO ADD\nCOPY B A\nALUEVAL C\nALUSTORER D\nOUT D\nHALT'))
+        values = {'B': [1, 2, 1000], 'C': [3, 4, 100]}
+
+        batch = anukoron.BatchMachine(list(memory), 3, values)
+        batch.run(100)
+
+        for i, state in enumerate(batch.states()):
+            machine = anukoron.Machine(list(memory))
+            machine.registers[anukoron.B] = values['B'][i]
+            machine.registers[anukoron.C] = values['C'][i]
+            machine.run(100)
+            self.assertEqual(state, machine.state())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# Command lines must run on every supported Python, run this with the oldest as well
+# SPDX-License-Identifier: GPL-3.0-only
+
+import subprocess, sys, tempfile, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def run(*args):
+    return subprocess.run([sys.executable, *map(str, args)], cwd=ROOT, capture_output=True, text=True)
+
+class CommandLine(unittest.TestCase):
+    def test_help(self):
+        for tool in ('rochoyita.py', 'anukoron.py', 'shilpi.py', 'benchmarks/bench.py'):
+            with self.subTest(tool):
+                result = run(tool, '-h')
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertIn('usage:', result.stdout)
+
+    def test_version(self):
+        result = run('rochoyita.py', '-v')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('rochoyita version', result.stdout)
+
+    def test_version_with_input(self):
+        result = run('rochoyita.py', '-v', 'examples/dot.S')
+        self.assertEqual(result.returncode, 2)
+        self.assertIn('not allowed with argument input', result.stderr)
+
+    def test_no_input(self):
+        self.assertEqual(run('rochoyita.py').returncode, 2)
+
+    def test_assemble_and_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            for example in ('dot.S', 'stack.S'):
+                with self.subTest(example):
+                    hex_file = directory / example.replace('.S', '.hex')
+                    result = run('rochoyita.py', ROOT / 'examples' / example, '-q', '-o', hex_file)
+                    self.assertEqual(result.returncode, 0, result.stderr)
+                    result = run('anukoron.py', hex_file, '--max-cycles', 10000, '-q')
+                    self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            inputs = sorted((ROOT / 'examples').glob('*.S'))
+            result = run('rochoyita.py', '--batch', '-j', 1, '-q', '-o', directory, *inputs)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(len(list(Path(directory).glob('*.hex'))), len(inputs))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# Linking objects must give the same program as assembling their sources as one file
+# SPDX-License-Identifier: GPL-3.0-only
+
+import sys, tempfile, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import rochoyita
+
+MAIN = '''
+LOADI C 5
+LOADI D 1
+:main-loop
+CALL :sum
+OUT D
+J :main-end
+:main-end
+HALT
+'''
+
+SUM = '''
+:sum
+ALUFSETO ADD
+COPY C A
+ALUEVAL D
+ALUSTORER D
+RETURN
+'''
+
+# calls a routine of another object, and jumps both ways between its labels
+SCALE = '''
+:scale
+CALL :sum
+JZ :scale-done
+CALL :sum
+:scale-done
+RETURN
+'''
+
+# last, as every line after :ISR goes to the ISR section
+HANDLER = '''
+:ISR
+ILOCKSET 1
+LOADI B 69
+OUT B
+CALL :scale
+HALT
+'''
+
+def link(*sources):
+    return rochoyita.link_objects([rochoyita.assemble_object(source, file=f'object{n}.S') for n, source in enumerate(sources)])
+
+class LinkTest(unittest.TestCase):
+    def assert_same_words(self, linked, single):
+        self.assertEqual(list(linked.program), list(single.program))
+        self.assertEqual(list(linked.isr), list(single.isr))
+
+    def test_objects(self):
+        for sources in [(MAIN, SUM), (MAIN, SUM, SCALE), (MAIN, SCALE, SUM, HANDLER), (SUM, SCALE, MAIN)]:
+            with self.subTest(objects=len(sources)):
+                self.assert_same_words(link(*sources), rochoyita.assemble('\n'.join(sources)))
+
+    def test_object_files(self):
+        # objects written with -c and read back link the same
+        with tempfile.TemporaryDirectory() as directory:
+            objects = []
+            for n, source in enumerate((MAIN, SCALE, SUM, HANDLER)):
+                path = Path(directory) / f'object{n}.o'
+                rochoyita.write_object(rochoyita.assemble_object(source, file=f'object{n}.S'), path)
+                objects.append(rochoyita.read_object(path))
+
+            self.assert_same_words(rochoyita.link_objects(objects), rochoyita.assemble('\n'.join((MAIN, SCALE, SUM, HANDLER))))
+
+    def test_listing(self):
+        # listing addresses move along with the words
+        linked = link(MAIN, SUM)
+        single = rochoyita.assemble(MAIN + '\n' + SUM, listing=True)
+        self.assertEqual([l[0] for l in linked.listing], [l[0] for l in single.listing])
+        self.assertEqual([l[3:] for l in linked.listing], [l[3:] for l in single.listing])
+
+    def test_labels(self):
+        with self.assertRaises(rochoyita.AssemblerError):
+            link(MAIN, SUM, SUM)
+
+        with self.assertRaises(rochoyita.AssemblerError):
+            link(MAIN)
+
+if __name__ == '__main__':
+    unittest.main()
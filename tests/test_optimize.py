@@ -0,0 +1,153 @@
+# -O and the compact CALL ABI must not change what a program does
+# SPDX-License-Identifier: GPL-3.0-only
+
+import sys, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import anukoron, rochoyita
+
+EXAMPLES = sorted((ROOT / 'examples').glob('*.S'))
+
+BUILDS = [
+    {'optimize': True},
+    {'call_abi': 'compact'},
+    {'optimize': True, 'call_abi': 'compact'},
+]
+
+# what a program can rely on. Jumps load their address through A and B, MAR and ALU flags are
+# scratch for CALL as well, so those depend on where code ends up
+OBSERVED = ('halted', 'outputs', 'C', 'D', 'SP', 'IMR')
+
+MAX_CYCLES = 20000
+
+# nested, repeated and tail calls, leaf routines small enough to be inlined by -O
+CALLS = '''
+LOADI C 5
+LOADI D 1
+:again
+CALL :sum
+OUT D
+CALL :twice
+OUT D
+CALL :mask
+OUT D
+COPY C A
+LOADI B 1
+ALUFSETO SUB
+ALUEVAL B
+ALUSTORER C
+JZ :done
+J :again
+:done
+OUT C
+OUT D
+HALT
+
+:sum
+ALUFSETO ADD
+COPY C A
+ALUEVAL D
+ALUSTORER D
+RETURN
+
+:twice
+CALL :sum
+CALL :sum
+RETURN
+
+:mask
+LOADI B 1022
+J :tail
+
+:tail
+COPY D A
+ALUFSETO AND
+ALUEVAL B
+ALUSTORER D
+RETURN
+'''
+
+# jumps back once to h00005, the second LOADI C 5, with C holding 7 instead
+FIXED_JUMP = '''
+LOADI D 0
+LOADI C 5
+OUT C
+LOADI C 5
+OUT C
+COPY D A
+ALUFSETO ADD
+ALUEVAL D
+JZ :again
+HALT
+:again
+LOADI D 1
+LOADI C 7
+J h00005
+'''
+
+def observed(program, interrupts=None):
+    machine = anukoron.Machine(anukoron.program_memory(program))
+    machine.run(MAX_CYCLES, interrupts)
+    state = machine.state()
+    return {key: state[key] for key in OBSERVED}
+
+class OptimizeTest(unittest.TestCase):
+    def assert_builds_agree(self, assemble):
+        expected = observed(assemble())
+
+        for build in BUILDS:
+            with self.subTest(**build):
+                self.assertEqual(observed(assemble(**build)), expected)
+
+        return expected
+
+    def test_examples(self):
+        for example in EXAMPLES:
+            def assemble(**kwargs):
+                return rochoyita.assemble_file(str(example), include_paths=[str(ROOT / 'examples')], **kwargs)
+
+            # programs waiting for an interrupt do as much as fits in the cycles, which -O changes
+            if not observed(assemble())['halted']:
+                continue
+
+            with self.subTest(example=example.name):
+                self.assert_builds_agree(assemble)
+
+    def test_calls(self):
+        expected = self.assert_builds_agree(lambda **kwargs: rochoyita.assemble(CALLS, **kwargs))
+        self.assertTrue(expected['halted'])
+        self.assertGreater(len(expected['outputs']), 4)
+
+    def test_fixed_jump(self):
+        expected = self.assert_builds_agree(lambda **kwargs: rochoyita.assemble(FIXED_JUMP, **kwargs))
+        self.assertEqual(expected['outputs'], [5, 5, 5])
+
+    def test_fixed_jump_registers(self):
+        # the relaxation follows registers into h00005 from both the fall through and the jump
+        code = rochoyita.assemble_object(FIXED_JUMP)
+        registers = {i: r for isr, i, r in rochoyita.word_registers(code, []) if not isr}
+        self.assertEqual(registers[4]['C'][1][0], 5)
+        self.assertIsNone(registers[5]['C'][1][0])
+
+    def test_optimize_changes_code(self):
+        # the tests above would pass trivially if nothing was optimized
+        default = rochoyita.assemble(CALLS)
+        optimized = rochoyita.assemble(CALLS, optimize=True)
+        self.assertLess(len(optimized.program), len(default.program))
+        self.assertTrue(optimized.inlined)
+
+    def test_display_outputs(self):
+        # every key press moves the dot, whatever the ISR takes
+        interrupts = {300: 0b1000, 1500: 0b0001, 4000: 0b0100, 7000: 0b0010}
+        outputs = []
+        for build in [{}] + BUILDS:
+            program = rochoyita.assemble_file(str(ROOT / 'examples' / 'dot.S'), **build)
+            outputs.append(observed(program, interrupts)['outputs'])
+
+        self.assertEqual(outputs, [outputs[0]] * len(outputs))
+
+if __name__ == '__main__':
+    unittest.main()
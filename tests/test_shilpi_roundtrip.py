@@ -0,0 +1,79 @@
+# Round trip of shilpi output through rochoyita and the display model of anukoron
+# SPDX-License-Identifier: GPL-3.0-only
+
+import sys, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import anukoron, rochoyita, shilpi
+
+IMAGES = sorted((ROOT / 'examples' / 'images').glob('*.txt'))
+TEXTS = ['namaste world', 'Sutra 1', '0123456789', 'ABCDEFGHIJKLMNOPQRSTUVWXYZ', '']
+
+def shown_frames(frames):
+    # frame_text of the display after each input frame, as generated and run
+    output = shilpi.generate_program(frames)
+    program = rochoyita.assemble('\n'.join(output), file='display-image.S')
+    display = anukoron.Display()
+    machine = anukoron.Machine(anukoron.program_memory(program), display)
+    machine.run()
+
+    assert machine.halted
+
+    # the buffer is loaded once per row bank changed, the display is blank before that
+    shown = [(0,) * shilpi.DISPLAY_WIDTH] + display.frames
+    previous = [0] * shilpi.DISPLAY_WIDTH
+    loads = 0
+    texts = []
+    for columns in frames:
+        loads += sum(1 for a, b in zip(columns, previous) for rb in range(4) if ((a ^ b) >> (rb * 8)) & 0xFF)
+        previous = columns
+        texts.append(anukoron.frame_text(shown[loads]))
+
+    assert loads == len(display.frames)
+    return texts
+
+class RoundTripTest(unittest.TestCase):
+    def assert_round_trip(self, frames):
+        self.assertEqual(shown_frames(frames), [shilpi.frame_text(f) for f in frames])
+        self.assertIsNone(shilpi.check(frames, shilpi.generate_program(frames))[0])
+
+    def test_images(self):
+        for image in IMAGES:
+            with self.subTest(image=image.name):
+                frames = shilpi.parse_frames(image.read_text())
+                self.assertEqual(len(frames), 1)
+
+                # every pixel other than '#' is off
+                rows = image.read_text().strip('\n').splitlines()
+                expected = ''.join(''.join('#' if p == '#' else '.' for p in row.ljust(64)) + '\n' for row in rows)
+                self.assertEqual(shilpi.frame_text(frames[0]), expected)
+
+                self.assert_round_trip(frames)
+
+    def test_texts(self):
+        for text in TEXTS:
+            with self.subTest(text=text):
+                self.assert_round_trip([shilpi.generate_frame_from_text(text)])
+
+    def test_frame_sequence(self):
+        text = '\n\n'.join(image.read_text() for image in IMAGES + IMAGES[::-1])
+        frames = shilpi.parse_frames(text)
+        self.assertEqual(len(frames), 2 * len(IMAGES))
+        self.assert_round_trip(frames)
+
+    def test_check_reports_failed_frame(self):
+        frames = [shilpi.generate_frame_from_text('one'), shilpi.generate_frame_from_text('two')]
+        output = shilpi.generate_program(frames)
+
+        # drop the last row data of the second frame
+        last = max(i for i, line in enumerate(output) if line == 'OUT B')
+        frame, rows, seconds = shilpi.check(frames, output[:last] + output[last + 1:])
+
+        self.assertEqual(frame, 1)
+        self.assertTrue(rows)
+
+if __name__ == '__main__':
+    unittest.main()